@@ -1,9 +1,14 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context, send_file
 from flask_cors import CORS
-from openai import OpenAI
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
+import hmac
+import json
 from datetime import datetime
+from functools import wraps
 import logging
+import math
+import threading
 import time
 
 # 导入数据库相关模块
@@ -11,10 +16,28 @@ from config import config
 from models import db, Conversation
 from database import (
     create_user, get_user_by_api_key, update_user_login,
-    save_chat_message, get_or_create_conversation, save_completion,
-    save_usage_record, get_user_conversations, get_conversation_messages,
-    clear_user_conversations, create_custom_assistant
+    update_user_settings, save_chat_message, get_active_conversation, get_or_create_conversation, save_completion,
+    save_usage_record, get_user_conversation_summaries, get_conversation_message_page,
+    encode_cursor, decode_cursor,
+    clear_user_conversations, create_custom_assistant,
+    create_batch_job, get_batch_job, get_user_batch_jobs, get_batch_items,
+    cancel_batch_job, claim_interrupted_batch_job, mark_stale_batch_job, unit_of_work
 )
+from batch_jobs import batch_runner
+from openai_clients import client_pool, sdk
+from model_catalog import model_catalog, model_capabilities, supports_vision
+from usage_writer import usage_writer
+from usage_stats import usage_stats, PERIODS
+from context_builder import context_builder, count_tokens, count_message_tokens
+from response_cache import response_cache, assistant_prompt_cache, cache_key
+from single_flight import single_flight, request_key
+from rate_limiter import rate_limiter, RateLimitExceeded, retry_after
+from hedging import hedger
+from metrics import metrics
+from request_timing import request_timing, profiler
+from image_store import image_store, ImageError
+from archiver import archiver
+from db_engine import init_engine, install_sqlite_pragmas, log_engine_report
 
 def create_app():
     """创建和配置Flask应用"""
@@ -26,24 +49,58 @@ def create_app():
     
     # 初始化扩展
     CORS(app)
+    init_engine(app)
     db.init_app(app)
+    install_sqlite_pragmas(app)
+    # 数据库迁移由 init_db.py 执行（FLASK_APP=init_db.py flask db ...），应用启动时不加载alembic
+    client_pool.init_app(app)
+    rate_limiter.init_app(app)
+    model_catalog.init_app(app)
+    usage_writer.init_app(app)
+    usage_stats.init_app(app)
+    context_builder.init_app(app)
+    response_cache.init_app(app)
+    assistant_prompt_cache.init_app(app)
+    single_flight.init_app(app)
+    hedger.init_app(app)
+    image_store.init_app(app)
+    metrics.init_app(app)
+    request_timing.init_app(app)
+    profiler.init_app(app)
+    batch_runner.init_app(app)
+    archiver.init_app(app)
     
     # 配置日志
     logging.basicConfig(level=getattr(logging, app.config['LOG_LEVEL']))
     logger = logging.getLogger(__name__)
+    log_engine_report(app)
     
     return app
 
+def start_prewarm(app):
+    """预热上游连接（后台执行，不阻塞启动）
+
+    由服务入口在处理请求的进程中调用（gunicorn的 post_fork、asgi的lifespan启动、开发服务器），
+    不放在 create_app 中：gunicorn主进程预加载应用后fork，fork时仍在运行的线程持有的锁会让worker死锁。
+    """
+    if app.config['OPENAI_PREWARM_CONNECTIONS'] > 0:
+        threading.Thread(
+            target=client_pool.prewarm,
+            args=(app.config['OPENAI_PREWARM_CONNECTIONS'],),
+            daemon=True
+        ).start()
+
 app = create_app()
 logger = logging.getLogger(__name__)
 
-def get_openai_client():
-    """获取当前用户的OpenAI客户端"""
+def get_openai_client(timeout=None):
+    """获取当前用户的OpenAI客户端，timeout为该路由单次上游请求的超时（秒）"""
     api_key = session.get('api_key')
     if not api_key:
         return None
     try:
-        return OpenAI(api_key=api_key)
+        client = client_pool.get(api_key)
+        return client.with_options(timeout=timeout) if timeout else client
     except Exception as e:
         logger.error(f"创建OpenAI客户端失败: {str(e)}")
         return None
@@ -53,32 +110,27 @@ def get_current_user():
     api_key = session.get('api_key')
     if not api_key:
         return None
-    return get_user_by_api_key(api_key)
+    with request_timing.span('auth'):
+        return get_user_by_api_key(api_key)
 
 def verify_api_key(api_key):
-    """验证API密钥是否有效"""
+    """验证API密钥是否有效（使用模型目录缓存，避免每次登录都请求上游）"""
     try:
-        # 简化客户端初始化，避免参数冲突
-        client = OpenAI(api_key=api_key)
-        
-        # 尝试获取模型列表来验证密钥
-        try:
-            models = client.models.list()
-            # 检查是否成功获取到模型列表
-            if models and hasattr(models, 'data') and len(models.data) > 0:
-                logger.info(f"API密钥验证成功，可用模型数量: {len(models.data)}")
-                return True
-            else:
-                logger.warning("API密钥验证失败：未获取到模型列表")
-                return False
-        except Exception as api_error:
-            logger.error(f"API调用失败: {str(api_error)}")
-            return False
-            
+        models = model_catalog.get_models(api_key)
+        if models:
+            logger.info(f"API密钥验证成功，可用模型数量: {len(models)}")
+            return True
+        logger.warning("API密钥验证失败：未获取到模型列表")
+        return False
     except Exception as e:
-        logger.error(f"OpenAI客户端初始化失败: {str(e)}")
+        logger.error(f"API调用失败: {str(e)}")
         return False
 
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    max_length = app.config['MAX_CONTENT_LENGTH']
+    return jsonify({'error': f'请求体超过 {max_length // (1024 * 1024)}MB 大小限制'}), 413
+
 @app.route('/')
 def home():
     """主页面 - 检查是否已登录"""
@@ -128,6 +180,7 @@ def login():
         
     except Exception as e:
         logger.error(f"登录失败: {e}")
+        metrics.record_error(e)
         return jsonify({'error': '登录失败，请重试'}), 500
 
 @app.route('/logout', methods=['POST'])
@@ -140,6 +193,76 @@ def logout():
     session.clear()
     return jsonify({'success': True, 'message': '已退出登录'})
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus指标（配置 METRICS_TOKEN 后需要 Bearer 认证）"""
+    if not metrics.enabled:
+        return jsonify({'error': '指标未启用'}), 404
+    token = app.config['METRICS_TOKEN']
+    if token and not has_bearer_token(token):
+        return jsonify({'error': '未授权'}), 401
+    data, content_type = metrics.render()
+    return Response(data, content_type=content_type)
+
+def has_bearer_token(token):
+    """请求是否携带指定的Bearer令牌"""
+    authorization = request.headers.get('Authorization', '')
+    return hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+def admin_required(view):
+    """管理接口：需要 ADMIN_TOKEN，未配置时接口不可用"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = app.config['ADMIN_TOKEN']
+        if not token:
+            return jsonify({'error': '管理接口未启用'}), 404
+        if not has_bearer_token(token):
+            return jsonify({'error': '未授权'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/profiler', methods=['GET', 'POST'])
+@admin_required
+def api_admin_profiler():
+    """查看或设置请求采样分析比例"""
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        rate = data.get('sample_rate')
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+            return jsonify({'error': 'sample_rate 必须是0到1之间的数字'}), 400
+        if profiler.set_rate(float(rate)) is None:
+            return jsonify({'error': '保存采样比例失败'}), 500
+        logger.info(f"设置请求采样分析比例: {rate}")
+    
+    return jsonify({
+        'sample_rate': profiler.current_rate(),
+        'profiled': profiler.profiled,
+        'profiles': profiler.profiles()
+    })
+
+@app.route('/api/admin/archive', methods=['GET', 'POST'])
+@admin_required
+def api_admin_archive():
+    """查看归档文件和上次归档结果；POST 立即在后台执行一次归档"""
+    if request.method == 'POST':
+        archiver.start(force=True)
+        logger.info("手动触发归档")
+    
+    return jsonify({
+        'pending': archiver.pending(),
+        'last_result': archiver.last_result(),
+        'partitions': archiver.partitions()
+    }), 202 if request.method == 'POST' else 200
+
+@app.route('/api/admin/profiles/<name>')
+@admin_required
+def api_admin_profile(name):
+    """下载分析文件（cProfile格式，可用 snakeviz 或 pstats 查看）"""
+    path = profiler.path(name)
+    if path is None:
+        return jsonify({'error': '分析文件不存在'}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=name)
+
 @app.route('/api/status')
 def api_status():
     """获取API状态"""
@@ -160,9 +283,246 @@ def api_status():
         'logged_in': True,
         'status': 'running',
         'user_id': user.id,
-        'last_login': user.last_login.isoformat() if user.last_login else None
+        'last_login': user.last_login.isoformat() if user.last_login else None,
+        'response_cache': user.response_cache_enabled
     })
 
+@app.route('/api/settings', methods=['POST'])
+def api_settings():
+    """更新用户设置（目前只有补全响应缓存开关）"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    data = request.get_json()
+    response_cache_enabled = data.get('response_cache')
+    if response_cache_enabled is not None and not isinstance(response_cache_enabled, bool):
+        return jsonify({'error': 'response_cache 必须是布尔值'}), 400
+    
+    if not update_user_settings(user, response_cache_enabled=response_cache_enabled):
+        return jsonify({'error': '更新设置失败'}), 500
+    
+    logger.info(f"更新用户设置 - 用户: {user.api_key_masked}, 响应缓存: {user.response_cache_enabled}")
+    return jsonify({'success': True, 'response_cache': user.response_cache_enabled})
+
+@app.route('/api/usage')
+def api_usage():
+    """当前用户的使用统计（从汇总表读取）：period 为 day 或 hour，limit 为最近的时段数"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    period = request.args.get('period', 'day')
+    if period not in PERIODS:
+        return jsonify({'error': 'period 必须是 day 或 hour'}), 400
+    max_limit = app.config['USAGE_MAX_DAYS'] if period == 'day' else app.config['USAGE_MAX_HOURS']
+    limit = min(max(request.args.get('limit', 30 if period == 'day' else 24, type=int), 1), max_limit)
+    
+    with request_timing.span('usage'):
+        summary = usage_stats.summary(user.id, period, limit)
+    return jsonify(summary)
+
+def response_tokens(response):
+    """上游响应实际消耗的token数；没有响应（调用失败）时为0，流式响应用量未知时返回None（保留预扣额度）"""
+    if response is None:
+        return 0
+    usage = getattr(response, 'usage', None)
+    return usage.total_tokens if usage is not None else None
+
+def call_upstream_limited(model, estimated_tokens, create, timeout=None, hedge_route=None, discard=None):
+    """经过限流器调用上游：预扣额度（必要时排队等待），429/5xx按退避重试，返回 (额度凭据, 响应)
+    
+    timeout 为该路由的重试时间预算；指定 hedge_route 时按该路由的延迟分布发出对冲请求，
+    对冲尝试另行预扣额度，被丢弃的尝试结束后按其实际用量修正（失败时退回）。
+    调用失败（包括重试用尽）时退回预扣的额度，成功时由调用方按实际用量 settle。
+    """
+    api_key = session['api_key']
+    ticket = rate_limiter.acquire(api_key, model, estimated_tokens)
+    deadline = time.monotonic() + timeout if timeout else None
+    call = lambda: rate_limiter.call(create, deadline)
+    
+    def reserve_hedge():
+        # 对冲尝试不排队等待额度，额度不足时抛出 RateLimitExceeded（不对冲）
+        hedge_ticket, _ = rate_limiter.reserve(api_key, model, estimated_tokens, max_wait=0)
+        return lambda loser: rate_limiter.settle(hedge_ticket, response_tokens(loser))
+    
+    try:
+        with metrics.upstream(model), request_timing.span('upstream'):
+            if hedge_route:
+                return ticket, hedger.call(hedge_route, model, call, discard, reserve_hedge)
+            return ticket, call()
+    except Exception:
+        rate_limiter.settle(ticket, 0)
+        raise
+
+def open_stream(create):
+    """打开上游流并读取首个分块，对冲请求以首个分块到达的时间为准"""
+    stream = create()
+    return stream, next(iter(stream), None)
+
+def close_stream(opened):
+    stream, _ = opened
+    if hasattr(stream, 'close'):
+        stream.close()
+
+def resume_stream(opened):
+    """从已读取的首个分块继续转发，结束或断开时关闭上游流"""
+    stream, first = opened
+    try:
+        if first is not None:
+            yield first
+        yield from stream
+    finally:
+        close_stream(opened)
+
+def is_rate_limited(error):
+    return isinstance(error, (RateLimitExceeded, sdk().RateLimitError))
+
+def rate_limited_response(error):
+    """限流错误返回429，并通过Retry-After告知建议的等待时间"""
+    wait = error.retry_after if isinstance(error, RateLimitExceeded) else retry_after(error)
+    response = jsonify({'error': '请求过于频繁，请稍后重试', 'retry_after': math.ceil(wait) if wait else None})
+    response.status_code = 429
+    if wait:
+        response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+# 上游调用失败时的日志前缀和错误信息
+UPSTREAM_ERROR_LABELS = {
+    'chat': ('聊天API错误', '聊天失败'),
+    'completion': ('补全API错误', '文本补全失败')
+}
+
+def upstream_error_response(api_type, user_id, model, error):
+    """上游调用失败：保存错误记录，限流单独标记并返回429，便于客户端稍后重试"""
+    log_label, error_label = UPSTREAM_ERROR_LABELS[api_type]
+    logger.error(f"{log_label}: {error}")
+    metrics.record_error(error)
+    
+    save_usage_record(
+        user_id=user_id,
+        api_type=api_type,
+        model=model,
+        tokens_used=0,
+        status='rate_limited' if is_rate_limited(error) else 'error'
+    )
+    
+    if is_rate_limited(error):
+        return rate_limited_response(error)
+    
+    return jsonify({'error': f'{error_label}: {str(error)}'}), 500
+
+def sse_event(payload, event=None):
+    """格式化一条server-sent event"""
+    data = json.dumps(payload, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"data: {data}\n\n"
+
+class StreamCollector:
+    """累积上游流式分块的文本和usage"""
+    
+    def __init__(self, extract_text):
+        self.extract_text = extract_text
+        self.parts = []
+        self.usage = {'prompt_tokens': None, 'completion_tokens': 0, 'total_tokens': 0}
+        self.reported = False
+    
+    def feed(self, chunk):
+        """处理一个分块，返回其中的新增文本（没有时为None）"""
+        if getattr(chunk, 'usage', None):
+            self.usage.update({
+                'prompt_tokens': chunk.usage.prompt_tokens,
+                'completion_tokens': chunk.usage.completion_tokens,
+                'total_tokens': chunk.usage.total_tokens
+            })
+            self.reported = True
+        if not chunk.choices:
+            return None
+        text = self.extract_text(chunk.choices[0])
+        if not text:
+            return None
+        self.parts.append(text)
+        if not self.reported:
+            # 上游未返回usage前，按一个分块约一个token估算
+            self.usage['completion_tokens'] += 1
+            self.usage['total_tokens'] = self.usage['completion_tokens']
+        return text
+    
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+def stream_upstream(chunks, extract_text, on_finish):
+    """把上游流式响应逐块转发为SSE
+    
+    结束时调用 on_finish(text, usage, status)，status 为 success / error / aborted（客户端断开），
+    其返回值作为最后的 done 事件发送给浏览器。
+    """
+    collector = StreamCollector(extract_text)
+    finished = False
+    
+    try:
+        for chunk in chunks:
+            text = collector.feed(chunk)
+            if text:
+                yield sse_event({'delta': text})
+        
+        finished = True
+        yield sse_event(on_finish(collector.text, collector.usage, 'success'), 'done')
+        
+    except Exception as e:
+        logger.error(f"流式响应错误: {e}")
+        metrics.record_error(e)
+        if not finished:
+            finished = True
+            on_finish(collector.text, collector.usage, 'error')
+        yield sse_event({'error': str(e)}, 'error')
+        
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if not finished:
+            on_finish(collector.text, collector.usage, 'aborted')
+
+def sse_response(generator):
+    """包装SSE响应，关闭代理缓冲保证分块及时送达"""
+    return Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/models')
+def api_models():
+    """获取当前密钥可用的模型及其能力"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    try:
+        models = model_catalog.get_models(session['api_key'])
+        if models is None:
+            return jsonify({'error': 'API密钥无效或已过期'}), 401
+        
+        return jsonify({'models': [
+            {'id': model, **model_capabilities(model)} for model in models
+        ]})
+        
+    except Exception as e:
+        logger.error(f"获取模型列表错误: {e}")
+        metrics.record_error(e)
+        return jsonify({'error': f'获取模型列表失败: {str(e)}'}), 502
+
+# 聊天和补全接口分为 准备（读库、构建请求）→ 上游调用 → 保存 几个阶段，
+# 同步视图和 asgi.py 的异步服务共用准备与保存阶段，只有上游调用部分不同。
+# 各阶段之间传递的本轮请求（turn）只包含普通值，不持有ORM对象。
+
 @app.route('/api/chat', methods=['POST'])
 def api_chat():
     """聊天API - 支持文本和图片"""
@@ -174,6 +534,42 @@ def api_chat():
         return jsonify({'error': '用户不存在'}), 401
     
     data = request.get_json()
+    model = data.get('model', 'gpt-3.5-turbo')
+    metrics.set_model(model)
+    
+    if not data.get('message', '').strip():
+        return jsonify({'error': '消息不能为空'}), 400
+    
+    try:
+        turn, error = prepare_chat(user, data)
+        if error:
+            return error
+        
+        # 调用OpenAI API
+        client = get_openai_client(app.config['CHAT_UPSTREAM_TIMEOUT'])
+        
+        if turn['stream']:
+            return sse_response(stream_chat(client, turn))
+        
+        def call_upstream():
+            ticket, response = call_upstream_limited(
+                model,
+                turn['estimated_tokens'],
+                lambda: client.chat.completions.create(**chat_params(turn)),
+                timeout=app.config['CHAT_UPSTREAM_TIMEOUT'],
+                hedge_route='chat'
+            )
+            return save_chat_turn(turn, ticket, response)
+        
+        # 相同的进行中请求（通常是重试）共享同一次上游调用，这一轮对话只保存一次
+        result, shared = single_flight.do(turn['flight_key'], call_upstream)
+        return jsonify(chat_succeeded(turn, result, shared))
+        
+    except Exception as e:
+        return upstream_error_response('chat', user.id, model, e)
+
+def prepare_chat(user, data):
+    """查询对话并构建上游消息，返回 (本轮请求, 错误响应)"""
     message = data.get('message', '').strip()
     model = data.get('model', 'gpt-3.5-turbo')
     max_tokens = data.get('max_tokens', 1000)
@@ -181,11 +577,8 @@ def api_chat():
     images = data.get('images', [])
     conversation_id = data.get('conversation_id')  # 新增：指定对话ID
     
-    if not message:
-        return jsonify({'error': '消息不能为空'}), 400
-    
-    try:
-        # 获取或创建对话
+    # 获取对话；新对话推迟到上游调用成功后与消息一起创建，上游调用期间不持有写事务
+    with request_timing.span('conversation'):
         if conversation_id:
             # 使用指定的对话
             conversation = Conversation.query.filter_by(
@@ -193,107 +586,167 @@ def api_chat():
                 user_id=user.id
             ).first()
             if not conversation:
-                return jsonify({'error': '对话不存在'}), 404
+                return None, (jsonify({'error': '对话不存在'}), 404)
         else:
-            # 获取或创建新对话
-            conversation = get_or_create_conversation(user.id)
-            if not conversation:
-                return jsonify({'error': '创建对话失败'}), 500
-        
-        # 保存用户消息
-        save_chat_message(user.id, conversation.id, 'user', message)
-        
-        # 调用OpenAI API
-        start_time = time.time()
-        client = get_openai_client()
-        
-        # 获取对话历史
-        messages = get_conversation_messages(conversation.id)
-        chat_messages = []
-        
-        # 如果有自定义system prompt，添加到消息开头
-        if conversation.system_prompt:
-            chat_messages.append({
-                'role': 'system',
-                'content': conversation.system_prompt
-            })
-        
-        # 添加其他消息
-        for msg in messages:
-            if msg.role != 'system':  # 跳过已添加的system消息
-                chat_messages.append({
-                    'role': msg.role,
-                    'content': msg.content
-                })
+            conversation = get_active_conversation(user.id)
+    
+    start_time = time.time()
+    
+    # system prompt + 预算内的历史 + 本轮用户消息（本轮消息与AI回复一起保存）
+    with request_timing.span('context'):
+        chat_messages = context_builder.build(conversation, model, max_tokens, message)
+    
+    # 如果有图片且模型支持视觉，构建特殊的消息格式；不支持视觉的模型忽略图片，消息也不关联图片
+    sent_images = images if supports_vision(model) else []
+    if sent_images:
+        # 为支持视觉的模型构建消息；图片优先按ID从图片存储读取，兼容直接传入的data URL
+        content_parts = [{"type": "text", "text": message}]
         
-        # 如果有图片且模型支持视觉，构建特殊的消息格式
-        if images and model in ['gpt-4o', 'gpt-4-vision-preview', 'gpt-4o-mini']:
-            # 为支持视觉的模型构建消息
-            content_parts = [{"type": "text", "text": message}]
-            
-            for image in images:
+        with request_timing.span('images'):
+            for image in sent_images:
+                try:
+                    url = image_store.data_url(image['id']) if image.get('id') else image['data']
+                except ImageError as e:
+                    return None, (jsonify({'error': str(e)}), 400)
                 content_parts.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": image['data']
+                        "url": url
                     }
                 })
-            
-            # 替换最后一条用户消息为多模态消息
-            if chat_messages and chat_messages[-1]['role'] == 'user':
-                chat_messages[-1]['content'] = content_parts
         
-        response = client.chat.completions.create(
-            model=model,
-            messages=chat_messages,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-        
-        response_time = time.time() - start_time
-        assistant_message = response.choices[0].message.content
-        tokens_used = response.usage.total_tokens
-        
-        # 保存AI回复
-        save_chat_message(user.id, conversation.id, 'assistant', assistant_message, model, tokens_used)
-        
-        # 保存使用记录
+        # 替换最后一条用户消息为多模态消息
+        if chat_messages and chat_messages[-1]['role'] == 'user':
+            chat_messages[-1]['content'] = content_parts
+    
+    conversation_id = conversation.id if conversation else None
+    return {
+        'user_id': user.id,
+        'user_masked': user.api_key_masked,
+        'conversation_id': conversation_id,
+        'message': message,
+        'model': model,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'stream': bool(data.get('stream', False)),  # 可选：SSE流式输出
+        'chat_messages': chat_messages,
+        'image_ids': [image['id'] for image in sent_images if image.get('id')],
+        'image_count': len(sent_images),
+        'start_time': start_time,
+        'estimated_tokens': count_message_tokens(chat_messages, model) + max_tokens,
+        'flight_key': request_key('chat', user.id, conversation_id, model, chat_messages, max_tokens, temperature)
+    }, None
+
+def chat_params(turn, stream=False):
+    """上游 chat.completions.create 的参数"""
+    params = {
+        'model': turn['model'],
+        'messages': turn['chat_messages'],
+        'max_tokens': turn['max_tokens'],
+        'temperature': turn['temperature']
+    }
+    if stream:
+        params.update(stream=True, stream_options={'include_usage': True})
+    return params
+
+def save_chat_turn(turn, ticket, response):
+    """上游返回后，在同一事务中保存对话、用户消息、AI回复和使用记录"""
+    user_id, model = turn['user_id'], turn['model']
+    response_time = time.time() - turn['start_time']
+    assistant_message = response.choices[0].message.content
+    tokens_used = response.usage.total_tokens
+    rate_limiter.settle(ticket, tokens_used)
+    
+    with request_timing.span('commit'), unit_of_work():
+        if turn['conversation_id']:
+            target = db.session.get(Conversation, turn['conversation_id'])
+        else:
+            target = get_or_create_conversation(user_id)
+        save_chat_message(user_id, target.id, 'user', turn['message'], image_ids=turn['image_ids'])
+        save_chat_message(user_id, target.id, 'assistant', assistant_message, model, tokens_used)
         save_usage_record(
-            user_id=user.id,
+            user_id=user_id,
             api_type='chat',
             model=model,
             tokens_used=tokens_used,
             response_time=response_time,
             status='success'
         )
-        
-        logger.info(f"聊天成功 - 用户: {user.api_key_masked}, 模型: {model}, Tokens: {tokens_used}, 图片数: {len(images)}")
-        
-        return jsonify({
-            'response': assistant_message,
-            'model': model,
-            'conversation_id': conversation.id,
-            'conversation_title': conversation.title,
-            'usage': {
-                'total_tokens': tokens_used,
-                'prompt_tokens': response.usage.prompt_tokens,
-                'completion_tokens': response.usage.completion_tokens
-            }
-        })
-        
-    except Exception as e:
-        logger.error(f"聊天API错误: {e}")
-        
-        # 保存错误记录
+    
+    return {
+        'response': assistant_message,
+        'model': model,
+        'conversation_id': target.id,
+        'conversation_title': target.title,
+        'usage': {
+            'total_tokens': tokens_used,
+            'prompt_tokens': response.usage.prompt_tokens,
+            'completion_tokens': response.usage.completion_tokens
+        }
+    }
+
+def chat_succeeded(turn, result, shared):
+    """记录本轮聊天；共享了其他请求结果的一方只保存0 token的使用记录"""
+    if shared:
         save_usage_record(
-            user_id=user.id,
+            user_id=turn['user_id'],
             api_type='chat',
-            model=model,
+            model=turn['model'],
             tokens_used=0,
-            status='error'
+            response_time=time.time() - turn['start_time'],
+            status='success'
         )
-        
-        return jsonify({'error': f'聊天失败: {str(e)}'}), 500
+    
+    logger.info(f"聊天成功 - 用户: {turn['user_masked']}, 模型: {turn['model']}, "
+                f"Tokens: {0 if shared else result['usage']['total_tokens']}, 图片数: {turn['image_count']}")
+    return result
+
+def stream_chat(client, turn):
+    """流式聊天：转发增量内容，结束或断开时在同一事务中保存用户消息、AI回复与使用记录"""
+    ticket, opened = call_upstream_limited(
+        turn['model'],
+        turn['estimated_tokens'],
+        lambda: open_stream(lambda: client.chat.completions.create(**chat_params(turn, stream=True))),
+        timeout=app.config['CHAT_UPSTREAM_TIMEOUT'],
+        hedge_route='chat_stream',
+        discard=close_stream
+    )
+    return stream_upstream(
+        resume_stream(opened),
+        lambda choice: choice.delta.content,
+        lambda text, usage, status: finish_chat_stream(turn, ticket, text, usage, status)
+    )
+
+def finish_chat_stream(turn, ticket, text, usage, status):
+    """流式聊天结束：保存消息和使用记录，返回 done 事件的内容"""
+    user_id, model, conversation_id = turn['user_id'], turn['model'], turn['conversation_id']
+    response_time = time.time() - turn['start_time']
+    rate_limiter.settle(ticket, usage['total_tokens'])
+    conversation = None
+    with unit_of_work():
+        if text and status != 'error':
+            if conversation_id:
+                conversation = db.session.get(Conversation, conversation_id)
+            else:
+                conversation = get_or_create_conversation(user_id)
+            save_chat_message(user_id, conversation.id, 'user', turn['message'], image_ids=turn['image_ids'])
+            save_chat_message(user_id, conversation.id, 'assistant', text, model, usage['total_tokens'])
+        save_usage_record(
+            user_id=user_id,
+            api_type='chat',
+            model=model,
+            tokens_used=usage['total_tokens'],
+            response_time=response_time,
+            status=status
+        )
+    logger.info(f"流式聊天结束 - 用户: {turn['user_masked']}, 模型: {model}, 状态: {status}, "
+                f"Tokens: {usage['total_tokens']}, 图片数: {turn['image_count']}")
+    return {
+        'model': model,
+        'conversation_id': conversation.id if conversation else conversation_id,
+        'conversation_title': conversation.title if conversation else None,
+        'usage': usage
+    }
 
 @app.route('/api/completion', methods=['POST'])
 def api_completion():
@@ -306,75 +759,234 @@ def api_completion():
         return jsonify({'error': '用户不存在'}), 401
     
     data = request.get_json()
-    prompt = data.get('prompt', '').strip()
     model = data.get('model', 'gpt-3.5-turbo-instruct')
-    max_tokens = data.get('max_tokens', 1000)
-    temperature = data.get('temperature', 0.7)
+    metrics.set_model(model)
     
-    if not prompt:
+    if not data.get('prompt', '').strip():
         return jsonify({'error': '提示文本不能为空'}), 400
     
     try:
-        start_time = time.time()
-        client = get_openai_client()
+        turn = prepare_completion(user, data)
+        if turn['cached'] is not None:
+            return cached_completion_response(turn)
         
-        response = client.completions.create(
-            model=model,
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
+        client = get_openai_client(app.config['COMPLETION_UPSTREAM_TIMEOUT'])
+        
+        if turn['stream']:
+            return sse_response(stream_completion(client, turn))
         
-        response_time = time.time() - start_time
-        completion_text = response.choices[0].text
-        tokens_used = response.usage.total_tokens
+        # 相同的进行中请求共享同一次上游调用，各自保存补全记录，只有实际调用上游的请求计入token
+        def call_upstream():
+            ticket, response = call_upstream_limited(
+                model,
+                turn['estimated_tokens'],
+                lambda: client.completions.create(**completion_params(turn)),
+                timeout=app.config['COMPLETION_UPSTREAM_TIMEOUT']
+            )
+            rate_limiter.settle(ticket, response.usage.total_tokens)
+            return response
         
-        # 保存补全记录
+        response, shared = single_flight.do(turn['flight_key'], call_upstream)
+        return jsonify(save_completion_result(turn, response, shared))
+        
+    except Exception as e:
+        return upstream_error_response('completion', user.id, model, e)
+
+def prepare_completion(user, data):
+    """解析补全请求并查询响应缓存；命中时保存使用记录，本轮请求的 cached 为缓存的结果"""
+    prompt = data.get('prompt', '').strip()
+    model = data.get('model', 'gpt-3.5-turbo-instruct')
+    max_tokens = data.get('max_tokens', 1000)
+    temperature = data.get('temperature', 0.7)
+    turn = {
+        'user_id': user.id,
+        'user_masked': user.api_key_masked,
+        'prompt': prompt,
+        'model': model,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'stream': bool(data.get('stream', False)),  # 可选：SSE流式输出
+        'start_time': time.time(),
+        'cache_entry_key': None,
+        'cached': None,
+        'estimated_tokens': count_tokens(prompt, model) + max_tokens,
+        'flight_key': request_key('completion', user.id, model, prompt, max_tokens, temperature)
+    }
+    
+    # 确定性请求先查响应缓存，命中时不请求上游、不重复保存补全记录
+    params = {'model': model, 'prompt': prompt, 'max_tokens': max_tokens, 'temperature': temperature}
+    if data.get('cache', True) and response_cache.cacheable(user, params):
+        turn['cache_entry_key'] = cache_key(user.id, params)
+        with request_timing.span('cache'):
+            turn['cached'] = response_cache.get(turn['cache_entry_key'])
+        if turn['cached'] is not None:
+            save_usage_record(
+                user_id=user.id,
+                api_type='completion',
+                model=model,
+                tokens_used=0,
+                response_time=time.time() - turn['start_time'],
+                status='success',
+                cache_hit=True
+            )
+            logger.info(f"补全命中缓存 - 用户: {user.api_key_masked}, 模型: {model}")
+    
+    return turn
+
+def cached_completion_response(turn):
+    """返回缓存的补全结果，流式请求以SSE形式一次性返回"""
+    cached, model = turn['cached'], turn['model']
+    if turn['stream']:
+        return sse_response(replay_cached_completion(cached, model))
+    return jsonify({
+        'completion': cached['completion'],
+        'model': model,
+        'usage': cached['usage'],
+        'cached': True
+    })
+
+def completion_params(turn, stream=False):
+    """上游 completions.create 的参数"""
+    params = {
+        'model': turn['model'],
+        'prompt': turn['prompt'],
+        'max_tokens': turn['max_tokens'],
+        'temperature': turn['temperature']
+    }
+    if stream:
+        params.update(stream=True, stream_options={'include_usage': True})
+    return params
+
+def save_completion_result(turn, response, shared):
+    """在同一事务中保存补全记录和使用记录，返回响应内容"""
+    user_id, model = turn['user_id'], turn['model']
+    cache_entry_key = turn['cache_entry_key']
+    response_time = time.time() - turn['start_time']
+    completion_text = response.choices[0].text
+    tokens_used = response.usage.total_tokens
+    usage = {
+        'total_tokens': tokens_used,
+        'prompt_tokens': response.usage.prompt_tokens,
+        'completion_tokens': response.usage.completion_tokens
+    }
+    
+    with request_timing.span('commit'), unit_of_work():
         save_completion(
-            user_id=user.id,
-            prompt=prompt,
+            user_id=user_id,
+            prompt=turn['prompt'],
             completion=completion_text,
             model=model,
-            max_tokens=max_tokens,
-            temperature=temperature,
+            max_tokens=turn['max_tokens'],
+            temperature=turn['temperature'],
             tokens_used=tokens_used
         )
-        
-        # 保存使用记录
         save_usage_record(
-            user_id=user.id,
+            user_id=user_id,
             api_type='completion',
             model=model,
-            tokens_used=tokens_used,
+            tokens_used=0 if shared else tokens_used,
             response_time=response_time,
-            status='success'
+            status='success',
+            cache_hit=False if cache_entry_key else None
         )
-        
-        logger.info(f"补全成功 - 用户: {user.api_key_masked}, 模型: {model}, Tokens: {tokens_used}")
-        
-        return jsonify({
-            'completion': completion_text,
-            'model': model,
-            'usage': {
-                'total_tokens': tokens_used,
-                'prompt_tokens': response.usage.prompt_tokens,
-                'completion_tokens': response.usage.completion_tokens
-            }
-        })
-        
-    except Exception as e:
-        logger.error(f"补全API错误: {e}")
-        
-        # 保存错误记录
+    
+    if cache_entry_key and not shared:
+        response_cache.set(cache_entry_key, {'completion': completion_text, 'usage': usage})
+    
+    logger.info(f"补全成功 - 用户: {turn['user_masked']}, 模型: {model}, Tokens: {0 if shared else tokens_used}")
+    
+    return {
+        'completion': completion_text,
+        'model': model,
+        'usage': usage
+    }
+
+def stream_completion(client, turn):
+    """流式文本补全：转发增量文本，结束或断开时保存补全与使用记录"""
+    ticket, chunks = call_upstream_limited(
+        turn['model'],
+        turn['estimated_tokens'],
+        lambda: client.completions.create(**completion_params(turn, stream=True)),
+        timeout=app.config['COMPLETION_UPSTREAM_TIMEOUT']
+    )
+    return stream_upstream(
+        chunks,
+        lambda choice: choice.text,
+        lambda text, usage, status: finish_completion_stream(turn, ticket, text, usage, status)
+    )
+
+def finish_completion_stream(turn, ticket, text, usage, status):
+    """流式补全结束：保存补全与使用记录，返回 done 事件的内容"""
+    user_id, model = turn['user_id'], turn['model']
+    cache_entry_key = turn['cache_entry_key']
+    response_time = time.time() - turn['start_time']
+    rate_limiter.settle(ticket, usage['total_tokens'])
+    with unit_of_work():
+        if text and status != 'error':
+            save_completion(
+                user_id=user_id,
+                prompt=turn['prompt'],
+                completion=text,
+                model=model,
+                max_tokens=turn['max_tokens'],
+                temperature=turn['temperature'],
+                tokens_used=usage['total_tokens']
+            )
         save_usage_record(
-            user_id=user.id,
+            user_id=user_id,
             api_type='completion',
             model=model,
-            tokens_used=0,
-            status='error'
+            tokens_used=usage['total_tokens'],
+            response_time=response_time,
+            status=status,
+            cache_hit=False if cache_entry_key else None
         )
+    # 只缓存完整生成的结果
+    if cache_entry_key and status == 'success' and text:
+        response_cache.set(cache_entry_key, {'completion': text, 'usage': usage})
+    logger.info(f"流式补全结束 - 用户: {turn['user_masked']}, 模型: {model}, 状态: {status}, Tokens: {usage['total_tokens']}")
+    return {'model': model, 'usage': usage}
+
+def replay_cached_completion(cached, model):
+    """以SSE形式一次性返回缓存的补全结果"""
+    yield sse_event({'delta': cached['completion']})
+    yield sse_event({'model': model, 'usage': cached['usage'], 'cached': True}, 'done')
+
+@app.route('/api/images', methods=['POST'])
+def api_upload_image():
+    """上传图片：请求体为图片原始字节（或multipart的file字段），返回按内容寻址的图片ID"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    if request.content_length and request.content_length > app.config['IMAGE_MAX_BYTES'] + 64 * 1024:
+        return jsonify({'error': '图片过大'}), 413
+    
+    try:
+        upload = request.files.get('file')
+        image = image_store.save(upload.stream if upload else request.stream)
+        logger.info(f"上传图片 - 用户: {session.get('user_masked')}, 图片: {image['id'][:12]}, 大小: {image['bytes']}")
+        return jsonify(image)
         
-        return jsonify({'error': f'文本补全失败: {str(e)}'}), 500
+    except ImageError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"上传图片错误: {e}")
+        metrics.record_error(e)
+        return jsonify({'error': f'上传图片失败: {str(e)}'}), 500
+
+@app.route('/api/images/<image_id>')
+def api_get_image(image_id):
+    """读取已上传的图片（图片ID为内容哈希，内容不会变化，可长期缓存）"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    path = image_store.path(image_id)
+    if not path:
+        return jsonify({'error': '图片不存在'}), 404
+    response = send_file(path, max_age=31536000)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 @app.route('/api/clear_history', methods=['POST'])
 def api_clear_history():
@@ -396,11 +1008,12 @@ def api_clear_history():
             
     except Exception as e:
         logger.error(f"清除历史错误: {e}")
+        metrics.record_error(e)
         return jsonify({'error': f'清除历史失败: {str(e)}'}), 500
 
 @app.route('/api/conversations')
 def api_conversations():
-    """获取用户对话列表"""
+    """获取用户对话列表（按最近更新倒序，用 cursor 参数翻页）"""
     if 'api_key' not in session:
         return jsonify({'error': '未登录'}), 401
     
@@ -408,8 +1021,19 @@ def api_conversations():
     if not user:
         return jsonify({'error': '用户不存在'}), 401
     
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
     try:
-        conversations = get_user_conversations(user.id)
+        cursor = request.args.get('cursor')
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        # 多取一条用于判断是否还有下一页
+        conversations = get_user_conversation_summaries(user.id, limit + 1, before)
+        has_more = len(conversations) > limit
+        conversations = conversations[:limit]
+        
         conv_list = []
         for conv in conversations:
             conv_data = {
@@ -417,22 +1041,80 @@ def api_conversations():
                 'title': conv.title,
                 'created_at': conv.created_at.isoformat(),
                 'updated_at': conv.updated_at.isoformat(),
-                'message_count': len(conv.messages),
-                'is_custom_assistant': bool(conv.system_prompt)  # 是否为自定义助手
+                'message_count': conv.message_count,
+                'last_message_at': conv.last_message_at.isoformat() if conv.last_message_at else None,
+                'last_message_preview': conv.last_message_preview,
+                'is_custom_assistant': bool(conv.system_prompt_head)  # 是否为自定义助手
             }
             
             # 如果是自定义助手，添加system_prompt预览
-            if conv.system_prompt:
-                conv_data['system_prompt_preview'] = conv.system_prompt[:100] + '...' if len(conv.system_prompt) > 100 else conv.system_prompt
+            if conv.system_prompt_head:
+                conv_data['system_prompt_preview'] = conv.system_prompt_head[:100] + '...' if len(conv.system_prompt_head) > 100 else conv.system_prompt_head
             
             conv_list.append(conv_data)
         
-        return jsonify({'conversations': conv_list})
+        next_cursor = None
+        if has_more:
+            last = conversations[-1]
+            next_cursor = encode_cursor(last.updated_at, last.id)
+        
+        return jsonify({'conversations': conv_list, 'next_cursor': next_cursor})
         
     except Exception as e:
         logger.error(f"获取对话列表错误: {e}")
+        metrics.record_error(e)
         return jsonify({'error': f'获取对话失败: {str(e)}'}), 500
 
+@app.route('/api/conversations/<int:conversation_id>/messages')
+def api_conversation_messages(conversation_id):
+    """分页获取对话消息：默认返回最新一页，用 before 参数向前加载更早的消息"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    conversation = Conversation.query.filter_by(id=conversation_id, user_id=user.id).first()
+    if not conversation:
+        return jsonify({'error': '对话不存在'}), 404
+    
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    try:
+        cursor = request.args.get('before')
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        messages = get_conversation_message_page(conversation.id, limit + 1, before)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        
+        next_cursor = None
+        if has_more:
+            oldest = messages[-1]
+            next_cursor = encode_cursor(oldest.created_at, oldest.id)
+        
+        return jsonify({
+            'conversation_id': conversation.id,
+            'messages': [{
+                'id': msg.id,
+                'role': msg.role,
+                'content': msg.content,
+                'tokens_used': msg.tokens_used,
+                'model': msg.model,
+                'image_ids': msg.image_ids or [],
+                'created_at': msg.created_at.isoformat()
+            } for msg in reversed(messages)],  # 页内按时间正序返回，便于直接渲染
+            'next_cursor': next_cursor
+        })
+        
+    except Exception as e:
+        logger.error(f"获取对话消息错误: {e}")
+        metrics.record_error(e)
+        return jsonify({'error': f'获取消息失败: {str(e)}'}), 500
+
 @app.route('/api/create_assistant', methods=['POST'])
 def api_create_assistant():
     """创建自定义对话助手"""
@@ -446,6 +1128,7 @@ def api_create_assistant():
     data = request.get_json()
     user_request = data.get('request', '').strip()
     model = data.get('model', 'gpt-4')
+    metrics.set_model(model)
     
     if not user_request:
         return jsonify({'error': '请描述您需要的助手功能'}), 400
@@ -453,27 +1136,204 @@ def api_create_assistant():
     try:
         # 创建自定义助手
         api_key = session.get('api_key')
-        conversation = create_custom_assistant(user.id, user_request, api_key, model)
+        conversation = create_custom_assistant(
+            user.id, user_request, api_key, model, timeout=app.config['ASSISTANT_UPSTREAM_TIMEOUT']
+        )
         
         if not conversation:
             return jsonify({'error': '创建助手失败，请重试'}), 500
         
         logger.info(f"创建自定义助手 - 用户: {user.api_key_masked}, 需求: {user_request[:50]}...")
         
-        return jsonify({
-            'success': True,
-            'conversation': {
-                'id': conversation.id,
-                'title': conversation.title,
-                'system_prompt': conversation.system_prompt,
-                'created_at': conversation.created_at.isoformat()
-            },
-            'message': f'已创建"{conversation.title}"助手'
-        })
+        return jsonify(assistant_created(conversation))
         
     except Exception as e:
         logger.error(f"创建助手错误: {e}")
+        metrics.record_error(e)
         return jsonify({'error': f'创建助手失败: {str(e)}'}), 500
 
+def assistant_created(conversation):
+    """创建助手成功的响应内容"""
+    return {
+        'success': True,
+        'conversation': {
+            'id': conversation.id,
+            'title': conversation.title,
+            'system_prompt': conversation.system_prompt,
+            'created_at': conversation.created_at.isoformat()
+        },
+        'message': f'已创建"{conversation.title}"助手'
+    }
+
+def serialize_batch_job(job):
+    """批量任务进度信息"""
+    return {
+        'id': job.id,
+        'status': job.status,
+        'model': job.model,
+        'total': job.total_items,
+        'completed': job.completed_items,
+        'failed': job.failed_items,
+        'tokens': job.tokens_used,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+def load_batch_job(job_id, user):
+    """获取当前用户的批量任务；执行进程已退出（心跳超时）的任务由发现它的进程认领并继续执行"""
+    job = get_batch_job(job_id, user.id)
+    if job and not batch_runner.is_running(job.id):
+        mark_stale_batch_job(job, app.config['BATCH_HEARTBEAT_TIMEOUT'])
+        # 多个worker同时发现时只有认领成功的一个继续执行，其余请求读回的是运行中的任务
+        if job.status == 'interrupted' and claim_interrupted_batch_job(job):
+            logger.info(f"批量任务 {job.id} 已中断，在当前进程中继续执行")
+            batch_runner.submit(job, session['api_key'])
+    return job
+
+@app.route('/api/batch/jobs', methods=['GET', 'POST'])
+def api_batch_jobs():
+    """提交批量处理任务 / 获取最近的任务列表"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    if request.method == 'GET':
+        jobs = get_user_batch_jobs(user.id)
+        return jsonify({'jobs': [serialize_batch_job(job) for job in jobs]})
+    
+    data = request.get_json()
+    items = data.get('items')
+    model = data.get('model', 'gpt-3.5-turbo')
+    metrics.set_model(model)
+    max_tokens = data.get('max_tokens', 1000)
+    temperature = data.get('temperature', 0.7)
+    concurrent = data.get('concurrent', 3)
+    
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items必须是非空数组'}), 400
+    
+    if len(items) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"单个任务最多{app.config['BATCH_MAX_ITEMS']}条"}), 400
+    
+    prompts = []
+    for index, item in enumerate(items):
+        prompt = item.get('prompt') if isinstance(item, dict) else None
+        if not isinstance(prompt, str) or not prompt.strip():
+            return jsonify({'error': f'第{index + 1}个项目的prompt字段必须是非空字符串'}), 400
+        prompts.append(prompt)
+    
+    try:
+        concurrent = min(max(int(concurrent), 1), app.config['BATCH_MAX_CONCURRENCY'])
+        job = create_batch_job(user.id, prompts, model, max_tokens, temperature, concurrent)
+        if not job:
+            return jsonify({'error': '创建批量任务失败'}), 500
+        
+        batch_runner.submit(job, session.get('api_key'))
+        logger.info(f"提交批量任务 - 用户: {user.api_key_masked}, 任务: {job.id}, 条目数: {len(prompts)}")
+        
+        return jsonify({'success': True, 'job': serialize_batch_job(job)}), 202
+        
+    except Exception as e:
+        logger.error(f"提交批量任务错误: {e}")
+        metrics.record_error(e)
+        return jsonify({'error': f'提交批量任务失败: {str(e)}'}), 500
+
+@app.route('/api/batch/jobs/<int:job_id>')
+def api_batch_job(job_id):
+    """获取批量任务进度"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    job = load_batch_job(job_id, user)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    return jsonify({'job': serialize_batch_job(job)})
+
+@app.route('/api/batch/jobs/<int:job_id>/results')
+def api_batch_job_results(job_id):
+    """分页获取批量任务结果"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    job = load_batch_job(job_id, user)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 100, type=int), 1), 1000)
+    status = request.args.get('status')
+    
+    items = get_batch_items(job.id, (page - 1) * per_page, per_page, status)
+    
+    return jsonify({
+        'job': serialize_batch_job(job),
+        'page': page,
+        'per_page': per_page,
+        'results': [{
+            'index': item.index,
+            'prompt': item.prompt,
+            'status': item.status,
+            'response': item.response,
+            'error': item.error,
+            'tokens_used': item.tokens_used,
+            'duration_ms': int(item.duration * 1000) if item.duration is not None else None,
+            'attempts': item.attempts
+        } for item in items]
+    })
+
+@app.route('/api/batch/jobs/<int:job_id>/cancel', methods=['POST'])
+def api_batch_job_cancel(job_id):
+    """取消批量任务"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    job = get_batch_job(job_id, user.id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if not cancel_batch_job(job):
+        return jsonify({'error': '取消任务失败'}), 500
+    
+    batch_runner.cancel(job.id)
+    return jsonify({'success': True, 'job': serialize_batch_job(job)})
+
+@app.route('/api/batch/jobs/<int:job_id>/resume', methods=['POST'])
+def api_batch_job_resume(job_id):
+    """恢复因进程重启而中断的批量任务"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+    
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+    
+    # 中断的任务在 load_batch_job 中由认领成功的进程继续执行，重复的恢复请求看到的是运行中的任务
+    job = load_batch_job(job_id, user)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    
+    if job.status != 'running':
+        return jsonify({'error': '只有中断的任务可以恢复'}), 400
+    
+    return jsonify({'success': True, 'job': serialize_batch_job(job)})
+
 if __name__ == '__main__':
+    start_prewarm(app)
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
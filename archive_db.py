@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+对话与补全记录归档工具（归档规则见 archiver.py，可由cron定期执行）
+
+    python archive_db.py run [--dry-run] [--vacuum]        # 归档已清除的旧对话和旧补全记录
+    python archive_db.py list                              # 查看归档文件
+    python archive_db.py restore --month 2026-01 --user-id 3 [--conversation-id 12 ...] [--activate]
+"""
+
+import argparse
+import json
+import sys
+
+from archiver import archiver
+from init_db import create_app
+from models import db
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='对话与补全记录归档')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='执行一次归档')
+    run.add_argument('--dry-run', action='store_true', help='只统计待归档的记录数')
+    run.add_argument('--vacuum', action='store_true', help='归档后回收数据库文件空间')
+
+    commands.add_parser('list', help='列出归档文件和上次归档结果')
+
+    restore = commands.add_parser('restore', help='把归档记录恢复到数据库')
+    restore.add_argument('--month', help='只恢复该月份（YYYY-MM）的归档')
+    restore.add_argument('--user-id', type=int, help='只恢复该用户的记录')
+    restore.add_argument('--conversation-id', type=int, action='append', help='只恢复指定对话（可重复），不恢复补全记录')
+    restore.add_argument('--no-completions', action='store_true', help='不恢复补全记录')
+    restore.add_argument('--activate', action='store_true', help='恢复为活跃对话（默认保持已清除状态）')
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    app = create_app()
+    archiver.init_app(app)
+
+    with app.app_context():
+        if options.command == 'run':
+            if options.dry_run:
+                print(json.dumps(archiver.pending(), ensure_ascii=False))
+                return True
+            result = archiver.run()
+            if result is None:
+                print("已有归档或恢复任务在执行")
+                return False
+            print(json.dumps(result, ensure_ascii=False))
+            if options.vacuum:
+                archiver.vacuum()
+                print("数据库空间已回收")
+
+        elif options.command == 'list':
+            for partition in archiver.partitions():
+                print(f"{partition['kind']:<14}{partition['month']:<10}{partition['bytes'] / 1024:>10.1f}KB")
+            print(f"上次归档: {json.dumps(archiver.last_result(), ensure_ascii=False)}")
+
+        elif options.command == 'restore':
+            result = archiver.restore(
+                month=options.month,
+                user_id=options.user_id,
+                conversation_ids=options.conversation_id,
+                completions=not options.no_completions,
+                activate=options.activate
+            )
+            if result is None:
+                print("已有归档或恢复任务在执行")
+                return False
+            print(json.dumps(result, ensure_ascii=False))
+
+        db.session.remove()
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,470 @@
+"""
+对话与补全记录归档
+
+清除对话只把对话标记为非活跃，消息一直留在 messages 表中，热点查询要跳过越来越多的无用行。
+归档把清除超过 ARCHIVE_INACTIVE_DAYS 天的对话（连同消息）和超过 ARCHIVE_COMPLETION_DAYS 天的补全记录
+按创建月份追加到gzip压缩的JSONL文件（<归档目录>/conversations/2026-01.jsonl.gz），
+文件落盘后再从数据库删除。每批一个短事务，批次之间稍作停顿，不长时间占用SQLite写锁。
+
+自动归档在处理请求的进程中按间隔后台执行，system_configs 中记录上次开始时间，
+通过条件更新保证每个间隔只有一个worker执行；也可以用 archive_db.py 手动执行、查看和恢复。
+"""
+
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, exists, insert, text, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Conversation, Message, Completion, SystemConfig
+
+try:
+    import fcntl
+except ImportError:  # 非POSIX系统上只用进程内的锁
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+LAST_RUN_KEY = 'archive_last_run'
+LAST_RESULT_KEY = 'archive_last_result'
+KINDS = ('conversations', 'completions')
+
+
+def to_record(row):
+    """ORM对象转为可写入JSON的字典（时间转为ISO格式）"""
+    record = {}
+    for column in row.__table__.columns:
+        value = getattr(row, column.key)
+        record[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+def from_record(model, record):
+    """归档记录转回可插入的列值"""
+    values = {}
+    for column in model.__table__.columns:
+        if column.key not in record:
+            continue
+        value = record[column.key]
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        values[column.key] = value
+    return values
+
+
+def partition_name(timestamp):
+    return timestamp.strftime('%Y-%m')
+
+
+def read_records(path):
+    """读取归档文件；写入中断留下的不完整结尾会被忽略"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                if line.strip():
+                    yield json.loads(line)
+    except (EOFError, ValueError, zlib.error, gzip.BadGzipFile) as e:
+        logger.warning(f"归档文件 {path} 结尾不完整，已忽略: {e}")
+
+
+def unique_records(path):
+    """按ID合并重复记录，对话字段取最后一条，消息列表按消息ID合并
+
+    同一ID会重复出现：写入文件后删除失败的批次会在下次归档时重复写入；归档期间收到新消息的对话
+    只删除已归档的消息并保留对话，下次归档时以同一ID写入剩余的消息。
+    """
+    records = {}
+    for record in read_records(path):
+        previous = records.get(record['id'])
+        if previous is not None and 'messages' in record:
+            messages = {message['id']: message for message in previous.get('messages', [])}
+            messages.update((message['id'], message) for message in record['messages'])
+            record['messages'] = sorted(messages.values(), key=lambda message: message['id'])
+        records[record['id']] = record
+    return list(records.values())
+
+
+class Archiver:
+    """归档执行器，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.directory = None
+        self._running = threading.Lock()
+        self._next_check = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config['ARCHIVE_DIR'] or os.path.join(app.instance_path, 'archive')
+        self.interval = app.config['ARCHIVE_INTERVAL']
+        self.inactive_days = app.config['ARCHIVE_INACTIVE_DAYS']
+        self.completion_days = app.config['ARCHIVE_COMPLETION_DAYS']
+        self.batch_size = app.config['ARCHIVE_BATCH_SIZE']
+        self.batch_pause = app.config['ARCHIVE_BATCH_PAUSE']
+        if self.interval > 0:
+            app.after_request(self._after_request)
+        app.extensions['archiver'] = self
+
+    def _after_request(self, response):
+        # 每个进程最多每10分钟检查一次是否到期，不在主进程中启动线程（gunicorn预加载后才fork）
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + min(self.interval, 600)
+            self.start()
+        return response
+
+    def start(self, force=False):
+        """在后台线程中归档；force 为False时只在距上次归档超过间隔、且抢到本次执行权时执行"""
+        threading.Thread(target=self._run_in_background, args=(force,), name='archiver', daemon=True).start()
+
+    def _run_in_background(self, force):
+        with self.app.app_context():
+            try:
+                if force or self._claim_run():
+                    self.run()
+            except Exception as e:
+                logger.error(f"归档失败: {e}")
+            finally:
+                db.session.remove()
+
+    def _claim_run(self):
+        """距上次归档超过间隔时，用条件更新抢占本次执行权（多个worker同时检查时只有一个成功）"""
+        now = datetime.utcnow()
+        previous = db.session.query(SystemConfig.value).filter_by(key=LAST_RUN_KEY).scalar()
+        if previous is not None and now - datetime.fromisoformat(previous) < timedelta(seconds=self.interval):
+            db.session.rollback()
+            return False
+        try:
+            if previous is None:
+                db.session.add(SystemConfig(key=LAST_RUN_KEY, value=now.isoformat(), description='上次归档开始时间'))
+                db.session.commit()
+                return True
+            claimed = db.session.execute(
+                update(SystemConfig)
+                .where(SystemConfig.key == LAST_RUN_KEY, SystemConfig.value == previous)
+                .values(value=now.isoformat())
+            ).rowcount == 1
+            db.session.commit()
+            return claimed
+        except IntegrityError:
+            db.session.rollback()
+            return False
+
+    @contextmanager
+    def _exclusive(self):
+        """同一时间只允许一个归档或恢复操作（进程内用线程锁，进程之间用文件锁）"""
+        if not self._running.acquire(blocking=False):
+            yield False
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        yield False
+                        return
+                yield True
+        finally:
+            self._running.release()
+
+    def cutoffs(self, now=None):
+        """(对话截止时间, 补全截止时间)，早于截止时间的记录会被归档；补全不归档时为None"""
+        now = now or datetime.utcnow()
+        completion_cutoff = now - timedelta(days=self.completion_days) if self.completion_days > 0 else None
+        return now - timedelta(days=self.inactive_days), completion_cutoff
+
+    def pending(self, now=None):
+        """待归档的对话、消息和补全记录数"""
+        conversation_cutoff, completion_cutoff = self.cutoffs(now)
+        conversation_ids = db.session.query(Conversation.id).filter(
+            Conversation.is_active == False,
+            Conversation.updated_at < conversation_cutoff
+        )
+        counts = {
+            'conversations': conversation_ids.count(),
+            'messages': Message.query.filter(Message.conversation_id.in_(conversation_ids.scalar_subquery())).count(),
+            'completions': 0
+        }
+        if completion_cutoff is not None:
+            counts['completions'] = Completion.query.filter(Completion.created_at < completion_cutoff).count()
+        return counts
+
+    def run(self, now=None):
+        """执行一次归档，返回各类记录的归档数量；已有归档在执行时返回None"""
+        with self._exclusive() as acquired:
+            if not acquired:
+                logger.info("已有归档任务在执行，跳过")
+                return None
+
+            started = time.time()
+            conversation_cutoff, completion_cutoff = self.cutoffs(now)
+            result = {'conversations': 0, 'messages': 0, 'completions': 0, 'partitions': set()}
+            self._archive_conversations(conversation_cutoff, result)
+            if completion_cutoff is not None:
+                self._archive_completions(completion_cutoff, result)
+
+            result['partitions'] = sorted(result['partitions'])
+            result['finished_at'] = datetime.utcnow().isoformat()
+            result['duration'] = round(time.time() - started, 2)
+            self._save_result(result)
+            logger.info(
+                f"归档完成: 对话 {result['conversations']} 个，消息 {result['messages']} 条，"
+                f"补全 {result['completions']} 条，耗时 {result['duration']}s"
+            )
+            return result
+
+    def _archive_conversations(self, cutoff, result):
+        last_id = 0
+        while True:
+            conversations = Conversation.query.filter(
+                Conversation.is_active == False,
+                Conversation.updated_at < cutoff,
+                Conversation.id > last_id
+            ).order_by(Conversation.id).limit(self.batch_size).with_for_update().all()
+            if not conversations:
+                db.session.rollback()
+                return
+            ids = [conversation.id for conversation in conversations]
+            last_id = ids[-1]
+
+            messages = Message.query.filter(Message.conversation_id.in_(ids)).order_by(
+                Message.conversation_id, Message.created_at, Message.id
+            ).all()
+            grouped = {}
+            for message in messages:
+                grouped.setdefault(message.conversation_id, []).append(to_record(message))
+
+            partitions = {}
+            for conversation in conversations:
+                record = to_record(conversation)
+                record['messages'] = grouped.get(conversation.id, [])
+                partitions.setdefault(partition_name(conversation.created_at or cutoff), []).append(record)
+            self._append('conversations', partitions)
+
+            try:
+                # 只删除已写入归档的消息；归档期间对话又有新消息时保留该对话
+                max_message_id = max((message.id for message in messages), default=0)
+                db.session.execute(
+                    delete(Message).where(Message.conversation_id.in_(ids), Message.id <= max_message_id),
+                    execution_options={'synchronize_session': False}
+                )
+                db.session.execute(
+                    delete(Conversation).where(
+                        Conversation.id.in_(ids),
+                        ~exists().where(Message.conversation_id == Conversation.id)
+                    ),
+                    execution_options={'synchronize_session': False}
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            result['conversations'] += len(conversations)
+            result['messages'] += len(messages)
+            result['partitions'].update(f'conversations/{name}' for name in partitions)
+            time.sleep(self.batch_pause)
+
+    def _archive_completions(self, cutoff, result):
+        last_id = 0
+        while True:
+            completions = Completion.query.filter(
+                Completion.created_at < cutoff,
+                Completion.id > last_id
+            ).order_by(Completion.id).limit(self.batch_size).all()
+            if not completions:
+                db.session.rollback()
+                return
+            ids = [completion.id for completion in completions]
+            last_id = ids[-1]
+
+            partitions = {}
+            for completion in completions:
+                partitions.setdefault(partition_name(completion.created_at), []).append(to_record(completion))
+            self._append('completions', partitions)
+
+            try:
+                db.session.execute(delete(Completion).where(Completion.id.in_(ids)),
+                                   execution_options={'synchronize_session': False})
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            result['completions'] += len(completions)
+            result['partitions'].update(f'completions/{name}' for name in partitions)
+            time.sleep(self.batch_pause)
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, f'{name}.jsonl.gz')
+
+    def _append(self, kind, partitions):
+        """每批追加为一个独立的gzip成员，fsync后才删除数据库中的记录"""
+        os.makedirs(os.path.join(self.directory, kind), exist_ok=True)
+        for name, records in partitions.items():
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            with open(self._path(kind, name), 'ab') as archive_file:
+                archive_file.write(gzip.compress(data.encode('utf-8')))
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+
+    def _rewrite(self, kind, name, records):
+        """用剩余记录替换归档文件（先写临时文件再原子替换），没有剩余记录时删除文件"""
+        path = self._path(kind, name)
+        if not records:
+            os.remove(path)
+            return
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw_file, gzip.GzipFile(fileobj=raw_file, mode='wb') as archive_file:
+                for record in records:
+                    archive_file.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def _save_result(self, result):
+        value = json.dumps(result, ensure_ascii=False)
+        config = SystemConfig.query.filter_by(key=LAST_RESULT_KEY).first()
+        if config is None:
+            db.session.add(SystemConfig(key=LAST_RESULT_KEY, value=value, description='上次归档结果'))
+        else:
+            config.value = value
+        db.session.commit()
+
+    def last_result(self):
+        value = db.session.query(SystemConfig.value).filter_by(key=LAST_RESULT_KEY).scalar()
+        return json.loads(value) if value else None
+
+    def partitions(self, month=None):
+        """归档文件列表：[{'kind', 'month', 'bytes'}]，按类型和月份排序"""
+        entries = []
+        for kind in KINDS:
+            directory = os.path.join(self.directory, kind)
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if not filename.endswith('.jsonl.gz'):
+                    continue
+                name = filename[:-len('.jsonl.gz')]
+                if month is None or name == month:
+                    entries.append({'kind': kind, 'month': name,
+                                    'bytes': os.path.getsize(os.path.join(directory, filename))})
+        return entries
+
+    def restore(self, month=None, user_id=None, conversation_ids=None, completions=True, activate=False):
+        """把归档记录恢复到数据库，并从归档文件中移除
+
+        可按月份、用户或对话ID筛选；指定对话ID时不恢复补全记录。数据库中已存在的ID会跳过，
+        其中仍在数据库中的对话（部分消息归档后又收到新消息）保留在归档文件中，待整个对话归档后再恢复。
+        恢复的对话更新时间设为当前时间，避免下次归档时立即被再次归档；activate 为True时同时恢复为活跃对话。
+        """
+        with self._exclusive() as acquired:
+            if not acquired:
+                return None
+
+            conversation_ids = set(conversation_ids) if conversation_ids else None
+            result = {'conversations': 0, 'messages': 0, 'completions': 0, 'skipped': 0}
+            for partition in self.partitions(month):
+                kind, name = partition['kind'], partition['month']
+                if kind == 'completions' and (not completions or conversation_ids):
+                    continue
+
+                def selected(record):
+                    if user_id is not None and record['user_id'] != user_id:
+                        return False
+                    return kind == 'completions' or conversation_ids is None or record['id'] in conversation_ids
+
+                records = unique_records(self._path(kind, name))
+                chosen = [record for record in records if selected(record)]
+                if not chosen:
+                    continue
+                kept = set()
+                if kind == 'conversations':
+                    kept = self._restore_conversations(chosen, activate, result)
+                else:
+                    self._restore_completions(chosen, result)
+                self._rewrite(kind, name, [record for record in records
+                                           if not selected(record) or record['id'] in kept])
+            return result
+
+    def _restore_conversations(self, records, activate, result):
+        """恢复对话及其消息，返回因对话仍在数据库中而跳过的对话ID"""
+        now = datetime.utcnow()
+        skipped = set()
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            existing = self._existing_ids(Conversation, [record['id'] for record in batch])
+            conversations, messages = [], []
+            for record in batch:
+                if record['id'] in existing:
+                    result['skipped'] += 1
+                    skipped.add(record['id'])
+                    continue
+                values = from_record(Conversation, record)
+                values['updated_at'] = now
+                if activate:
+                    values['is_active'] = True
+                conversations.append(values)
+                messages.extend(from_record(Message, message) for message in record.get('messages', []))
+            existing_messages = self._existing_ids(Message, [message['id'] for message in messages])
+            messages = [message for message in messages if message['id'] not in existing_messages]
+
+            try:
+                if conversations:
+                    db.session.execute(insert(Conversation), conversations)
+                if messages:
+                    db.session.execute(insert(Message), messages)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            result['conversations'] += len(conversations)
+            result['messages'] += len(messages)
+        return skipped
+
+    def _restore_completions(self, records, result):
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            existing = self._existing_ids(Completion, [record['id'] for record in batch])
+            rows = [from_record(Completion, record) for record in batch if record['id'] not in existing]
+            result['skipped'] += len(batch) - len(rows)
+            try:
+                if rows:
+                    db.session.execute(insert(Completion), rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            result['completions'] += len(rows)
+
+    def _existing_ids(self, model, ids):
+        existing = set()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            existing.update(row_id for (row_id,) in db.session.query(model.id).filter(model.id.in_(chunk)))
+        return existing
+
+    def vacuum(self):
+        """归档后回收数据库文件空间（SQLite的VACUUM会重写整个文件，应在低峰期执行）"""
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            if db.engine.dialect.name == 'sqlite':
+                connection.execute(text('VACUUM'))
+            elif db.engine.dialect.name == 'postgresql':
+                connection.execute(text('VACUUM (ANALYZE) messages, conversations, completions'))
+
+
+archiver = Archiver()
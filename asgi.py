@@ -0,0 +1,491 @@
+"""
+异步服务模式（ASGI）
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+
+Flask应用由 asgiref 的 WsgiToAsgi 适配为ASGI应用，请求分发、before/after_request、错误处理和
+teardown 都由Flask照常执行。聊天、补全和创建助手三个接口换成 async def 视图（flask[async]），
+协程在事件循环中用 AsyncOpenAI 调用上游（包括限流排队、重试退避和对冲），上游连接在事件循环上复用；
+视图中的数据库读写通过 sync_to_async 回到该请求自己的线程执行，不阻塞事件循环。
+每个进行中的请求占用线程池（ASYNC_THREADS）中的一个线程，等待上游时线程空闲、不占用数据库连接。
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import jsonify, request, session
+
+from app import (
+    app, get_current_user, sse_response, stream_upstream, upstream_error_response, response_tokens,
+    prepare_chat, chat_params, save_chat_turn, chat_succeeded, finish_chat_stream,
+    prepare_completion, cached_completion_response, completion_params, save_completion_result,
+    finish_completion_stream, assistant_created, start_prewarm
+)
+from database import assistant_generation_prompts, save_custom_assistant, ASSISTANT_TITLE_QUOTES
+from models import db
+from openai_clients import client_pool
+from rate_limiter import rate_limiter
+from hedging import hedger
+from single_flight import single_flight
+from metrics import metrics
+from request_timing import request_timing
+from response_cache import assistant_prompt_cache, assistant_cache_key
+
+logger = logging.getLogger(__name__)
+
+
+def run_sync(fn):
+    """在当前请求的线程中执行同步函数（数据库读写），不阻塞事件循环
+
+    结束后关闭会话、归还数据库连接，等待上游期间不占用连接池（否则进行中的请求数受限于连接池大小）。
+    已加载的ORM对象仍可读取已加载的属性，提交后过期的对象需在同一阶段内读取。
+    """
+    def call(*args):
+        try:
+            return fn(*args)
+        finally:
+            db.session.close()
+
+    return sync_to_async(call)
+
+
+class AsyncStream:
+    """把异步上游流包装为同步迭代器，供 app.stream_upstream 在请求线程中逐块转发（读取在事件循环中执行）"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return async_to_sync(self._next)()
+        except StopAsyncIteration:
+            raise StopIteration
+
+    async def _next(self):
+        return await self.chunks.__anext__()
+
+    async def _close(self):
+        await self.chunks.aclose()
+
+    def close(self):
+        async_to_sync(self._close)()
+
+
+async def call_upstream_async(api_key, model, estimated_tokens, create, timeout=None, hedge_route=None,
+                              discard=None):
+    """app.call_upstream_limited 的异步版本，create 返回协程"""
+    ticket = await rate_limiter.acquire_async(api_key, model, estimated_tokens)
+    deadline = time.monotonic() + timeout if timeout else None
+    call = lambda: rate_limiter.call_async(create, deadline)
+
+    def reserve_hedge():
+        hedge_ticket, _ = rate_limiter.reserve(api_key, model, estimated_tokens, max_wait=0)
+        return lambda loser: rate_limiter.settle(hedge_ticket, response_tokens(loser))
+
+    try:
+        with metrics.upstream(model), request_timing.span('upstream'):
+            if hedge_route:
+                return ticket, await hedger.call_async(hedge_route, model, call, discard, reserve_hedge)
+            return ticket, await call()
+    except BaseException:  # 包括取消
+        rate_limiter.settle(ticket, 0)
+        raise
+
+
+async def open_stream_async(create):
+    """打开上游流并读取首个分块，对冲请求以首个分块到达的时间为准"""
+    stream = await create()
+    try:
+        return stream, await stream.__anext__()
+    except StopAsyncIteration:
+        return stream, None
+
+
+async def close_stream_async(opened):
+    stream, _ = opened
+    await stream.close()
+
+
+async def resume_stream_async(opened):
+    """从已读取的首个分块继续转发，结束或断开时关闭上游流"""
+    stream, first = opened
+    try:
+        if first is not None:
+            yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await close_stream_async(opened)
+
+
+async def generate_assistant_async(user_request, api_key, model, timeout=None):
+    """database.generate_assistant 的异步版本，标题和system prompt同时生成"""
+    client = client_pool.get_async(api_key)
+    if timeout:
+        client = client.with_options(timeout=timeout)
+    system_generation_prompt, title_generation_prompt = assistant_generation_prompts(user_request)
+
+    async def generate(prompt, max_tokens):
+        return await rate_limiter.call_async(lambda: client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.7
+        ))
+
+    # 提示词约200 token，两次调用一起预扣额度，结束后按实际用量修正（失败或取消时全部退回）
+    ticket = await rate_limiter.acquire_async(api_key, model, 900)
+    try:
+        with metrics.upstream(model):
+            system_response, title_response = await asyncio.gather(
+                generate(system_generation_prompt, 500),
+                generate(title_generation_prompt, 50)
+            )
+    except BaseException:
+        rate_limiter.settle(ticket, 0)
+        raise
+    rate_limiter.settle(ticket, system_response.usage.total_tokens + title_response.usage.total_tokens)
+    title = title_response.choices[0].message.content.strip()
+    return title.strip(ASSISTANT_TITLE_QUOTES), system_response.choices[0].message.content.strip()
+
+
+class Deferred(partial):
+    """异步视图返回后在请求线程中创建的响应
+
+    流式响应的 stream_with_context 要在请求线程的上下文中启动，不能在事件循环中执行的协程里创建。
+    """
+
+
+def async_view(view):
+    """在请求线程中等待异步视图完成，返回 Deferred 时在请求线程中创建响应"""
+    @wraps(view)
+    def dispatch(**kwargs):
+        response = app.ensure_sync(view)(**kwargs)
+        if isinstance(response, Deferred):
+            return response()
+        return response
+
+    return dispatch
+
+
+def async_client(api_key, timeout):
+    return client_pool.get_async(api_key).with_options(timeout=timeout)
+
+
+async def api_chat():
+    """聊天API，对应 app.api_chat"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+
+    user = await run_sync(get_current_user)()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+
+    data = await run_sync(request.get_json)()
+    model = data.get('model', 'gpt-3.5-turbo')
+    metrics.set_model(model)
+
+    if not data.get('message', '').strip():
+        return jsonify({'error': '消息不能为空'}), 400
+
+    user_id, api_key = user.id, session['api_key']
+    timeout = app.config['CHAT_UPSTREAM_TIMEOUT']
+    try:
+        turn, error = await run_sync(prepare_chat)(user, data)
+        if error:
+            return error
+
+        client = async_client(api_key, timeout)
+
+        if turn['stream']:
+            ticket, opened = await call_upstream_async(
+                api_key,
+                model,
+                turn['estimated_tokens'],
+                lambda: open_stream_async(lambda: client.chat.completions.create(**chat_params(turn, stream=True))),
+                timeout=timeout,
+                hedge_route='chat_stream',
+                discard=close_stream_async
+            )
+            return Deferred(sse_response, stream_upstream(
+                AsyncStream(resume_stream_async(opened)),
+                lambda choice: choice.delta.content,
+                lambda text, usage, status: finish_chat_stream(turn, ticket, text, usage, status)
+            ))
+
+        async def call_upstream():
+            ticket, response = await call_upstream_async(
+                api_key,
+                model,
+                turn['estimated_tokens'],
+                lambda: client.chat.completions.create(**chat_params(turn)),
+                timeout=timeout,
+                hedge_route='chat'
+            )
+            return await run_sync(save_chat_turn)(turn, ticket, response)
+
+        # 相同的进行中请求（通常是重试）共享同一次上游调用，这一轮对话只保存一次
+        result, shared = await single_flight.do_async(turn['flight_key'], call_upstream)
+        return jsonify(await run_sync(chat_succeeded)(turn, result, shared))
+
+    except Exception as e:
+        return await run_sync(upstream_error_response)('chat', user_id, model, e)
+
+
+async def api_completion():
+    """文本补全API，对应 app.api_completion"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+
+    user = await run_sync(get_current_user)()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+
+    data = await run_sync(request.get_json)()
+    model = data.get('model', 'gpt-3.5-turbo-instruct')
+    metrics.set_model(model)
+
+    if not data.get('prompt', '').strip():
+        return jsonify({'error': '提示文本不能为空'}), 400
+
+    user_id, api_key = user.id, session['api_key']
+    timeout = app.config['COMPLETION_UPSTREAM_TIMEOUT']
+    try:
+        turn = await run_sync(prepare_completion)(user, data)
+        if turn['cached'] is not None:
+            return Deferred(cached_completion_response, turn)
+
+        client = async_client(api_key, timeout)
+
+        if turn['stream']:
+            ticket, stream = await call_upstream_async(
+                api_key,
+                model,
+                turn['estimated_tokens'],
+                lambda: client.completions.create(**completion_params(turn, stream=True)),
+                timeout=timeout
+            )
+            return Deferred(sse_response, stream_upstream(
+                AsyncStream(resume_stream_async((stream, None))),
+                lambda choice: choice.text,
+                lambda text, usage, status: finish_completion_stream(turn, ticket, text, usage, status)
+            ))
+
+        # 相同的进行中请求共享同一次上游调用，各自保存补全记录，只有实际调用上游的请求计入token
+        async def call_upstream():
+            ticket, response = await call_upstream_async(
+                api_key,
+                model,
+                turn['estimated_tokens'],
+                lambda: client.completions.create(**completion_params(turn)),
+                timeout=timeout
+            )
+            rate_limiter.settle(ticket, response.usage.total_tokens)
+            return response
+
+        response, shared = await single_flight.do_async(turn['flight_key'], call_upstream)
+        return jsonify(await run_sync(save_completion_result)(turn, response, shared))
+
+    except Exception as e:
+        return await run_sync(upstream_error_response)('completion', user_id, model, e)
+
+
+async def api_create_assistant():
+    """创建自定义对话助手，对应 app.api_create_assistant"""
+    if 'api_key' not in session:
+        return jsonify({'error': '未登录'}), 401
+
+    user = await run_sync(get_current_user)()
+    if not user:
+        return jsonify({'error': '用户不存在'}), 401
+
+    data = await run_sync(request.get_json)()
+    user_request = data.get('request', '').strip()
+    model = data.get('model', 'gpt-4')
+    metrics.set_model(model)
+
+    if not user_request:
+        return jsonify({'error': '请描述您需要的助手功能'}), 400
+
+    user_id, user_masked, api_key = user.id, user.api_key_masked, session['api_key']
+    try:
+        # 相同需求优先使用缓存的生成结果
+        key = assistant_cache_key(user_request, model)
+        cached = await run_sync(assistant_prompt_cache.get)(key)
+        if cached is not None:
+            title, system_prompt = cached['title'], cached['system_prompt']
+        else:
+            title, system_prompt = await generate_assistant_async(
+                user_request, api_key, model, timeout=app.config['ASSISTANT_UPSTREAM_TIMEOUT']
+            )
+            await run_sync(assistant_prompt_cache.set)(key, {'title': title, 'system_prompt': system_prompt})
+
+        result = await run_sync(lambda: assistant_created(save_custom_assistant(user_id, title, system_prompt)))()
+        logger.info(f"创建自定义助手 - 用户: {user_masked}, 需求: {user_request[:50]}...")
+        return jsonify(result)
+
+    except Exception as e:
+        logger.error(f"创建助手错误: {e}")
+        metrics.record_error(e)
+        return jsonify({'error': f'创建助手失败: {str(e)}'}), 500
+
+
+# asgiref 中被 sync_to_async 包装的原始同步实现：构造environ、调用应用并转发响应
+_run_wsgi_app = vars(WsgiToAsgiInstance)['run_wsgi_app'].func
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class _RequestInstance(WsgiToAsgiInstance):
+    """在线程池中执行一个请求
+
+    asgiref 默认以 thread_sensitive 方式运行WSGI应用，所有请求在同一个线程中串行处理；
+    这里改为每个请求占用线程池中的一个线程（该线程被 asgiref 记录为事件循环的同步线程，
+    异步视图的协程在事件循环中执行）。请求体超过 max_length 时不再读取，由Flask返回413；
+    客户端断开后停止发送，结束或断开时关闭响应（WSGI要求，流式响应据此保存 aborted 状态）。
+    """
+
+    def __init__(self, wsgi_application, executor, max_length):
+        super().__init__(wsgi_application)
+        self.executor = executor
+        self.max_length = max_length
+        self.disconnected = False
+
+    async def __call__(self, scope, receive, send):
+        self.client_receive = receive
+        if content_length(scope) > self.max_length:
+            # 超出上限的请求体不读取，Flask按 Content-Length 返回413
+            body = _empty_body
+        else:
+            body = _limited_body(receive, self.max_length)
+
+        async def send_connected(message):
+            if self.disconnected:
+                raise ClientDisconnected()
+            await send(message)
+
+        try:
+            await super().__call__(scope, body, send_connected)
+        except ClientDisconnected:
+            pass
+
+    def build_environ(self, scope, body):
+        environ = super().build_environ(scope, body)
+        if 'CONTENT_LENGTH' not in environ:
+            # 分块上传的请求体已完整读入（超出上限时多读1字节），补上长度，由Flask按 MAX_CONTENT_LENGTH 检查
+            environ.pop('HTTP_TRANSFER_ENCODING', None)
+            body.seek(0, 2)
+            environ['CONTENT_LENGTH'] = str(body.tell())
+            body.seek(0)
+        return environ
+
+    async def run_wsgi_app(self, body):
+        watcher = asyncio.ensure_future(self.wait_for_disconnect())
+        try:
+            await sync_to_async(self._run, thread_sensitive=False, executor=self.executor)(body)
+        finally:
+            watcher.cancel()
+
+    async def wait_for_disconnect(self):
+        while (await self.client_receive())['type'] != 'http.disconnect':
+            pass
+        self.disconnected = True
+
+    def _run(self, body):
+        responses = []
+        application = self.wsgi_application
+
+        def wsgi_application(environ, start_response):
+            response = application(environ, start_response)
+            responses.append(response)
+            return response
+
+        self.wsgi_application = wsgi_application
+        try:
+            _run_wsgi_app(self, body)
+        finally:
+            for response in responses:
+                if hasattr(response, 'close'):
+                    response.close()
+
+
+def content_length(scope):
+    for name, value in scope.get('headers', []):
+        if name == b'content-length' and value.isdigit():
+            return int(value)
+    return 0
+
+
+async def _empty_body():
+    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+
+def _limited_body(receive, limit):
+    """最多读取 limit+1 字节的请求体，超出部分不再读取（Flask读到超出上限的请求体时返回413）"""
+    received = 0
+
+    async def receive_limited():
+        nonlocal received
+        if received > limit:
+            return await _empty_body()
+        message = await receive()
+        body = message.get('body', b'')
+        allowed = limit + 1 - received
+        received += len(body)
+        if received > limit:
+            message = {**message, 'body': body[:allowed], 'more_body': False}
+        return message
+
+    return receive_limited
+
+
+class AsyncApplication(WsgiToAsgi):
+    """ASGI入口：lifespan启动时预热上游连接、关闭时释放异步客户端，请求交给Flask处理"""
+
+    def __init__(self, flask_app):
+        super().__init__(flask_app)
+        self.app = flask_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_THREADS'],
+            thread_name_prefix='asgi'
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        instance = _RequestInstance(self.wsgi_application, self.executor, self.app.config['MAX_CONTENT_LENGTH'])
+        await instance(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start_prewarm(self.app)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await client_pool.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+# 聊天、补全和创建助手使用异步视图，路由、before/after_request 和错误处理与同步视图相同
+app.view_functions['api_chat'] = async_view(api_chat)
+app.view_functions['api_completion'] = async_view(api_completion)
+app.view_functions['api_create_assistant'] = async_view(api_create_assistant)
+
+application = AsyncApplication(app)
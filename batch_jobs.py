@@ -0,0 +1,275 @@
+"""
+服务端JSON批量处理任务执行器
+
+任务提交后由应用进程内的线程池执行，条目状态与结果持久化在
+batch_jobs / batch_items 表中，浏览器只需轮询进度并分页拉取结果。
+并发度按AIMD方式自适应：连续成功时逐步加一，遇到限流或上游故障时减半；
+每个条目还要经过 rate_limiter 的令牌桶，与交互式请求共享同一份额度。
+需要重试的条目放入延迟队列，到期后由调度线程重新派发，退避期间不占用执行线程。
+执行线程不访问数据库，结果由调度线程攒批后一次性写入。
+"""
+
+import heapq
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from models import db, BatchJob, BatchItem
+from database import save_batch_results
+from openai_clients import client_pool
+from rate_limiter import rate_limiter, is_retryable_error, retry_after
+from context_builder import count_tokens
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit:
+    """AIMD并发控制：成功一轮后上限加一，被限流时上限减半"""
+
+    def __init__(self, maximum, initial=2):
+        self.maximum = max(1, maximum)
+        self.limit = min(max(1, initial), self.maximum)
+        self._streak = 0
+        self._lock = threading.Lock()
+
+    def on_success(self):
+        with self._lock:
+            self._streak += 1
+            if self._streak >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._streak = 0
+
+    def on_throttle(self):
+        with self._lock:
+            self.limit = max(1, self.limit // 2)
+            self._streak = 0
+
+
+class _JobControl:
+    """单个运行中任务的进程内控制状态"""
+
+    def __init__(self, job_id, max_concurrency, api_key):
+        self.job_id = job_id
+        self.api_key = api_key
+        self.limiter = AdaptiveLimit(max_concurrency)
+        self.cancelled = threading.Event()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.pending = deque()  # (item_id, prompt, attempts)
+        self.delayed = []  # 等待退避结束的条目，按 (到期时间, 条目) 组成的小顶堆
+        self.results = []  # 待写入数据库的条目结果
+
+    def promote_delayed(self, now):
+        """把退避已到期的条目移回待处理队列，返回下一个条目到期前的秒数（没有时为None）"""
+        while self.delayed and self.delayed[0][0] <= now:
+            self.pending.append(heapq.heappop(self.delayed)[1])
+        return self.delayed[0][0] - now if self.delayed else None
+
+
+class BatchJobRunner:
+    """进程内批量任务执行器，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config['BATCH_MAX_WORKERS']
+        self.max_attempts = app.config['BATCH_MAX_ATTEMPTS']
+        self.flush_size = app.config['BATCH_FLUSH_SIZE']
+        self.flush_interval = app.config['BATCH_FLUSH_INTERVAL']
+        app.extensions['batch_runner'] = self
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='batch-item'
+                )
+            return self._executor
+
+    def is_running(self, job_id):
+        with self._lock:
+            return job_id in self._jobs
+
+    def submit(self, job, api_key):
+        """开始（或恢复）执行任务，返回False表示该任务已在本进程执行中"""
+        with self._lock:
+            if job.id in self._jobs:
+                return False
+            control = _JobControl(job.id, job.max_concurrency or 1, api_key)
+            self._jobs[job.id] = control
+
+        thread = threading.Thread(
+            target=self._run_job,
+            args=(control, api_key),
+            name=f'batch-job-{job.id}',
+            daemon=True
+        )
+        thread.start()
+        return True
+
+    def cancel(self, job_id):
+        with self._lock:
+            control = self._jobs.get(job_id)
+        if control:
+            control.cancelled.set()
+            with control.condition:
+                control.condition.notify_all()
+
+    def _run_job(self, control, api_key):
+        """任务调度线程：按自适应并发上限把待处理条目派发到线程池"""
+        with self.app.app_context():
+            try:
+                self._dispatch(control, api_key)
+            except Exception as e:
+                logger.error(f"批量任务 {control.job_id} 调度失败: {e}")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+                with self._lock:
+                    self._jobs.pop(control.job_id, None)
+
+    def _dispatch(self, control, api_key):
+        job = db.session.get(BatchJob, control.job_id)
+        if job is None or job.finished:
+            return
+
+        job.status = 'running'
+        job.started_at = job.started_at or datetime.utcnow()
+        job.heartbeat_at = datetime.utcnow()
+        control.pending.extend(
+            db.session.query(BatchItem.id, BatchItem.prompt, BatchItem.attempts).filter_by(
+                job_id=job.id, status='pending'
+            ).order_by(BatchItem.index.asc())
+        )
+        user_id = job.user_id
+        db.session.commit()
+
+        # 由执行器统一处理重试，关闭SDK内置重试避免叠加退避
+        client = client_pool.get(api_key).with_options(max_retries=0)
+        params = {
+            'model': job.model,
+            'max_tokens': job.max_tokens,
+            'temperature': job.temperature
+        }
+        last_flush = time.monotonic()
+
+        while True:
+            with control.condition:
+                while True:
+                    next_retry = control.promote_delayed(time.monotonic())
+                    if control.cancelled.is_set() or (control.pending and control.in_flight < control.limiter.limit):
+                        break
+                    if not control.pending and control.in_flight == 0 and next_retry is None:
+                        break
+                    if len(control.results) >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                        break
+                    control.condition.wait(timeout=min(1.0, next_retry) if next_retry is not None else 1.0)
+
+                if control.cancelled.is_set() or (not control.pending and control.in_flight == 0
+                                                  and not control.delayed):
+                    break
+
+                item = None
+                if control.pending and control.in_flight < control.limiter.limit:
+                    item = control.pending.popleft()
+                    control.in_flight += 1
+
+            if item is not None:
+                self.executor.submit(self._run_item, control, client, params, item)
+
+            if len(control.results) >= self.flush_size or time.monotonic() - last_flush >= self.flush_interval:
+                # 结果写入同时刷新心跳，并读回任务状态（取消请求可能来自其他worker进程）
+                if self._flush(control, user_id, params['model']) == 'cancelled':
+                    control.cancelled.set()
+                last_flush = time.monotonic()
+
+        # 等待已派发的条目结束，把剩余结果写入后再结束任务
+        with control.condition:
+            while control.in_flight > 0:
+                control.condition.wait(timeout=1.0)
+        self._flush(control, user_id, params['model'])
+
+        job = db.session.get(BatchJob, control.job_id)
+        db.session.refresh(job)
+        if job.status == 'running':
+            job.status = 'cancelled' if control.cancelled.is_set() else 'completed'
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+        logger.info(f"批量任务结束 - 任务: {job.id}, 状态: {job.status}, "
+                    f"成功: {job.completed_items}, 失败: {job.failed_items}")
+
+    def _flush(self, control, user_id, model):
+        with control.condition:
+            results, control.results = control.results, []
+        return save_batch_results(control.job_id, user_id, model, results)
+
+    def _run_item(self, control, client, params, item):
+        item_id, prompt, attempts = item
+        attempts = (attempts or 0) + 1
+        result = None
+        ticket = None
+        retry_delay = 0
+        start_time = time.time()
+
+        try:
+            # 批量条目在后台执行，额度不足时一直排队
+            ticket = rate_limiter.acquire(
+                control.api_key, params['model'],
+                count_tokens(prompt, params['model']) + (params['max_tokens'] or 0),
+                max_wait=None
+            )
+            with metrics.upstream(params['model'], route='batch'):
+                response = client.chat.completions.create(
+                    messages=[{'role': 'user', 'content': prompt}],
+                    **params
+                )
+            rate_limiter.settle(ticket, response.usage.total_tokens)
+            control.limiter.on_success()
+            result = {
+                'id': item_id,
+                'status': 'success',
+                'response': response.choices[0].message.content,
+                'tokens_used': response.usage.total_tokens
+            }
+        except Exception as e:
+            # 失败的尝试没有消耗额度，先退回预扣的token，重试时重新预扣
+            rate_limiter.settle(ticket, 0)
+            if is_retryable_error(e) and attempts < self.max_attempts:
+                control.limiter.on_throttle()
+                # 抖动退避，避免所有并发同时重试
+                delay = retry_after(e)
+                retry_delay = delay if delay is not None else min(30, 2 ** attempts) * random.uniform(0.5, 1.0)
+            else:
+                logger.warning(f"批量条目 {item_id} 失败: {e}")
+                result = {'id': item_id, 'status': 'error', 'error': str(e), 'tokens_used': 0}
+
+        with control.condition:
+            control.in_flight -= 1
+            if result is None:
+                if not control.cancelled.is_set():
+                    heapq.heappush(control.delayed, (time.monotonic() + retry_delay, (item_id, prompt, attempts)))
+            else:
+                result.update({
+                    'attempts': attempts,
+                    'duration': time.time() - start_time,
+                    'finished_at': datetime.utcnow()
+                })
+                control.results.append(result)
+            control.condition.notify_all()
+
+
+batch_runner = BatchJobRunner()
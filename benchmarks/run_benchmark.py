@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+压测脚本
+
+启动本地OpenAI替身（stub_openai.py）和gunicorn下的应用，按配置的并发和请求比例访问
+/login、/api/chat、/api/completion 和 /api/conversations，输出每个接口的吞吐量、
+P50/P95/P99延迟、错误数以及数据库大小的增长。结果可保存为JSON，下次运行时用 --baseline 对比。
+
+    python benchmarks/run_benchmark.py --concurrency 32 --duration 60
+    python benchmarks/run_benchmark.py --latency fixed:1.0 --error-rate 0.05 --output after.json --baseline before.json
+
+默认使用临时SQLite数据库；--database-url 可指定其他数据库（会写入压测数据）。
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(ROOT, 'benchmarks', 'stub_openai.py')
+
+PROMPTS = [
+    '用三句话介绍一下Python的GIL',
+    'Write a haiku about databases',
+    '解释一下什么是令牌桶限流',
+    'Summarize the plot of Hamlet in one paragraph',
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f'等待服务启动超时: {url}')
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def database_size(url):
+    """数据库占用的字节数：SQLite为主文件加WAL，PostgreSQL为 pg_database_size"""
+    if url.startswith('sqlite:///'):
+        path = url[len('sqlite:///'):]
+        return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+    if url.startswith('postgresql'):
+        from sqlalchemy import create_engine, text
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            size = conn.execute(text('SELECT pg_database_size(current_database())')).scalar()
+        engine.dispose()
+        return size
+    return None
+
+
+class Recorder:
+    """按接口记录延迟（秒）和错误"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.first_byte = {}
+        self.errors = {}
+        self.statuses = {}
+        self.recording = False
+
+    def add(self, name, seconds, status, first_byte=None):
+        if not self.recording:
+            return
+        with self.lock:
+            self.statuses.setdefault(name, {}).setdefault(status, 0)
+            self.statuses[name][status] += 1
+            if status >= 400 or status == 0:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            else:
+                self.latencies.setdefault(name, []).append(seconds)
+                if first_byte is not None:
+                    self.first_byte.setdefault(name, []).append(first_byte)
+
+    def summary(self, elapsed):
+        result = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = self.latencies.get(name, [])
+            entry = {
+                'requests': len(values) + self.errors.get(name, 0),
+                'errors': self.errors.get(name, 0),
+                'statuses': {str(status): count for status, count in self.statuses.get(name, {}).items()},
+                'throughput': len(values) / elapsed if elapsed else 0,
+                'p50_ms': ms(percentile(values, 50)),
+                'p95_ms': ms(percentile(values, 95)),
+                'p99_ms': ms(percentile(values, 99)),
+            }
+            if name in self.first_byte:
+                entry['ttfb_p50_ms'] = ms(percentile(self.first_byte[name], 50))
+                entry['ttfb_p95_ms'] = ms(percentile(self.first_byte[name], 95))
+            result[name] = entry
+        return result
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+class VirtualUser(threading.Thread):
+    """一个并发用户：登录后按比例循环发送请求"""
+
+    def __init__(self, index, options, base_url, recorder, stop):
+        super().__init__(daemon=True)
+        self.options = options
+        self.recorder = recorder
+        self.stop = stop
+        self.api_key = f'sk-bench-{index % options.users:05d}'
+        self.client = httpx.Client(base_url=base_url, timeout=options.request_timeout)
+        self.random = random.Random(options.seed + index)
+        self.weights = [
+            ('chat', options.chat_weight),
+            ('chat_stream', options.stream_weight),
+            ('completion', options.completion_weight),
+            ('conversations', options.conversations_weight),
+        ]
+
+    def request(self, name, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 0
+        self.recorder.add(name, time.perf_counter() - start, status)
+        return status
+
+    def stream(self, name, path, payload):
+        start = time.perf_counter()
+        first_byte = None
+        status = 0
+        try:
+            with self.client.stream('POST', path, json=payload) as response:
+                status = response.status_code
+                for _ in response.iter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - start
+        except httpx.HTTPError:
+            status = 0
+        self.recorder.add(name, time.perf_counter() - start, status, first_byte)
+
+    def login(self):
+        while not self.stop.is_set():
+            if self.request('login', 'POST', '/login', json={'api_key': self.api_key}) == 200:
+                return
+            time.sleep(0.5)
+
+    def run(self):
+        self.login()
+        names = [name for name, _ in self.weights]
+        weights = [weight for _, weight in self.weights]
+        while not self.stop.is_set():
+            name = self.random.choices(names, weights)[0]
+            prompt = self.random.choice(PROMPTS)
+            if name == 'chat':
+                self.request('chat', 'POST', '/api/chat', json={
+                    'message': prompt, 'model': self.options.chat_model, 'max_tokens': self.options.max_tokens
+                })
+            elif name == 'chat_stream':
+                self.stream('chat_stream', '/api/chat', {
+                    'message': prompt, 'model': self.options.chat_model,
+                    'max_tokens': self.options.max_tokens, 'stream': True
+                })
+            elif name == 'completion':
+                self.request('completion', 'POST', '/api/completion', json={
+                    'prompt': prompt, 'max_tokens': self.options.max_tokens,
+                    'temperature': self.options.completion_temperature
+                })
+            else:
+                self.request('conversations', 'GET', '/api/conversations')
+            # 周期性重新登录，覆盖登录路径
+            if self.random.random() < self.options.relogin_rate:
+                self.login()
+        self.client.close()
+
+
+def start_processes(options, workdir):
+    stub_port = free_port()
+    app_port = free_port()
+    stub = subprocess.Popen([
+        sys.executable, STUB, '--port', str(stub_port), '--latency', options.latency,
+        '--token-interval', str(options.token_interval), '--completion-tokens', options.completion_tokens,
+        '--error-rate', str(options.error_rate)
+    ])
+    wait_for(f'http://127.0.0.1:{stub_port}/v1/models')
+
+    database_url = options.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env = dict(os.environ)
+    env.update({
+        'FLASK_ENV': 'production',
+        'SECRET_KEY': 'benchmark',
+        'DATABASE_URL': database_url,
+        'OPENAI_BASE_URL': f'http://127.0.0.1:{stub_port}/v1',
+        'RATE_LIMIT_USER_RPM': '0',
+        'RATE_LIMIT_USER_TPM': '0',
+        'LOG_LEVEL': 'WARNING',
+    })
+    for item in options.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'init_db.py')], cwd=ROOT, env=env,
+                          stdout=subprocess.DEVNULL)
+    command = ['gunicorn', '-b', f'127.0.0.1:{app_port}', *options.gunicorn_args.split(), options.app]
+    app = subprocess.Popen(command, cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{app_port}'
+    wait_for(f'{base_url}/api/status', timeout=60)
+    return stub, app, base_url, database_url, stub_port
+
+
+def run(options):
+    workdir = tempfile.mkdtemp(prefix='endless-bench-')
+    stub = app = None
+    try:
+        stub, app, base_url, database_url, stub_port = start_processes(options, workdir)
+        size_before = database_size(database_url)
+
+        recorder = Recorder()
+        stop = threading.Event()
+        users = [VirtualUser(index, options, base_url, recorder, stop) for index in range(options.concurrency)]
+        for user in users:
+            user.start()
+
+        time.sleep(options.warmup)
+        recorder.recording = True
+        started = time.monotonic()
+        time.sleep(options.duration)
+        recorder.recording = False
+        elapsed = time.monotonic() - started
+        stop.set()
+        for user in users:
+            user.join(options.request_timeout)
+
+        size_after = database_size(database_url)
+        upstream = httpx.get(f'http://127.0.0.1:{stub_port}/stats').json()
+        endpoints = recorder.summary(elapsed)
+        return {
+            'options': {key: value for key, value in vars(options).items() if key not in ('output', 'baseline')},
+            'duration': round(elapsed, 2),
+            'throughput': round(sum(entry['requests'] - entry['errors'] for entry in endpoints.values()) / elapsed, 2),
+            'endpoints': endpoints,
+            'upstream_requests': upstream,
+            'db_bytes_before': size_before,
+            'db_bytes_after': size_after,
+        }
+    finally:
+        for process in (app, stub):
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(result, baseline=None):
+    print()
+    print(f"持续时间: {result['duration']}s  总吞吐量: {result['throughput']} req/s")
+    header = f"{'接口':<14}{'请求数':>8}{'错误':>6}{'req/s':>9}{'P50':>9}{'P95':>9}{'P99':>9}{'TTFB P50':>10}"
+    print(header)
+    print('-' * len(header))
+    for name, entry in result['endpoints'].items():
+        print(f"{name:<14}{entry['requests']:>8}{entry['errors']:>6}{entry['throughput']:>9.1f}"
+              f"{fmt(entry['p50_ms']):>9}{fmt(entry['p95_ms']):>9}{fmt(entry['p99_ms']):>9}"
+              f"{fmt(entry.get('ttfb_p50_ms')):>10}")
+        if baseline and name in baseline['endpoints']:
+            old = baseline['endpoints'][name]
+            print(f"{'  vs 基线':<14}{'':>8}{'':>6}{delta(old['throughput'], entry['throughput']):>9}"
+                  f"{delta(old['p50_ms'], entry['p50_ms']):>9}{delta(old['p95_ms'], entry['p95_ms']):>9}"
+                  f"{delta(old['p99_ms'], entry['p99_ms']):>9}")
+    print(f"上游请求: {result['upstream_requests']}")
+    if result['db_bytes_before'] is not None:
+        growth = result['db_bytes_after'] - result['db_bytes_before']
+        print(f"数据库大小: {result['db_bytes_before'] / 1024:.0f}KB -> {result['db_bytes_after'] / 1024:.0f}KB "
+              f"(+{growth / 1024:.0f}KB)")
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.0f}'
+
+
+def delta(old, new):
+    if not old or new is None:
+        return '-'
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='endless-api 压测')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发用户数')
+    parser.add_argument('--users', type=int, default=16, help='不同API密钥的数量')
+    parser.add_argument('--duration', type=float, default=30, help='计入结果的压测时间（秒）')
+    parser.add_argument('--warmup', type=float, default=5, help='预热时间（秒），不计入结果')
+    parser.add_argument('--chat-weight', type=float, default=4)
+    parser.add_argument('--stream-weight', type=float, default=2)
+    parser.add_argument('--completion-weight', type=float, default=2)
+    parser.add_argument('--conversations-weight', type=float, default=2)
+    parser.add_argument('--relogin-rate', type=float, default=0.01, help='每次请求后重新登录的概率')
+    parser.add_argument('--chat-model', default='gpt-4o-mini')
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--completion-temperature', type=float, default=0.7)
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=1)
+    # 上游替身
+    parser.add_argument('--latency', default='lognormal:0.5,0.4', help='上游延迟分布，见 stub_openai.py')
+    parser.add_argument('--token-interval', type=float, default=0.005, help='流式分块间隔（秒）')
+    parser.add_argument('--completion-tokens', default='50-300', help='上游输出token数范围')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='上游返回429的比例')
+    # 应用
+    parser.add_argument('--gunicorn-args', default='-w 4 --threads 8', help='传给gunicorn的参数')
+    parser.add_argument('--app', default='app:app', help='应用入口，异步模式为 asgi:application')
+    parser.add_argument('--database-url', help='默认使用临时SQLite数据库')
+    parser.add_argument('--env', action='append', default=[], help='额外的应用环境变量，如 --env HEDGE_ENABLED=false')
+    parser.add_argument('--output', help='把结果保存为JSON')
+    parser.add_argument('--baseline', help='与之前保存的JSON结果对比')
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    result = run(options)
+    print_report(result, baseline)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(result, output_file, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {options.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+启动耗时报告
+
+在新进程中用 python -X importtime 多次导入应用入口（默认 app，即gunicorn预加载和worker回收时的开销），
+取中位数输出总耗时、按顶层包汇总的导入耗时和最慢的模块。结果可保存为JSON，下次运行时用 --baseline 对比；
+--budget 指定耗时上限，超出时以非零状态退出，可放在CI中防止启动耗时回退。
+
+    python benchmarks/startup_time.py
+    python benchmarks/startup_time.py --budget 1.0 --output after.json --baseline before.json
+
+导入应用会连接数据库读取引擎设置，默认使用临时SQLite数据库。
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def measure(options, env):
+    """导入一次应用，返回 (总耗时秒, {模块: (自身微秒, 累计微秒)})"""
+    code = f"import time; started = time.perf_counter(); import {options.module}; print(time.perf_counter() - started)"
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, env=env,
+                             capture_output=True, text=True, check=True)
+    modules = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            modules[match.group(4)] = (int(match.group(1)), int(match.group(2)))
+    return float(process.stdout.strip().splitlines()[-1]), modules
+
+
+def summarize(runs):
+    """各次运行取中位数：总耗时、按顶层包汇总的自身耗时、各模块的累计耗时（均按耗时倒序）"""
+    totals = [total for total, _ in runs]
+    packages = {}
+    cumulative = {}
+    for _, modules in runs:
+        run_packages = {}
+        for name, (self_us, cumulative_us) in modules.items():
+            package = name.split('.')[0]
+            run_packages[package] = run_packages.get(package, 0) + self_us
+            cumulative.setdefault(name, []).append(cumulative_us)
+        for package, value in run_packages.items():
+            packages.setdefault(package, []).append(value)
+
+    def median_ms(values):
+        return round(statistics.median(values) / 1000, 1)
+
+    return {
+        'total_s': round(statistics.median(totals), 3),
+        'min_s': round(min(totals), 3),
+        'modules_imported': round(statistics.median(len(modules) for _, modules in runs)),
+        'packages_ms': dict(sorted(((package, median_ms(values)) for package, values in packages.items()),
+                                   key=lambda item: -item[1])),
+        'modules_ms': dict(sorted(((name, median_ms(values)) for name, values in cumulative.items()),
+                                  key=lambda item: -item[1])),
+    }
+
+
+def run(options):
+    workdir = tempfile.mkdtemp(prefix='endless-startup-')
+    env = dict(os.environ, FLASK_ENV='production', LOG_LEVEL='WARNING')
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(workdir, 'startup.db'))
+    for item in options.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    try:
+        measure(options, env)  # 第一次运行编译字节码，不计入结果
+        runs = [measure(options, env) for _ in range(options.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = summarize(runs)
+    result['module'] = options.module
+    result['runs'] = options.runs
+    return result
+
+
+def print_report(result, baseline=None, top=15):
+    print()
+    line = f"导入 {result['module']}: {result['total_s'] * 1000:.0f}ms（{result['runs']}次中位数，最快 {result['min_s'] * 1000:.0f}ms），" \
+           f"共 {result['modules_imported']} 个模块"
+    if baseline:
+        line += f"  vs 基线 {baseline['total_s'] * 1000:.0f}ms ({delta(baseline['total_s'], result['total_s'])})"
+    print(line)
+
+    print(f"\n{'顶层包':<28}{'自身耗时ms':>12}{'vs 基线':>10}")
+    for package, value in list(result['packages_ms'].items())[:top]:
+        old = (baseline or {}).get('packages_ms', {}).get(package)
+        print(f"{package:<28}{value:>12.1f}{delta(old, value) if baseline else '':>10}")
+
+    print(f"\n{'模块':<48}{'累计耗时ms':>12}")
+    for name, value in list(result['modules_ms'].items())[:top]:
+        print(f"{name:<48}{value:>12.1f}")
+
+
+def delta(old, new):
+    if not old or new is None:
+        return 'new' if new else '-'
+    return f'{(new - old) / old * 100:+.0f}%'
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='应用启动（导入）耗时报告')
+    parser.add_argument('--module', default='app', help='导入的入口模块，异步模式为 asgi')
+    parser.add_argument('--runs', type=int, default=5, help='导入次数，结果取中位数')
+    parser.add_argument('--top', type=int, default=15, help='列出的包和模块数量')
+    parser.add_argument('--budget', type=float, help='导入耗时上限（秒），超出时退出状态为1')
+    parser.add_argument('--env', action='append', default=[], help='额外的应用环境变量，如 --env METRICS_ENABLED=false')
+    parser.add_argument('--output', help='把结果保存为JSON')
+    parser.add_argument('--baseline', help='与之前保存的JSON结果对比')
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    result = run(options)
+    print_report(result, baseline, options.top)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(result, output_file, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {options.output}")
+
+    if options.budget is not None and result['total_s'] > options.budget:
+        print(f"导入耗时 {result['total_s']:.3f}s 超出预算 {options.budget:.3f}s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
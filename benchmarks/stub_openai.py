@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+本地OpenAI API替身，用于压测
+
+实现 /v1/models、/v1/chat/completions（含流式）和 /v1/completions，
+响应延迟、输出token数、流式分块间隔和429比例都可配置，只依赖标准库。
+
+    python benchmarks/stub_openai.py --port 8900 --latency lognormal:0.8,0.5 --error-rate 0.02
+
+延迟分布格式：fixed:秒、uniform:最小,最大、normal:均值,标准差、lognormal:中位数,sigma
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODELS = ['gpt-4o', 'gpt-4o-mini', 'gpt-4', 'gpt-3.5-turbo', 'gpt-3.5-turbo-instruct']
+WORDS = ['the', 'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', '你好', '世界']
+
+
+def parse_distribution(spec):
+    """把分布描述解析为采样函数（返回秒，不小于0）"""
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',')] if args else []
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f'未知的分布: {spec}')
+
+
+def parse_range(spec):
+    low, _, high = spec.partition('-')
+    return int(low), int(high or low)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    options = None
+    stats = Stats()
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {
+                'object': 'list',
+                'data': [{'id': model, 'object': 'model', 'created': 0, 'owned_by': 'stub'} for model in MODELS]
+            })
+        elif self.path == '/stats':
+            self.send_json(200, self.stats.counts)
+        else:
+            self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self.send_json(400, {'error': {'message': 'invalid json', 'type': 'invalid_request_error'}})
+
+        if self.path.endswith('/chat/completions'):
+            kind = 'chat'
+        elif self.path.endswith('/completions'):
+            kind = 'completion'
+        else:
+            return self.send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+
+        if random.random() < self.options.error_rate:
+            self.stats.add('429')
+            return self.send_json(429, {
+                'error': {'message': 'Rate limit reached (stub)', 'type': 'rate_limit_error', 'code': 'rate_limit_exceeded'}
+            }, {'retry-after-ms': str(self.options.retry_after_ms)})
+
+        self.stats.add(kind + ('_stream' if body.get('stream') else ''))
+        prompt_tokens = max(1, len(json.dumps(body.get('messages') or body.get('prompt') or '')) // 4)
+        low, high = self.options.completion_tokens
+        limit = body.get('max_tokens') or high
+        completion_tokens = random.randint(min(low, limit), min(high, limit))
+        words = [random.choice(WORDS) for _ in range(completion_tokens)]
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens
+        }
+
+        time.sleep(self.options.latency())
+        if body.get('stream'):
+            include_usage = (body.get('stream_options') or {}).get('include_usage')
+            self.send_stream(kind, body.get('model'), words, usage if include_usage else None)
+        else:
+            self.send_json(200, self.completion(kind, body.get('model'), ' '.join(words), usage))
+
+    @staticmethod
+    def completion(kind, model, text, usage):
+        if kind == 'chat':
+            choice = {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}
+        else:
+            choice = {'index': 0, 'text': text, 'finish_reason': 'stop', 'logprobs': None}
+        return {
+            'id': f'stub-{uuid.uuid4().hex}',
+            'object': 'chat.completion' if kind == 'chat' else 'text_completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [choice],
+            'usage': usage
+        }
+
+    def rate_limit_headers(self):
+        return {
+            'x-ratelimit-limit-requests': '100000',
+            'x-ratelimit-remaining-requests': '99999',
+            'x-ratelimit-limit-tokens': '100000000',
+            'x-ratelimit-remaining-tokens': '99999999'
+        }
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in {**self.rate_limit_headers(), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, kind, model, words, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in self.rate_limit_headers().items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        chunk_id = f'stub-{uuid.uuid4().hex}'
+        created = int(time.time())
+        for index, word in enumerate(words):
+            text = word if index == 0 else ' ' + word
+            if kind == 'chat':
+                choice = {'index': 0, 'delta': {'content': text}, 'finish_reason': None}
+            else:
+                choice = {'index': 0, 'text': text, 'finish_reason': None, 'logprobs': None}
+            self.write_event({
+                'id': chunk_id,
+                'object': 'chat.completion.chunk' if kind == 'chat' else 'text_completion',
+                'created': created,
+                'model': model,
+                'choices': [choice]
+            })
+            if self.options.token_interval:
+                time.sleep(self.options.token_interval)
+        if usage:
+            self.write_event({
+                'id': chunk_id,
+                'object': 'chat.completion.chunk' if kind == 'chat' else 'text_completion',
+                'created': created,
+                'model': model,
+                'choices': [],
+                'usage': usage
+            })
+        self.write_chunk(b'data: [DONE]\n\n')
+        self.write_chunk(b'')
+
+    def write_event(self, payload):
+        self.write_chunk(f'data: {json.dumps(payload, ensure_ascii=False)}\n\n'.encode())
+
+    def write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 默认的监听队列只有5，高并发时连接会被丢弃重试
+
+    def handle_error(self, request, client_address):
+        # 客户端提前断开（如对冲请求的落选方被关闭）属于正常情况
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='本地OpenAI API替身')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', default='lognormal:0.5,0.4', help='首个token前的延迟分布（秒）')
+    parser.add_argument('--token-interval', type=float, default=0.005, help='流式分块间隔（秒）')
+    parser.add_argument('--completion-tokens', type=parse_range, default=(50, 300), help='输出token数范围，如 50-300')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回429的比例')
+    parser.add_argument('--retry-after-ms', type=int, default=200, help='429响应中的 retry-after-ms')
+    parser.add_argument('--verbose', action='store_true', help='打印每个请求')
+    return parser
+
+
+def serve(options):
+    options.latency = parse_distribution(options.latency)
+    StubHandler.options = options
+    server = StubServer((options.host, options.port), StubHandler)
+    print(f"OpenAI替身已启动: http://{options.host}:{options.port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(build_parser().parse_args())
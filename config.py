@@ -6,6 +6,20 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///endless_api.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # SQLite引擎配置（每个连接建立时通过PRAGMA设置）
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE') or 'WAL'  # WAL模式下读写互不阻塞
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or 'NORMAL'  # WAL下NORMAL足够安全且少一次fsync
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)  # 等待写锁的时间（毫秒），避免database is locked
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -65536)  # 页缓存，负数表示KB（64MB）
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 268435456)  # 内存映射读取（256MB）
+    
+    # PostgreSQL连接池配置
+    POSTGRES_POOL_SIZE = int(os.environ.get('POSTGRES_POOL_SIZE') or 10)
+    POSTGRES_MAX_OVERFLOW = int(os.environ.get('POSTGRES_MAX_OVERFLOW') or 20)
+    POSTGRES_POOL_TIMEOUT = int(os.environ.get('POSTGRES_POOL_TIMEOUT') or 10)  # 等待空闲连接的时间（秒）
+    POSTGRES_POOL_RECYCLE = int(os.environ.get('POSTGRES_POOL_RECYCLE') or 1800)  # 连接最长复用时间（秒）
+    POSTGRES_STATEMENT_TIMEOUT = int(os.environ.get('POSTGRES_STATEMENT_TIMEOUT') or 30000)  # 单条语句超时（毫秒）
+    
     # 安全配置
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-change-this-in-production'
     
@@ -14,6 +28,124 @@ class Config:
     
     # 日志配置
     LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    
+    # 上游OpenAI客户端配置
+    OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')  # 为空时使用SDK默认地址
+    OPENAI_TIMEOUT = float(os.environ.get('OPENAI_TIMEOUT') or 120)  # 上游请求超时（秒）
+    OPENAI_CLIENT_POOL_SIZE = int(os.environ.get('OPENAI_CLIENT_POOL_SIZE') or 256)  # 缓存的客户端数量上限
+    OPENAI_CLIENT_IDLE_TTL = int(os.environ.get('OPENAI_CLIENT_IDLE_TTL') or 1800)  # 客户端空闲过期时间（秒）
+    OPENAI_MAX_CONNECTIONS = int(os.environ.get('OPENAI_MAX_CONNECTIONS') or 100)  # 每个上游主机的最大连接数
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('OPENAI_MAX_KEEPALIVE_CONNECTIONS') or 20)
+    OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY') or 60)  # 长连接空闲保持时间（秒）
+    OPENAI_PREWARM_CONNECTIONS = int(os.environ.get('OPENAI_PREWARM_CONNECTIONS') or 0)  # 启动时预热的连接数，0为关闭
+    
+    # 模型目录缓存配置
+    MODEL_CATALOG_TTL = int(os.environ.get('MODEL_CATALOG_TTL') or 3600)  # 有效密钥的模型列表缓存时间（秒）
+    MODEL_CATALOG_NEGATIVE_TTL = int(os.environ.get('MODEL_CATALOG_NEGATIVE_TTL') or 60)  # 无效密钥的负缓存时间（秒）
+    MODEL_CATALOG_REFRESH_RATIO = 0.8  # 缓存超过TTL的该比例后在后台刷新
+    MODEL_CATALOG_MAX_ENTRIES = 4096  # 缓存的密钥数上限，超出时先删除过期条目，再删除最久未使用的条目
+    
+    # 使用记录异步写入配置
+    USAGE_WRITER_ENABLED = (os.environ.get('USAGE_WRITER_ENABLED') or 'true').lower() == 'true'
+    USAGE_QUEUE_SIZE = int(os.environ.get('USAGE_QUEUE_SIZE') or 10000)  # 内存队列上限，超出后丢弃
+    USAGE_FLUSH_SIZE = 200  # 攒够多少条写入一次
+    USAGE_FLUSH_INTERVAL = 1.0  # 最长等待时间（秒）
+    
+    # 补全响应缓存配置
+    RESPONSE_CACHE_ENABLED = (os.environ.get('RESPONSE_CACHE_ENABLED') or 'true').lower() == 'true'
+    RESPONSE_CACHE_MAX_TEMPERATURE = float(os.environ.get('RESPONSE_CACHE_MAX_TEMPERATURE') or 0)  # 只缓存温度不高于此值的请求
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL') or 86400)  # 缓存有效期（秒）
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES') or 2048)  # 内存层条数上限
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES') or 64 * 1024 * 1024)  # 内存层大小上限
+    RESPONSE_CACHE_DISK_PATH = os.environ.get('RESPONSE_CACHE_DISK_PATH')  # 磁盘层SQLite文件路径，为空时不启用
+    RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_DISK_MAX_BYTES') or 512 * 1024 * 1024)  # 磁盘层大小上限
+    
+    # 自定义助手生成结果缓存（按规范化后的需求描述和模型，所有用户共享）
+    ASSISTANT_CACHE_ENABLED = (os.environ.get('ASSISTANT_CACHE_ENABLED') or 'true').lower() == 'true'
+    ASSISTANT_CACHE_TTL = int(os.environ.get('ASSISTANT_CACHE_TTL') or 7 * 86400)  # 缓存有效期（秒）
+    ASSISTANT_CACHE_MAX_ENTRIES = int(os.environ.get('ASSISTANT_CACHE_MAX_ENTRIES') or 1024)  # 内存层条数上限
+    ASSISTANT_CACHE_MAX_BYTES = int(os.environ.get('ASSISTANT_CACHE_MAX_BYTES') or 8 * 1024 * 1024)  # 内存层大小上限
+    ASSISTANT_CACHE_DISK_PATH = os.environ.get('ASSISTANT_CACHE_DISK_PATH')  # 磁盘层SQLite文件路径，为空时不启用
+    ASSISTANT_CACHE_DISK_MAX_BYTES = int(os.environ.get('ASSISTANT_CACHE_DISK_MAX_BYTES') or 64 * 1024 * 1024)  # 磁盘层大小上限
+    
+    # 上游调用限流与重试（令牌桶为进程内，模型级额度同时从上游响应头学习）
+    RATE_LIMIT_ENABLED = (os.environ.get('RATE_LIMIT_ENABLED') or 'true').lower() == 'true'
+    RATE_LIMIT_USER_RPM = int(os.environ.get('RATE_LIMIT_USER_RPM') or 120)  # 每个用户每分钟请求数，0为不限制
+    RATE_LIMIT_USER_TPM = int(os.environ.get('RATE_LIMIT_USER_TPM') or 200000)  # 每个用户每分钟token数，0为不限制
+    RATE_LIMIT_MODEL_RPM = int(os.environ.get('RATE_LIMIT_MODEL_RPM') or 0)  # 每个用户每个模型的请求数，0为只按上游响应头限制
+    RATE_LIMIT_MODEL_TPM = int(os.environ.get('RATE_LIMIT_MODEL_TPM') or 0)  # 每个用户每个模型的token数，0为只按上游响应头限制
+    RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT') or 30)  # 交互请求排队等待额度的最长时间（秒），超出返回429
+    UPSTREAM_MAX_ATTEMPTS = int(os.environ.get('UPSTREAM_MAX_ATTEMPTS') or 4)  # 429/5xx/超时时的最大尝试次数
+    UPSTREAM_RETRY_BASE_DELAY = 0.5  # 首次重试的基础等待时间（秒），之后指数增长
+    UPSTREAM_RETRY_MAX_DELAY = 20  # 单次重试的最长等待时间（秒）
+    
+    # 各路由的上游超时（秒）：单次尝试的超时，也是重试的时间预算
+    CHAT_UPSTREAM_TIMEOUT = float(os.environ.get('CHAT_UPSTREAM_TIMEOUT') or 60)
+    COMPLETION_UPSTREAM_TIMEOUT = float(os.environ.get('COMPLETION_UPSTREAM_TIMEOUT') or 60)
+    ASSISTANT_UPSTREAM_TIMEOUT = float(os.environ.get('ASSISTANT_UPSTREAM_TIMEOUT') or 90)
+    
+    # Prometheus指标（多进程部署时设置环境变量 PROMETHEUS_MULTIPROC_DIR）
+    METRICS_ENABLED = (os.environ.get('METRICS_ENABLED') or 'true').lower() == 'true'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # 访问 /metrics 需要的Bearer令牌，为空时不校验
+    METRICS_MAX_MODELS = 50  # 模型标签的种类上限，超出的模型归为 other
+    
+    # 请求耗时分解（Server-Timing响应头）与采样分析
+    SERVER_TIMING_ENABLED = (os.environ.get('SERVER_TIMING_ENABLED') or 'true').lower() == 'true'
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE') or 0)  # 默认采样比例，管理员可通过接口调整
+    PROFILER_DIR = os.environ.get('PROFILER_DIR')  # 分析文件目录，默认为 instance/profiles
+    PROFILER_REFRESH_INTERVAL = 10  # 各worker重新读取采样比例的间隔（秒）
+    PROFILER_MAX_FILES = 200  # 最多保留的分析文件数
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # 管理接口的Bearer令牌，为空时管理接口不可用
+    
+    # 异步服务模式（asgi.py）：每个进行中的请求占用一个线程，等待上游时不占用数据库连接，应不小于预期的并发请求数
+    ASYNC_THREADS = int(os.environ.get('ASYNC_THREADS') or 256)
+    
+    # 聊天对冲请求：超过最近延迟的P95仍未响应（流式为未收到首个分块）时再发一次，取先完成的结果
+    HEDGE_ENABLED = (os.environ.get('HEDGE_ENABLED') or 'true').lower() == 'true'
+    HEDGE_PERCENTILE = 95
+    HEDGE_MIN_SAMPLES = 20  # 样本数不足时不对冲
+    HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY') or 1.0)  # 触发对冲的最短等待时间（秒）
+    HEDGE_WINDOW_SIZE = 200  # 每个路由/模型保留的最近延迟样本数
+    HEDGE_MAX_WORKERS = int(os.environ.get('HEDGE_MAX_WORKERS') or 64)
+    
+    # 合并同一进程内相同的进行中上游请求
+    SINGLE_FLIGHT_ENABLED = (os.environ.get('SINGLE_FLIGHT_ENABLED') or 'true').lower() == 'true'
+    
+    # 图片存储配置（按内容哈希保存上传的图片，并缩小到视觉模型使用的分辨率）
+    IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR')  # 为空时使用 instance/images
+    IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES') or 20 * 1024 * 1024)  # 单张图片上传大小上限
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH') or 32 * 1024 * 1024)  # 请求体大小上限，超出返回413，需大于单张图片上限
+    IMAGE_MAX_SIDE = 2048  # 长边上限（像素）
+    IMAGE_SHORT_SIDE = 768  # 短边上限（像素），与视觉模型高精度模式的处理尺寸一致
+    IMAGE_JPEG_QUALITY = 85
+    
+    # 对话上下文配置
+    CONTEXT_MAX_TOKENS = int(os.environ.get('CONTEXT_MAX_TOKENS') or 0)  # 输入上下文token上限，0表示只受模型上下文长度和CONTEXT_WINDOW_TOKENS限制
+    CONTEXT_DEFAULT_MAX_CONTEXT = 4096  # 能力表中没有的模型按此上下文长度计算
+    CONTEXT_CACHE_SIZE = 1024  # 进程内缓存的对话数
+    CONTEXT_WINDOW_TOKENS = int(os.environ.get('CONTEXT_WINDOW_TOKENS') or 16384)  # 未设置CONTEXT_MAX_TOKENS时每个对话缓存（最多发送）的历史token数
+    
+    # 使用统计：写入使用记录时同步累加按小时/天的汇总，成本按本地价格表估算
+    USAGE_PRICE_FILE = os.environ.get('USAGE_PRICE_FILE')  # 覆盖内置价格表的JSON文件，格式 {"模型": [输入价格, 输出价格]}（美元/百万token）
+    USAGE_MAX_DAYS = 366  # /api/usage 按天查询的最大范围
+    USAGE_MAX_HOURS = 24 * 31  # /api/usage 按小时查询的最大范围
+    
+    # 批量处理配置
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS') or 10000)  # 单个任务最大条目数
+    BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY') or 10)  # 单个任务并发上限
+    BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS') or 32)  # 进程内执行线程总数
+    BATCH_MAX_ATTEMPTS = int(os.environ.get('BATCH_MAX_ATTEMPTS') or 3)  # 限流/上游故障时的最大尝试次数
+    BATCH_FLUSH_SIZE = 50  # 攒够多少条结果写入一次数据库
+    BATCH_FLUSH_INTERVAL = 2  # 结果最长缓存时间（秒），同时作为心跳间隔
+    BATCH_HEARTBEAT_TIMEOUT = 60  # 超过该时间无心跳视为任务中断（秒）
+    
+    # 归档配置：已清除的旧对话（含消息）和旧补全记录按月写入压缩文件后从数据库删除
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')  # 归档目录，默认为 instance/archive
+    ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL') or 86400)  # 自动归档间隔（秒），0为关闭（可由cron执行 archive_db.py）
+    ARCHIVE_INACTIVE_DAYS = int(os.environ.get('ARCHIVE_INACTIVE_DAYS') or 30)  # 对话清除后超过多少天归档
+    ARCHIVE_COMPLETION_DAYS = int(os.environ.get('ARCHIVE_COMPLETION_DAYS') or 90)  # 补全记录超过多少天归档，0为不归档
+    ARCHIVE_BATCH_SIZE = 100  # 每个事务归档的对话/补全记录数
+    ARCHIVE_BATCH_PAUSE = 0.05  # 批次之间的停顿（秒），让出SQLite写锁
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -25,10 +157,38 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///endless_api_test.db'
+    USAGE_WRITER_ENABLED = False  # 测试中同步写入，便于断言
+    ARCHIVE_INTERVAL = 0  # 测试中不自动归档
 
 config = {
     'development': DevelopmentConfig,
     'production': ProductionConfig,
     'testing': TestingConfig,
     'default': DevelopmentConfig
-} 
\ No newline at end of file
+} 
+
+def engine_options(app_config):
+    """根据数据库类型生成 SQLALCHEMY_ENGINE_OPTIONS"""
+    uri = app_config['SQLALCHEMY_DATABASE_URI']
+    
+    if uri.startswith('sqlite'):
+        return {
+            'connect_args': {
+                'timeout': app_config['SQLITE_BUSY_TIMEOUT'] / 1000,
+                'check_same_thread': False
+            }
+        }
+    
+    if uri.startswith('postgres'):
+        return {
+            'pool_size': app_config['POSTGRES_POOL_SIZE'],
+            'max_overflow': app_config['POSTGRES_MAX_OVERFLOW'],
+            'pool_timeout': app_config['POSTGRES_POOL_TIMEOUT'],
+            'pool_recycle': app_config['POSTGRES_POOL_RECYCLE'],
+            'pool_pre_ping': True,
+            'connect_args': {
+                'options': f"-c statement_timeout={app_config['POSTGRES_STATEMENT_TIMEOUT']}"
+            }
+        }
+    
+    return {'pool_pre_ping': True}
@@ -0,0 +1,165 @@
+"""
+按token预算构建对话上下文
+
+每个对话的历史消息（连同本地计算的token数）缓存在进程内，之后只增量读取新保存的消息，
+不再每轮重新加载整段历史。每个对话最多缓存 window_tokens 个token的最近历史，缓存未命中时
+也只从最新的消息往前读取这么多。发送给上游前从最早的轮次开始裁剪，使上下文不超过模型的
+上下文长度减去回复预留的token数，system prompt和本轮用户消息始终保留。
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from database import get_conversation_messages, get_conversation_message_page
+from model_catalog import max_context
+
+try:
+    import tiktoken
+except ImportError:  # 可选依赖，未安装时使用近似估算
+    tiktoken = None
+
+# 每条消息的格式开销（角色、分隔符）和回复引导开销，参照OpenAI的计数方法
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# 缓存未命中时每次从数据库往前读取的消息数
+HISTORY_PAGE_SIZE = 100
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def _encoding_for(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text, model=None):
+    """本地计算文本token数；未安装tiktoken时按中日韩字符1个token、其余约4字符1个token估算"""
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding_for(model or 'gpt-3.5-turbo').encode(text))
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages, model=None):
+    """估算消息列表的输入token数（多模态消息只计算文本部分）"""
+    total = TOKENS_PER_REPLY
+    for msg in messages:
+        content = msg['content']
+        if isinstance(content, list):
+            content = ' '.join(part.get('text', '') for part in content if part.get('type') == 'text')
+        total += count_tokens(content, model) + TOKENS_PER_MESSAGE
+    return total
+
+
+class _ContextWindow:
+    def __init__(self):
+        self.messages = []  # [{'role', 'content', 'tokens'}]
+        self.tokens = 0
+        self.last_message_id = None
+
+
+class ContextBuilder:
+    """对话上下文缓存与裁剪，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self._windows = OrderedDict()  # conversation_id -> _ContextWindow
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache_size = app.config['CONTEXT_CACHE_SIZE']
+        self.default_max_context = app.config['CONTEXT_DEFAULT_MAX_CONTEXT']
+        self.max_budget = app.config['CONTEXT_MAX_TOKENS']
+        # 超出预算的早期消息不会再被发送，无需继续缓存
+        self.window_tokens = self.max_budget or app.config['CONTEXT_WINDOW_TOKENS']
+        app.extensions['context_builder'] = self
+
+    def budget(self, model, max_tokens):
+        """可用于输入上下文的token数：模型上下文长度减去回复预留"""
+        budget = (max_context(model) or self.default_max_context) - max_tokens
+        if self.max_budget:
+            budget = min(budget, self.max_budget)
+        return budget
+
+    def history(self, conversation_id, model=None):
+        """对话历史（不含system消息），只从数据库读取上次之后新增的消息"""
+        with self._lock:
+            window = self._windows.pop(conversation_id, None) or _ContextWindow()
+            self._windows[conversation_id] = window
+            while len(self._windows) > self.cache_size:
+                self._windows.popitem(last=False)
+
+        if window.last_message_id is None:
+            new_messages = self._recent_messages(conversation_id, model)
+        else:
+            new_messages = [(msg, None) for msg in
+                            get_conversation_messages(conversation_id, after_id=window.last_message_id)]
+        if new_messages:
+            with self._lock:
+                for msg, tokens in new_messages:
+                    if window.last_message_id is not None and msg.id <= window.last_message_id:
+                        continue  # 并发请求已追加
+                    if msg.role != 'system':
+                        if tokens is None:
+                            tokens = count_tokens(msg.content, model) + TOKENS_PER_MESSAGE
+                        window.messages.append({'role': msg.role, 'content': msg.content, 'tokens': tokens})
+                        window.tokens += tokens
+                    window.last_message_id = msg.id
+                while window.tokens > self.window_tokens and len(window.messages) > 1:
+                    window.tokens -= window.messages.pop(0)['tokens']
+        return list(window.messages)
+
+    def _recent_messages(self, conversation_id, model):
+        """缓存未命中时从最新的消息往前分页读取，直到超出 window_tokens，返回按时间正序的 (消息, token数)"""
+        messages = []
+        total = 0
+        before = None
+        while True:
+            page = get_conversation_message_page(conversation_id, limit=HISTORY_PAGE_SIZE, before=before)
+            for msg in page:
+                tokens = count_tokens(msg.content, model) + TOKENS_PER_MESSAGE
+                if messages and total + tokens > self.window_tokens:
+                    messages.reverse()
+                    return messages
+                messages.append((msg, tokens))
+                total += tokens
+            if len(page) < HISTORY_PAGE_SIZE:
+                messages.reverse()
+                return messages
+            before = (page[-1].created_at, page[-1].id)
+
+    def build(self, conversation, model, max_tokens, message):
+        """构建发送给上游的消息列表：system prompt + 预算内最近的历史 + 本轮用户消息"""
+        budget = self.budget(model, max_tokens)
+        system_messages = []
+        if conversation is not None and conversation.system_prompt:
+            system_messages.append({'role': 'system', 'content': conversation.system_prompt})
+
+        used = TOKENS_PER_REPLY + count_tokens(message, model) + TOKENS_PER_MESSAGE
+        used += sum(count_tokens(msg['content'], model) + TOKENS_PER_MESSAGE for msg in system_messages)
+
+        kept = []
+        if conversation is not None:
+            # 从最近的消息往前取，直到预算用完，保证保留的历史是连续的
+            for msg in reversed(self.history(conversation.id, model)):
+                if used + msg['tokens'] > budget:
+                    break
+                used += msg['tokens']
+                kept.append({'role': msg['role'], 'content': msg['content']})
+            kept.reverse()
+
+        return system_messages + kept + [{'role': 'user', 'content': message}]
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._windows.pop(conversation_id, None)
+
+
+context_builder = ContextBuilder()
@@ -1,6 +1,43 @@
-from models import db, User, Conversation, Message, Completion, UsageRecord, SystemConfig
+from models import db, User, Conversation, Message, Completion, UsageRecord, SystemConfig, BatchJob, BatchItem
+import base64
 import hashlib
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import g, has_app_context
+from sqlalchemy import insert, func, or_, and_
+from sqlalchemy.exc import IntegrityError
+from openai_clients import client_pool
+from rate_limiter import rate_limiter
+from metrics import metrics
+from response_cache import assistant_prompt_cache, assistant_cache_key
+from usage_writer import usage_writer
+from usage_stats import usage_stats
+from datetime import datetime, timedelta
+
+PREVIEW_LENGTH = 100  # 对话列表中预览文本的长度
+
+# 生成助手标题的共享线程池（与system prompt并发生成），线程在首次使用时创建，fork前预加载应用不受影响
+_title_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='assistant-title')
+
+def encode_cursor(timestamp, row_id):
+    """把分页位置（时间戳, ID）编码为不透明的游标字符串"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+def decode_cursor(cursor):
+    """解析游标字符串，格式无效时抛出ValueError"""
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+
+def keyset_before(timestamp_column, id_column, cursor):
+    """按 (时间戳, ID) 倒序翻页的条件：只取游标位置之前的行"""
+    timestamp, row_id = cursor
+    return or_(
+        timestamp_column < timestamp,
+        and_(timestamp_column == timestamp, id_column < row_id)
+    )
 
 def init_database(app):
     """初始化数据库"""
@@ -8,6 +45,38 @@ def init_database(app):
         db.create_all()
         print("数据库表创建完成！")
 
+def in_unit_of_work():
+    """当前是否处于请求级工作单元中"""
+    return has_app_context() and g.get('unit_of_work', False)
+
+@contextmanager
+def unit_of_work():
+    """请求级工作单元：期间的保存操作只flush不commit，退出时一次性提交
+    
+    任一操作失败会抛出异常并回滚整个工作单元，而不是各自回滚后静默返回None。
+    可以嵌套使用，只有最外层负责提交。
+    """
+    if in_unit_of_work():
+        yield
+        return
+    
+    g.unit_of_work = True
+    try:
+        yield
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        g.unit_of_work = False
+
+def commit_changes():
+    """提交修改；在工作单元中只flush（分配主键），由工作单元统一提交"""
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
 def create_user(api_key):
     """创建新用户"""
     # 生成API密钥哈希值
@@ -26,6 +95,10 @@ def create_user(api_key):
         db.session.add(user)
         db.session.commit()
         return user
+    except IntegrityError:
+        # 同一密钥的并发首次登录，另一个请求已创建用户
+        db.session.rollback()
+        return get_user_by_api_key(api_key)
     except Exception as e:
         db.session.rollback()
         print(f"创建用户失败: {e}")
@@ -45,34 +118,102 @@ def update_user_login(user):
         db.session.rollback()
         print(f"更新用户登录时间失败: {e}")
 
-def save_chat_message(user_id, conversation_id, role, content, model=None, tokens_used=None):
+def update_user_settings(user, response_cache_enabled=None):
+    """更新用户设置"""
+    if response_cache_enabled is not None:
+        user.response_cache_enabled = response_cache_enabled
+    try:
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"更新用户设置失败: {e}")
+        return False
+
+def get_system_config(key):
+    """读取系统配置，不存在时返回None"""
+    return db.session.query(SystemConfig.value).filter_by(key=key).scalar()
+
+def set_system_config(key, value, description=None):
+    """写入系统配置（不存在时创建）"""
+    config = SystemConfig.query.filter_by(key=key).first()
+    if config is None:
+        config = SystemConfig(key=key, description=description)
+        db.session.add(config)
+    config.value = value
+    try:
+        commit_changes()
+        return config
+    except Exception as e:
+        if in_unit_of_work():
+            raise
+        db.session.rollback()
+        print(f"保存系统配置失败: {e}")
+        return None
+
+def save_chat_message(user_id, conversation_id, role, content, model=None, tokens_used=None, image_ids=None):
     """保存聊天消息"""
     message = Message(
         conversation_id=conversation_id,
         role=role,
         content=content,
         model=model,
-        tokens_used=tokens_used
+        tokens_used=tokens_used,
+        image_ids=image_ids or None
     )
     
     try:
         db.session.add(message)
-        db.session.commit()
+        db.session.flush()
+        update_conversation_stats(conversation_id, message)
+        commit_changes()
         return message
     except Exception as e:
+        if in_unit_of_work():
+            raise
         db.session.rollback()
         print(f"保存消息失败: {e}")
         return None
 
-def create_custom_assistant(user_id, user_request, api_key, model='gpt-4'):
-    """创建自定义对话助手"""
+def update_conversation_stats(conversation_id, message):
+    """新消息写入后原子更新对话的消息数和最后一条消息（不改变updated_at排序）"""
+    Conversation.query.filter_by(id=conversation_id).update({
+        'message_count': Conversation.message_count + 1,
+        'last_message_at': message.created_at,
+        'last_message_preview': message.content[:PREVIEW_LENGTH],
+        'updated_at': Conversation.updated_at
+    }, synchronize_session=False)
+
+def refresh_conversation_stats(conversation_ids=None):
+    """根据消息表重新计算对话统计（用于历史数据回填或修复）"""
+    query = Conversation.query
+    if conversation_ids is not None:
+        query = query.filter(Conversation.id.in_(conversation_ids))
+    
     try:
-        # 使用AI生成system prompt
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
-        
-        # 构建生成system prompt的提示词
-        system_generation_prompt = f"""
+        for conversation in query.all():
+            last_message = Message.query.filter_by(
+                conversation_id=conversation.id
+            ).order_by(Message.created_at.desc(), Message.id.desc()).first()
+            Conversation.query.filter_by(id=conversation.id).update({
+                'message_count': Message.query.filter_by(conversation_id=conversation.id).count(),
+                'last_message_at': last_message.created_at if last_message else None,
+                'last_message_preview': last_message.content[:PREVIEW_LENGTH] if last_message else None,
+                'updated_at': Conversation.updated_at
+            }, synchronize_session=False)
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"刷新对话统计失败: {e}")
+        return False
+
+ASSISTANT_TITLE_QUOTES = '"“”「」 '  # 去掉模型给标题加的引号
+
+def assistant_generation_prompts(user_request):
+    """生成自定义助手所用的 (system prompt提示词, 标题提示词)"""
+    # 构建生成system prompt的提示词
+    system_generation_prompt = f"""
 请根据用户的需求，生成一个专业的system prompt来创建一个专门的AI助手。
 
 用户需求：{user_request}
@@ -86,66 +227,91 @@ def create_custom_assistant(user_id, user_request, api_key, model='gpt-4'):
 请只返回system prompt内容，不要包含其他说明。
 """
 
-        # 调用AI生成system prompt
-        response = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "user", "content": system_generation_prompt}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        
-        system_prompt = response.choices[0].message.content.strip()
-        
-        # 生成对话标题
-        title_generation_prompt = f"""
+    # 标题只依据用户需求生成，不必等待system prompt
+    title_generation_prompt = f"""
 根据以下需求，生成一个简洁的对话标题（不超过20字）：
 
 用户需求：{user_request}
-System Prompt：{system_prompt[:100]}...
 
 请只返回标题，不要包含其他内容。
 """
+    return system_generation_prompt, title_generation_prompt
+
+def generate_assistant(user_request, api_key, model='gpt-4', timeout=None):
+    """生成自定义助手的 (标题, system prompt)；两次上游调用互不依赖，并发执行"""
+    client = client_pool.get(api_key)
+    if timeout:
+        client = client.with_options(timeout=timeout)
+    system_generation_prompt, title_generation_prompt = assistant_generation_prompts(user_request)
 
-        title_response = client.chat.completions.create(
+    def generate(prompt, max_tokens):
+        return rate_limiter.call(lambda: client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "user", "content": title_generation_prompt}
+                {"role": "user", "content": prompt}
             ],
-            max_tokens=50,
+            max_tokens=max_tokens,
             temperature=0.7
-        )
+        ))
+
+    # 提示词约200 token，两次调用一起预扣额度，结束后按实际用量修正（失败时全部退回）
+    ticket = rate_limiter.acquire(api_key, model, 900)
+    try:
+        with metrics.upstream(model):
+            title_future = _title_executor.submit(generate, title_generation_prompt, 50)
+            system_response = generate(system_generation_prompt, 500)
+            title_response = title_future.result()
+    except Exception:
+        rate_limiter.settle(ticket, 0)
+        raise
+    rate_limiter.settle(ticket, system_response.usage.total_tokens + title_response.usage.total_tokens)
+    title = title_response.choices[0].message.content.strip()
+    return title.strip(ASSISTANT_TITLE_QUOTES), system_response.choices[0].message.content.strip()
+
+def create_custom_assistant(user_id, user_request, api_key, model='gpt-4', timeout=None):
+    """创建自定义对话助手（timeout为单次上游请求的超时，秒）；相同需求优先使用缓存的生成结果"""
+    try:
+        key = assistant_cache_key(user_request, model)
+        cached = assistant_prompt_cache.get(key)
+        if cached is not None:
+            title, system_prompt = cached['title'], cached['system_prompt']
+        else:
+            title, system_prompt = generate_assistant(user_request, api_key, model, timeout)
+            assistant_prompt_cache.set(key, {'title': title, 'system_prompt': system_prompt})
         
-        title = title_response.choices[0].message.content.strip()
+        return save_custom_assistant(user_id, title, system_prompt)
         
-        # 创建对话
+    except Exception as e:
+        db.session.rollback()
+        print(f"创建自定义助手失败: {e}")
+        return None
+
+def save_custom_assistant(user_id, title, system_prompt):
+    """创建助手对话和system message（同一事务）"""
+    with unit_of_work():
         conversation = Conversation(
             user_id=user_id,
             title=title,
             system_prompt=system_prompt
         )
-        
         db.session.add(conversation)
-        db.session.commit()
+        db.session.flush()
         
-        # 保存system message
         save_chat_message(user_id, conversation.id, 'system', system_prompt)
-        
-        return conversation
-        
-    except Exception as e:
-        db.session.rollback()
-        print(f"创建自定义助手失败: {e}")
-        return None
+    
+    return conversation
 
-def get_or_create_conversation(user_id, title="新对话", system_prompt=None):
-    """获取或创建对话"""
-    # 尝试获取用户最近的活跃对话
-    conversation = Conversation.query.filter_by(
+def get_active_conversation(user_id):
+    """获取用户最近的活跃对话（只读，不会创建）"""
+    return Conversation.query.filter_by(
         user_id=user_id,
         is_active=True
     ).order_by(Conversation.updated_at.desc()).first()
+
+def get_or_create_conversation(user_id, title="新对话", system_prompt=None):
+    """获取或创建对话"""
+    # 尝试获取用户最近的活跃对话
+    conversation = get_active_conversation(user_id)
     
     if not conversation:
         # 创建新对话
@@ -156,13 +322,15 @@ def get_or_create_conversation(user_id, title="新对话", system_prompt=None):
         )
         try:
             db.session.add(conversation)
-            db.session.commit()
+            commit_changes()
             
             # 如果有system prompt，保存为system message
             if system_prompt:
                 save_chat_message(user_id, conversation.id, 'system', system_prompt)
                 
         except Exception as e:
+            if in_unit_of_work():
+                raise
             db.session.rollback()
             print(f"创建对话失败: {e}")
             return None
@@ -183,30 +351,46 @@ def save_completion(user_id, prompt, completion, model, max_tokens=None, tempera
     
     try:
         db.session.add(completion_record)
-        db.session.commit()
+        commit_changes()
         return completion_record
     except Exception as e:
+        if in_unit_of_work():
+            raise
         db.session.rollback()
         print(f"保存补全记录失败: {e}")
         return None
 
-def save_usage_record(user_id, api_type, model, tokens_used, cost=None, response_time=None, status='success'):
-    """保存使用记录"""
-    usage_record = UsageRecord(
-        user_id=user_id,
-        api_type=api_type,
-        model=model,
-        tokens_used=tokens_used,
-        cost=cost,
-        response_time=response_time,
-        status=status
-    )
+def save_usage_record(user_id, api_type, model, tokens_used, cost=None, response_time=None, status='success',
+                      cache_hit=None):
+    """保存使用记录并累加使用统计（启用异步写入器时只入队，不在请求线程中写库）
+    
+    未指定成本时按价格表估算。
+    """
+    metrics.record_tokens(api_type, model, tokens_used)
+    fields = {
+        'user_id': user_id,
+        'api_type': api_type,
+        'model': model,
+        'tokens_used': tokens_used,
+        'cost': cost if cost is not None else usage_stats.estimate_cost(model, tokens_used),
+        'response_time': response_time,
+        'status': status,
+        'cache_hit': cache_hit,
+        'created_at': datetime.utcnow()
+    }
+    if usage_writer.active:
+        return usage_writer.record(**fields)
+    
+    usage_record = UsageRecord(**fields)
     
     try:
         db.session.add(usage_record)
-        db.session.commit()
+        usage_stats.add([fields])
+        commit_changes()
         return usage_record
     except Exception as e:
+        if in_unit_of_work():
+            raise
         db.session.rollback()
         print(f"保存使用记录失败: {e}")
         return None
@@ -218,16 +402,52 @@ def get_user_conversations(user_id, limit=10):
         is_active=True
     ).order_by(Conversation.updated_at.desc()).limit(limit).all()
 
-def get_conversation_messages(conversation_id):
-    """获取对话的所有消息"""
-    return Message.query.filter_by(
-        conversation_id=conversation_id
-    ).order_by(Message.created_at.asc()).all()
+def get_user_conversation_summaries(user_id, limit=10, before=None):
+    """获取用户对话列表摘要：单条查询，只读取列表需要的列，不加载消息和完整system prompt
+    
+    按 (updated_at, id) 倒序，before 为上一页最后一条的 (updated_at, id)。
+    """
+    query = db.session.query(
+        Conversation.id,
+        Conversation.title,
+        Conversation.created_at,
+        Conversation.updated_at,
+        Conversation.message_count,
+        Conversation.last_message_at,
+        Conversation.last_message_preview,
+        func.substr(Conversation.system_prompt, 1, PREVIEW_LENGTH + 1).label('system_prompt_head')
+    ).filter(
+        Conversation.user_id == user_id,
+        Conversation.is_active == True
+    )
+    if before is not None:
+        query = query.filter(keyset_before(Conversation.updated_at, Conversation.id, before))
+    return query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit).all()
+
+def get_conversation_messages(conversation_id, after_id=None):
+    """获取对话的所有消息（指定after_id时只返回其后新增的消息）"""
+    query = Message.query.filter_by(conversation_id=conversation_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    return query.order_by(Message.created_at.asc(), Message.id.asc()).all()
+
+def get_conversation_message_page(conversation_id, limit=50, before=None):
+    """分页获取对话消息（不含system消息），从最新的消息往前翻
+    
+    before 为上一页最早一条的 (created_at, id)；返回按时间倒序排列的消息。
+    """
+    query = Message.query.filter(
+        Message.conversation_id == conversation_id,
+        Message.role != 'system'
+    )
+    if before is not None:
+        query = query.filter(keyset_before(Message.created_at, Message.id, before))
+    return query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit).all()
 
 def clear_user_conversations(user_id):
     """清除用户的所有对话"""
     try:
-        # 将对话标记为非活跃状态而不是删除
+        # 将对话标记为非活跃状态而不是删除，超过 ARCHIVE_INACTIVE_DAYS 天后由 archiver 归档
         conversations = Conversation.query.filter_by(user_id=user_id, is_active=True).all()
         for conv in conversations:
             conv.is_active = False
@@ -236,4 +456,143 @@ def clear_user_conversations(user_id):
     except Exception as e:
         db.session.rollback()
         print(f"清除对话失败: {e}")
-        return False 
\ No newline at end of file
+        return False 
+
+def create_batch_job(user_id, prompts, model, max_tokens=None, temperature=None, max_concurrency=3):
+    """创建批量处理任务及其全部条目"""
+    job = BatchJob(
+        user_id=user_id,
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        max_concurrency=max_concurrency,
+        total_items=len(prompts)
+    )
+    
+    try:
+        db.session.add(job)
+        db.session.flush()
+        # 条目可能上万条，用executemany批量插入而不是逐个构造ORM对象
+        db.session.execute(insert(BatchItem), [
+            {'job_id': job.id, 'index': index, 'prompt': prompt, 'status': 'pending', 'attempts': 0}
+            for index, prompt in enumerate(prompts)
+        ])
+        db.session.commit()
+        return job
+    except Exception as e:
+        db.session.rollback()
+        print(f"创建批量任务失败: {e}")
+        return None
+
+def get_batch_job(job_id, user_id=None):
+    """获取批量处理任务（可限定用户）"""
+    query = BatchJob.query.filter_by(id=job_id)
+    if user_id is not None:
+        query = query.filter_by(user_id=user_id)
+    return query.first()
+
+def get_user_batch_jobs(user_id, limit=10):
+    """获取用户最近的批量处理任务"""
+    return BatchJob.query.filter_by(
+        user_id=user_id
+    ).order_by(BatchJob.created_at.desc()).limit(limit).all()
+
+def get_batch_items(job_id, offset=0, limit=100, status=None):
+    """按提交顺序分页获取批量任务条目"""
+    query = BatchItem.query.filter_by(job_id=job_id)
+    if status:
+        query = query.filter_by(status=status)
+    return query.order_by(BatchItem.index.asc()).offset(offset).limit(limit).all()
+
+def save_batch_results(job_id, user_id, model, results):
+    """批量写入一组条目结果：条目、任务计数、心跳、使用记录和使用统计在同一事务中提交
+    
+    返回数据库中的任务状态，便于执行进程发现来自其他进程的取消请求。
+    """
+    completed = sum(1 for result in results if result['status'] == 'success')
+    tokens = sum(result['tokens_used'] or 0 for result in results)
+    
+    try:
+        if results:
+            db.session.bulk_update_mappings(BatchItem, results)
+            usage = [{
+                'user_id': user_id,
+                'api_type': 'batch',
+                'model': model,
+                'tokens_used': result['tokens_used'] or 0,
+                'cost': usage_stats.estimate_cost(model, result['tokens_used']),
+                'response_time': result['duration'] if result['status'] == 'success' else None,
+                'status': result['status'],
+                'created_at': result['finished_at']
+            } for result in results]
+            db.session.execute(insert(UsageRecord), usage)
+            usage_stats.add(usage)
+        
+        # 原子自增，避免与其他写入者互相覆盖
+        BatchJob.query.filter_by(id=job_id).update({
+            'completed_items': BatchJob.completed_items + completed,
+            'failed_items': BatchJob.failed_items + len(results) - completed,
+            'tokens_used': BatchJob.tokens_used + tokens,
+            'heartbeat_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        metrics.record_tokens('batch', model, tokens)
+    except Exception as e:
+        db.session.rollback()
+        print(f"保存批量结果失败: {e}")
+    
+    return db.session.query(BatchJob.status).filter_by(id=job_id).scalar()
+
+def cancel_batch_job(job):
+    """取消批量处理任务，未执行的条目不再处理"""
+    if job.finished:
+        return True
+    job.status = 'cancelled'
+    job.finished_at = datetime.utcnow()
+    try:
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"取消批量任务失败: {e}")
+        return False
+
+def claim_interrupted_batch_job(job):
+    """把中断的任务原子地改回运行中，同时收到多个恢复请求时只有一个能认领成功"""
+    try:
+        claimed = BatchJob.query.filter_by(id=job.id, status='interrupted').update({
+            'status': 'running',
+            'heartbeat_at': datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"恢复批量任务失败: {e}")
+        return False
+    db.session.refresh(job)
+    return claimed == 1
+
+def mark_stale_batch_job(job, timeout_seconds):
+    """心跳超时的运行中任务视为中断（执行进程已退出），未写入结果的条目仍为待处理
+    
+    按数据库中的心跳条件更新，其他进程刚认领或恢复的任务不会被改回中断。
+    """
+    if job.status not in ('pending', 'running'):
+        return False
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout_seconds)
+    if (job.heartbeat_at or job.created_at) >= cutoff:
+        return False
+    
+    try:
+        marked = BatchJob.query.filter(
+            BatchJob.id == job.id,
+            BatchJob.status.in_(('pending', 'running')),
+            or_(BatchJob.heartbeat_at < cutoff, and_(BatchJob.heartbeat_at.is_(None), BatchJob.created_at < cutoff))
+        ).update({'status': 'interrupted'}, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"标记中断任务失败: {e}")
+        return False
+    db.session.refresh(job)
+    return marked == 1
@@ -0,0 +1,83 @@
+"""
+数据库引擎配置
+
+SQLite：每个新连接建立时设置 WAL、busy_timeout、synchronous 和缓存大小，
+避免多个gunicorn worker并发写入时出现 "database is locked"。
+PostgreSQL：连接池参数由 config.engine_options 提供。
+启动时输出各worker实际生效的引擎设置。
+gunicorn预加载应用时，worker在fork后调用 dispose_engines 丢弃从主进程继承的连接。
+"""
+
+import logging
+import os
+
+from sqlalchemy import event, text
+
+from config import engine_options
+from models import db
+
+logger = logging.getLogger(__name__)
+
+
+def init_engine(app):
+    """在 db.init_app 之前调用：填充引擎参数"""
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+
+def install_sqlite_pragmas(app):
+    """在 db.init_app 之后调用：为SQLite连接注册PRAGMA设置"""
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}",
+        f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous = {app.config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA cache_size = {int(app.config['SQLITE_CACHE_SIZE'])}",
+        f"PRAGMA mmap_size = {int(app.config['SQLITE_MMAP_SIZE'])}",
+        "PRAGMA temp_store = MEMORY",
+    ]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', set_pragmas)
+
+
+def dispose_engines(app):
+    """fork后在子进程中调用：丢弃从父进程继承的连接（不关闭，父进程可能仍在使用）"""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def engine_report(app):
+    """读取当前worker实际生效的引擎设置"""
+    with app.app_context():
+        engine = db.engine
+        report = {'pid': os.getpid(), 'dialect': engine.dialect.name, 'pool': engine.pool.status()}
+
+        with engine.connect() as connection:
+            if engine.dialect.name == 'sqlite':
+                for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size'):
+                    report[pragma] = connection.execute(text(f'PRAGMA {pragma}')).scalar()
+            elif engine.dialect.name == 'postgresql':
+                report['statement_timeout'] = connection.execute(text('SHOW statement_timeout')).scalar()
+                report['pool_size'] = engine.pool.size()
+                report['max_overflow'] = app.config['SQLALCHEMY_ENGINE_OPTIONS'].get('max_overflow')
+
+        return report
+
+
+def log_engine_report(app):
+    try:
+        report = engine_report(app)
+        logger.info('数据库引擎设置: ' + ', '.join(f'{key}={value}' for key, value in report.items()))
+    except Exception as e:
+        logger.warning(f"读取数据库引擎设置失败: {e}")
@@ -0,0 +1,123 @@
+"""
+gunicorn生产环境配置：gunicorn -c gunicorn.conf.py（python run.py 即按此配置启动）
+
+两种worker模式（GUNICORN_WORKER_MODE）：
+- thread（默认）：gthread，每个进行中的上游调用占用一个线程；线程数按预期并发分摊到各worker，
+  并且不超过单个worker的数据库连接池容量，否则线程会在等待连接时超时。
+- async：uvicorn事件循环（asgi.py，需要安装uvicorn和asgiref），上游调用在事件循环中等待、不占数据库连接，
+  每个CPU一个worker。
+
+应用在主进程中预加载后再fork，worker共享只读内存、启动更快；fork后各worker丢弃从主进程
+继承的数据库连接和上游连接池。超时按最长的上游超时设置，重启worker时进行中的上游调用
+可以正常结束。默认不按请求数回收worker：批量任务在worker进程内执行，回收会中断进行中的任务。
+"""
+
+import math
+import os
+import time
+
+from config import config as _app_configs, engine_options as _engine_options
+
+_started = time.monotonic()
+_app_config = _app_configs[os.environ.get('FLASK_ENV') or 'development']
+_cpus = os.cpu_count() or 1
+_async_mode = (os.environ.get('GUNICORN_WORKER_MODE') or 'thread').lower() == 'async'
+
+
+def _pool_capacity():
+    """单个worker的数据库连接池容量（pool_size + max_overflow，SQLAlchemy默认为 5 + 10）"""
+    options = _engine_options({key: getattr(_app_config, key) for key in dir(_app_config) if key.isupper()})
+    return options.get('pool_size', 5) + options.get('max_overflow', 10)
+
+
+# 监听地址
+bind = os.environ.get('GUNICORN_BIND') or f"0.0.0.0:{os.environ.get('PORT') or 5000}"
+backlog = 2048
+
+# worker模式与数量
+if _async_mode:
+    wsgi_app = 'asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    workers = int(os.environ.get('GUNICORN_WORKERS') or _cpus)
+    threads = 1
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    workers = int(os.environ.get('GUNICORN_WORKERS') or _cpus * 2 + 1)
+    # 预期同时进行的请求数（大多在等待上游），平均分摊到各worker
+    _concurrency = int(os.environ.get('GUNICORN_CONCURRENCY') or 64)
+    threads = int(os.environ.get('GUNICORN_THREADS') or
+                  max(2, min(math.ceil(_concurrency / workers), _pool_capacity())))
+
+# 预加载应用，fork后在 post_fork 中重置继承的连接
+preload_app = True
+
+# 超时：按最长的上游超时加余量，重启和回收worker时等待进行中的上游调用结束
+_upstream_timeout = max(
+    _app_config.CHAT_UPSTREAM_TIMEOUT,
+    _app_config.COMPLETION_UPSTREAM_TIMEOUT,
+    _app_config.ASSISTANT_UPSTREAM_TIMEOUT
+)
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or _upstream_timeout + 30)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or _upstream_timeout + 10)
+keepalive = 5
+
+# 处理一定数量请求后回收worker（加随机抖动避免所有worker同时重启），默认关闭：
+# 批量任务由worker进程内的线程执行，worker退出后任务在心跳超时后变为中断状态，需要用户手动恢复
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 0)
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER') or max_requests // 10)
+
+# worker心跳文件放在内存文件系统，避免磁盘IO阻塞心跳
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# 日志
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or '-'
+errorlog = '-'
+loglevel = _app_config.LOG_LEVEL.lower()
+
+
+def on_starting(server):
+    # 多进程指标目录需要在每次启动时清空，否则会汇总上次运行留下的数据
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory and os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.db'):
+                os.remove(os.path.join(directory, name))
+
+
+def when_ready(server):
+    server.log.info(
+        f"worker模式: {worker_class}, workers={workers}, threads={threads}, "
+        f"timeout={timeout}s, graceful_timeout={graceful_timeout}s, max_requests={max_requests}"
+    )
+    if max_requests:
+        server.log.warning("已启用 max_requests：回收worker会中断该worker中执行的批量任务（需要用户手动恢复）")
+    # 启动耗时（含预加载应用），用于发现启动变慢；各模块的导入耗时见 benchmarks/startup_time.py
+    server.log.info(f"主进程启动耗时 {time.monotonic() - _started:.2f}s")
+
+
+def pre_fork(server, worker):
+    worker.fork_started = time.monotonic()
+
+
+def post_fork(server, worker):
+    from app import app, start_prewarm
+    from db_engine import dispose_engines
+    from openai_clients import client_pool
+
+    dispose_engines(app)
+    client_pool.after_fork()
+    if not _async_mode:  # 异步模式由 asgi.py 在lifespan启动时预热
+        start_prewarm(app)
+
+
+def post_worker_init(worker):
+    # worker从fork到可以处理请求的耗时，决定扩容和回收worker时的空窗
+    worker.log.info(f"worker {worker.pid} 启动耗时 {time.monotonic() - worker.fork_started:.2f}s")
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+
+    mark_process_dead(worker.pid)
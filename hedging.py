@@ -0,0 +1,274 @@
+"""
+对冲请求（hedged requests）
+
+按路由和模型记录最近的上游延迟。第一次尝试在P95延迟内仍未返回（流式请求为未收到首个分块）时，
+再发出一次相同的请求，取先完成的结果，另一个结果被丢弃（流式响应会被关闭），
+因此只会保存一份结果。少量异常缓慢的上游调用不再决定整体的尾延迟。
+同步调用无法中途取消，被丢弃的尝试会执行到结束，结束后按实际用量修正对冲预扣的额度。
+对冲尝试同样消耗上游额度：线程池没有空闲线程或限流额度不足时不对冲，继续等待第一次尝试。
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from rate_limiter import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyWindow:
+    """最近N次成功调用的延迟"""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+
+class Hedger:
+    """对冲请求执行器，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._windows = {}  # (route, model) -> LatencyWindow
+        self._executor = None
+        self._lock = threading.Lock()
+        self._running = 0  # 线程池中执行的尝试数
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['HEDGE_ENABLED']
+        self.percent = app.config['HEDGE_PERCENTILE']
+        self.min_samples = app.config['HEDGE_MIN_SAMPLES']
+        self.min_delay = app.config['HEDGE_MIN_DELAY']
+        self.window_size = app.config['HEDGE_WINDOW_SIZE']
+        self.max_workers = app.config['HEDGE_MAX_WORKERS']
+        app.extensions['hedger'] = self
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='hedge')
+            return self._executor
+
+    def _window(self, route, model):
+        with self._lock:
+            window = self._windows.get((route, model))
+            if window is None:
+                window = self._windows[(route, model)] = LatencyWindow(self.window_size)
+            return window
+
+    def threshold(self, route, model):
+        """触发对冲的等待时间：最近延迟的P95，样本不足时返回None（不对冲）"""
+        window = self._window(route, model)
+        if len(window.samples) < self.min_samples:
+            return None
+        return max(self.min_delay, window.percentile(self.percent))
+
+    def call(self, route, model, fn, discard=None, reserve=None):
+        """执行 fn，超过阈值未完成时发出第二次尝试；discard 用于释放被丢弃的结果
+
+        两次尝试都在线程池中执行，只在有空闲线程时提交（不排队，等待时间从真正发出请求时算起），
+        线程池已满时在当前线程中直接执行、不对冲。被丢弃的尝试无法取消，会执行到结束，
+        结束后再调用 discard 释放结果。reserve 在发出对冲前为其预扣限流额度，返回修正额度的函数
+        settle(result)：对冲尝试失败时以 None 调用（退回额度），被丢弃的尝试结束后以其结果调用
+        （按实际用量修正）；额度不足时抛出 RateLimitExceeded。
+        """
+        window = self._window(route, model)
+
+        def attempt():
+            start = time.monotonic()
+            result = fn()
+            window.add(time.monotonic() - start)
+            return result
+
+        delay = self.threshold(route, model) if self.enabled else None
+        if delay is None:
+            return attempt()
+
+        first = self._spawn(attempt)
+        if first is None:
+            return attempt()
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        settle = self._reserve(reserve)
+        second = self._submit(route, model, delay, attempt, settle)
+        if second is None:
+            return first.result()
+        pending = {first, second}
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                if winner is second:
+                    with self._lock:
+                        self.hedge_wins += 1
+                for loser in ({first, second} - {winner}):
+                    self._discard(loser, discard, settle)
+                return winner.result()
+
+        # 两次尝试都失败，抛出第一次尝试的异常
+        raise first.exception()
+
+    def _spawn(self, fn):
+        """线程池有空闲线程时提交 fn，否则返回None；提交的任务不会在队列中等待"""
+        with self._lock:
+            if self._running >= self.max_workers:
+                self.skipped += 1
+                return None
+            self._running += 1
+
+        def run():
+            try:
+                return fn()
+            finally:
+                with self._lock:
+                    self._running -= 1
+
+        return self.executor.submit(run)
+
+    def _submit(self, route, model, delay, attempt, settle):
+        """限流额度足够且线程池有空闲线程时提交对冲尝试，否则返回None"""
+        if settle is None:
+            return None
+
+        def hedge():
+            try:
+                return attempt()
+            except Exception:
+                settle(None)
+                raise
+
+        future = self._spawn(hedge)
+        if future is None:
+            settle(None)
+            return None
+        self._hedging(route, model, delay)
+        return future
+
+    def _reserve(self, reserve):
+        """为对冲尝试预扣限流额度，返回修正额度的函数；额度不足时返回None（不对冲）"""
+        if reserve is None:
+            return lambda result: None
+        try:
+            return reserve()
+        except RateLimitExceeded:
+            with self._lock:
+                self.skipped += 1
+            return None
+
+    def _hedging(self, route, model, delay):
+        with self._lock:
+            self.hedged += 1
+        logger.info(f"上游响应超过 {delay:.2f}s，发出对冲请求 - 路由: {route}, 模型: {model}")
+
+    async def call_async(self, route, model, fn, discard=None, reserve=None):
+        """call 的异步版本：fn 返回协程，discard 为释放被丢弃结果的协程函数"""
+        window = self._window(route, model)
+
+        async def attempt():
+            start = time.monotonic()
+            result = await fn()
+            window.add(time.monotonic() - start)
+            return result
+
+        delay = self.threshold(route, model) if self.enabled else None
+        if delay is None:
+            return await attempt()
+
+        first = asyncio.ensure_future(attempt())
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        settle = self._reserve(reserve)
+        if settle is None:
+            return await first
+
+        async def hedge():
+            try:
+                return await attempt()
+            except Exception:
+                settle(None)
+                raise
+
+        self._hedging(route, model, delay)
+        second = asyncio.ensure_future(hedge())
+        pending = {first, second}
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is not None:
+                if winner is second:
+                    with self._lock:
+                        self.hedge_wins += 1
+                for loser in ({first, second} - {winner}):
+                    self._discard_async(loser, discard, settle)
+                return winner.result()
+
+        raise first.exception()
+
+    @staticmethod
+    def _discard_async(task, discard, settle):
+        """取消未完成的尝试（实际用量未知，保留预扣额度）；已完成的结果按实际用量修正后释放"""
+        if not task.done():
+            task.cancel()
+            return
+        if task.exception() is not None:
+            settle(None)
+            return
+        if discard is not None:
+            asyncio.ensure_future(discard(task.result()))
+        settle(task.result())
+
+    @staticmethod
+    def _discard(future, discard, settle):
+        """被丢弃的尝试执行到结束后释放结果，并按实际用量修正对冲预扣的额度"""
+        def release(finished):
+            if finished.exception() is not None:
+                settle(None)
+                return
+            if discard is not None:
+                try:
+                    discard(finished.result())
+                except Exception as e:
+                    logger.warning(f"释放对冲请求结果失败: {e}")
+            settle(finished.result())
+
+        future.add_done_callback(release)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'skipped': self.skipped,
+                'p95': {
+                    f'{route}:{model}': window.percentile(self.percent)
+                    for (route, model), window in self._windows.items()
+                }
+            }
+
+
+hedger = Hedger()
@@ -0,0 +1,179 @@
+"""
+按内容寻址的图片存储
+
+上传的图片按块流式写入磁盘并同时计算SHA-256，哈希值即图片ID，相同图片只存一份。
+保存前按视觉模型实际使用的分辨率缩小（长边不超过2048，短边不超过768）并重新编码，
+聊天请求只需引用图片ID，不再在JSON里携带几MB的base64数据，上游图片token也随之减少。
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 可选依赖，未安装时按原图保存，不做缩放
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMAGE_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+CONTENT_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp'
+}
+
+
+class ImageError(ValueError):
+    """图片过大、格式不支持或无法解析"""
+
+
+def sniff_extension(header):
+    """根据文件头识别图片格式"""
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class ImageStore:
+    """图片存储，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, app=None):
+        self.directory = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['IMAGE_STORE_DIR'] or os.path.join(app.instance_path, 'images')
+        self.max_bytes = app.config['IMAGE_MAX_BYTES']
+        self.max_side = app.config['IMAGE_MAX_SIDE']
+        self.short_side = app.config['IMAGE_SHORT_SIDE']
+        self.jpeg_quality = app.config['IMAGE_JPEG_QUALITY']
+        app.extensions['image_store'] = self
+
+    def save(self, stream):
+        """从文件流保存图片，返回图片信息；已存在的相同图片直接返回"""
+        os.makedirs(self.directory, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        header = b''
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.upload')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                while True:
+                    chunk = stream.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ImageError(f'图片超过 {self.max_bytes // (1024 * 1024)}MB 大小限制')
+                    if len(header) < 16:
+                        header += chunk[:16]
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+
+            extension = sniff_extension(header)
+            if extension is None:
+                raise ImageError('不支持的图片格式，仅支持 jpg、png、gif、webp')
+
+            image_id = digest.hexdigest()
+            existing = self.path(image_id)
+            if existing:
+                return self.info(image_id)
+
+            if Image is not None:
+                data, extension = self._downscale(temp_path)
+                self._write(image_id, extension, data)
+            else:
+                os.replace(temp_path, self._path_for(image_id, extension))
+            return self.info(image_id, original_bytes=size)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _downscale(self, path):
+        """缩小到视觉模型使用的分辨率并重新编码，返回 (数据, 扩展名)"""
+        try:
+            with Image.open(path) as image:
+                image = ImageOps.exif_transpose(image)  # 按EXIF方向旋转，动图只保留第一帧
+                width, height = image.size
+                scale = min(1.0, self.max_side / max(width, height), self.short_side / min(width, height))
+                if scale < 1.0:
+                    image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+
+                output = io.BytesIO()
+                if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                    image.save(output, format='PNG', optimize=True)
+                    return output.getvalue(), 'png'
+                image.convert('RGB').save(output, format='JPEG', quality=self.jpeg_quality, optimize=True)
+                return output.getvalue(), 'jpg'
+        except ImageError:
+            raise
+        except Exception as e:
+            raise ImageError(f'无法解析图片: {e}')
+
+    def _path_for(self, image_id, extension):
+        directory = os.path.join(self.directory, image_id[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'{image_id}.{extension}')
+
+    def _write(self, image_id, extension, data):
+        # 先写临时文件再原子替换，并发上传同一图片时不会读到半个文件
+        target = self._path_for(image_id, extension)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, target)
+
+    def path(self, image_id):
+        """图片文件路径，不存在或ID格式无效时返回None"""
+        if not image_id or not IMAGE_ID_PATTERN.match(image_id):
+            return None
+        for extension in CONTENT_TYPES:
+            candidate = os.path.join(self.directory, image_id[:2], f'{image_id}.{extension}')
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def info(self, image_id, original_bytes=None):
+        path = self.path(image_id)
+        extension = path.rsplit('.', 1)[1]
+        info = {
+            'id': image_id,
+            'content_type': CONTENT_TYPES[extension],
+            'bytes': os.path.getsize(path)
+        }
+        if original_bytes is not None:
+            info['original_bytes'] = original_bytes
+        if Image is not None:
+            with Image.open(path) as image:
+                info['width'], info['height'] = image.size
+        return info
+
+    def data_url(self, image_id):
+        """以data URL形式读取图片，用于发送给上游；图片不存在时抛出ImageError"""
+        path = self.path(image_id)
+        if path is None:
+            raise ImageError(f'图片不存在: {image_id}')
+        with open(path, 'rb') as image_file:
+            encoded = base64.b64encode(image_file.read()).decode()
+        return f"data:{CONTENT_TYPES[path.rsplit('.', 1)[1]]};base64,{encoded}"
+
+
+image_store = ImageStore()
@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 """
 数据库初始化脚本
-运行此脚本来创建数据库表
+运行此脚本来创建或升级数据库表（已有数据库会原地升级，不丢失数据）
+
+    python init_db.py          # 执行全部迁移
+    python init_db.py --reset  # 删除所有表后重建（会清空数据）
 """
 
 import os
 import sys
 from flask import Flask
+from flask_migrate import Migrate, upgrade
 from config import config
+from db_engine import init_engine, install_sqlite_pragmas
 from models import db, SystemConfig
 
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
 def create_app():
     """创建Flask应用"""
     app = Flask(__name__)
@@ -19,11 +26,14 @@ def create_app():
     app.config.from_object(config[config_name])
     
     # 初始化数据库
+    init_engine(app)
     db.init_app(app)
+    install_sqlite_pragmas(app)
+    Migrate(app, db, directory=MIGRATIONS_DIR, render_as_batch=True)
     
     return app
 
-def main():
+def main(reset=False):
     """主函数"""
     print("开始初始化数据库...")
     
@@ -33,15 +43,18 @@ def main():
     # 初始化数据库
     with app.app_context():
         try:
-            # 删除现有表（如果存在）
-            print("删除现有数据库表...")
-            db.drop_all()
-            print("已删除现有数据库表")
+            if reset:
+                # 删除现有表（包括迁移版本记录）
+                print("删除现有数据库表...")
+                db.drop_all()
+                db.session.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+                db.session.commit()
+                print("已删除现有数据库表")
             
-            # 创建所有表
-            print("创建数据库表...")
-            db.create_all()
-            print("数据库表创建成功！")
+            # 执行数据库迁移（已有数据库原地升级）
+            print("执行数据库迁移...")
+            upgrade(directory=MIGRATIONS_DIR)
+            print("数据库表结构已是最新！")
             
             # 插入一些初始配置
             print("插入初始配置...")
@@ -68,9 +81,9 @@ def main():
             print(f"数据库文件: {app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')}")
             
             # 显示表信息
-            print("\n已创建的数据库表:")
-            from models import User, Conversation, Message, Completion, UsageRecord
-            tables = [User, Conversation, Message, Completion, UsageRecord, SystemConfig]
+            print("\n数据库表:")
+            from models import User, Conversation, Message, Completion, UsageRecord, UsageRollup, BatchJob, BatchItem
+            tables = [User, Conversation, Message, Completion, UsageRecord, UsageRollup, BatchJob, BatchItem, SystemConfig]
             for table in tables:
                 print(f"- {table.__tablename__}")
             
@@ -80,9 +93,9 @@ def main():
             return False
         
     print("\n数据库初始化完成！")
-    print("现在您可以运行应用了: python app.py")
+    print("现在您可以运行应用了: python run.py")
     return True
 
 if __name__ == '__main__':
-    success = main()
+    success = main(reset='--reset' in sys.argv)
     sys.exit(0 if success else 1) 
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Prometheus指标
+
+按路由和模型记录请求延迟，并把每个请求的耗时拆分为上游调用时间和数据库时间；
+另有token计数、按异常类型的错误计数、进行中请求数和数据库连接池状态。
+设置环境变量 PROMETHEUS_MULTIPROC_DIR 后使用 prometheus_client 的多进程模式，
+gunicorn 各worker写入同一目录，/metrics 汇总所有worker的数据；worker退出时需调用 mark_process_dead。
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+try:
+    from prometheus_client import (
+        CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+    )
+except ImportError:  # 可选依赖，未安装时不采集指标
+    CollectorRegistry = None
+
+logger = logging.getLogger(__name__)
+
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def multiprocess_mode():
+    return bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+
+def mark_process_dead(pid):
+    """gunicorn worker退出时清理其进程级指标文件（在 child_exit 钩子中调用）"""
+    if CollectorRegistry is not None and multiprocess_mode():
+        multiprocess.mark_process_dead(pid)
+
+
+class Metrics:
+    """指标采集，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._models = set()
+        self._lock = threading.Lock()
+        self._engines = set()
+        self.registry = None
+        if CollectorRegistry is not None:
+            self._create_metrics()
+        if app is not None:
+            self.init_app(app)
+
+    def _create_metrics(self):
+        registry = self.registry = CollectorRegistry()
+        self.request_seconds = Histogram(
+            'endless_request_seconds', '请求总耗时', ['route', 'method', 'status', 'model'],
+            buckets=REQUEST_BUCKETS, registry=registry
+        )
+        self.request_upstream_seconds = Histogram(
+            'endless_request_upstream_seconds', '单个请求中等待上游的耗时', ['route', 'model'],
+            buckets=REQUEST_BUCKETS, registry=registry
+        )
+        self.request_db_seconds = Histogram(
+            'endless_request_db_seconds', '单个请求中执行SQL的耗时', ['route'],
+            buckets=QUERY_BUCKETS, registry=registry
+        )
+        self.upstream_seconds = Histogram(
+            'endless_upstream_seconds', '上游调用耗时（含重试和对冲，流式请求到首个分块为止）',
+            ['route', 'model', 'outcome'], buckets=REQUEST_BUCKETS, registry=registry
+        )
+        self.query_seconds = Histogram(
+            'endless_db_query_seconds', '单条SQL的执行耗时', buckets=QUERY_BUCKETS, registry=registry
+        )
+        self.tokens = Counter(
+            'endless_tokens', '使用记录中的token数', ['api_type', 'model'], registry=registry
+        )
+        self.errors = Counter(
+            'endless_errors', '请求处理中的错误数', ['route', 'exception'], registry=registry
+        )
+        self.in_flight = Gauge(
+            'endless_requests_in_flight', '进行中的请求数', ['route'],
+            multiprocess_mode='livesum', registry=registry
+        )
+        self.upstream_in_flight = Gauge(
+            'endless_upstream_in_flight', '进行中的上游调用数',
+            multiprocess_mode='livesum', registry=registry
+        )
+        self.pool_connections = Gauge(
+            'endless_db_pool_connections', '数据库连接池状态（各worker之和）', ['state'],
+            multiprocess_mode='livesum', registry=registry
+        )
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED'] and self.registry is not None
+        self.max_models = app.config['METRICS_MAX_MODELS']
+        if app.config['METRICS_ENABLED'] and self.registry is None:
+            logger.warning("未安装 prometheus_client，/metrics 不可用")
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+            app.teardown_request(self._teardown_request)
+            with app.app_context():
+                self._instrument_engine(db.engine)
+        app.extensions['metrics'] = self
+
+    def _instrument_engine(self, engine):
+        if engine in self._engines:
+            return
+        self._engines.add(engine)
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get('metrics_query_start')
+            if not starts:
+                return
+            elapsed = time.perf_counter() - starts.pop()
+            self.query_seconds.observe(elapsed)
+            if has_request_context() and 'metrics_start' in g:
+                g.metrics_db_seconds += elapsed
+
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    @staticmethod
+    def _route():
+        rule = request.url_rule
+        return rule.rule if rule is not None else 'unmatched'
+
+    def model_label(self, model):
+        """模型名来自客户端，超过上限的新模型归为 other，避免标签无限增长"""
+        if not model:
+            return ''
+        if not isinstance(model, str):
+            return 'other'
+        with self._lock:
+            if model in self._models:
+                return model
+            if len(self._models) < self.max_models:
+                self._models.add(model)
+                return model
+        return 'other'
+
+    def set_model(self, model):
+        """标记当前请求使用的模型"""
+        if self.enabled and has_request_context():
+            g.metrics_model = self.model_label(model)
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_route = self._route()
+        g.metrics_db_seconds = 0.0
+        g.metrics_upstream_seconds = 0.0
+        g.metrics_model = ''
+        self.in_flight.labels(g.metrics_route).inc()
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, error=None):
+        if 'metrics_start' not in g:
+            return
+        route = g.metrics_route
+        status = 500 if error is not None else g.get('metrics_status', 500)
+        if error is not None:
+            self.errors.labels(route, type(error).__name__).inc()
+
+        self.in_flight.labels(route).dec()
+        self.request_seconds.labels(route, request.method, str(status), g.metrics_model).observe(
+            time.perf_counter() - g.metrics_start
+        )
+        self.request_db_seconds.labels(route).observe(g.metrics_db_seconds)
+        if g.metrics_upstream_seconds:
+            self.request_upstream_seconds.labels(route, g.metrics_model).observe(g.metrics_upstream_seconds)
+        self._update_pool()
+        g.pop('metrics_start')
+
+    def _update_pool(self):
+        pool = db.engine.pool
+        for state, method in (('checked_out', 'checkedout'), ('checked_in', 'checkedin'),
+                              ('overflow', 'overflow'), ('size', 'size')):
+            if hasattr(pool, method):
+                # QueuePool.overflow() 在未用满时为负数，表示还可创建的连接数
+                self.pool_connections.labels(state).set(max(0, getattr(pool, method)()))
+
+    @contextmanager
+    def upstream(self, model, route=None):
+        """统计一次上游调用的耗时，并计入当前请求的上游时间"""
+        if not self.enabled:
+            yield
+            return
+        in_request = has_request_context() and 'metrics_start' in g
+        route = route or (g.metrics_route if in_request else 'background')
+        outcome = 'success'
+        start = time.perf_counter()
+        self.upstream_in_flight.inc()
+        try:
+            yield
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.upstream_in_flight.dec()
+            self.upstream_seconds.labels(route, self.model_label(model), outcome).observe(elapsed)
+            if in_request:
+                g.metrics_upstream_seconds += elapsed
+
+    def record_tokens(self, api_type, model, tokens):
+        if self.enabled and tokens:
+            self.tokens.labels(api_type, self.model_label(model)).inc(tokens)
+
+    def record_error(self, error):
+        """记录被路由捕获并转换为错误响应的异常"""
+        if self.enabled:
+            route = self._route() if has_request_context() else 'background'
+            self.errors.labels(route, type(error).__name__).inc()
+
+    def render(self):
+        """返回 (指标文本, Content-Type)，多进程模式下汇总所有worker"""
+        if multiprocess_mode():
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = self.registry
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+metrics = Metrics()
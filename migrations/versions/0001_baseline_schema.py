@@ -0,0 +1,119 @@
+"""baseline schema
+
+Revision ID: 0001
+Revises: 
+Create Date: 2026-10-18 10:00:00
+
+已有数据库（由 init_db.py / create_all 创建）中表已存在，此时跳过建表，
+直接在原库上继续执行后续迁移。
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def has_table(name):
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not has_table('users'):
+        op.create_table(
+            'users',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('api_key_hash', sa.String(length=255), nullable=False),
+            sa.Column('api_key_masked', sa.String(length=50), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('last_login', sa.DateTime(), nullable=True),
+            sa.Column('is_active', sa.Boolean(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('api_key_hash')
+        )
+
+    if not has_table('system_configs'):
+        op.create_table(
+            'system_configs',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('key', sa.String(length=100), nullable=False),
+            sa.Column('value', sa.Text(), nullable=True),
+            sa.Column('description', sa.String(length=255), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('key')
+        )
+
+    if not has_table('conversations'):
+        op.create_table(
+            'conversations',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(length=200), nullable=True),
+            sa.Column('system_prompt', sa.Text(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('updated_at', sa.DateTime(), nullable=True),
+            sa.Column('is_active', sa.Boolean(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if not has_table('messages'):
+        op.create_table(
+            'messages',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('conversation_id', sa.Integer(), nullable=False),
+            sa.Column('role', sa.String(length=20), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('model', sa.String(length=50), nullable=True),
+            sa.Column('tokens_used', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['conversation_id'], ['conversations.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if not has_table('completions'):
+        op.create_table(
+            'completions',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('prompt', sa.Text(), nullable=False),
+            sa.Column('completion', sa.Text(), nullable=False),
+            sa.Column('model', sa.String(length=50), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('max_tokens', sa.Integer(), nullable=True),
+            sa.Column('temperature', sa.Float(), nullable=True),
+            sa.Column('tokens_used', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if not has_table('usage_records'):
+        op.create_table(
+            'usage_records',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('api_type', sa.String(length=20), nullable=False),
+            sa.Column('model', sa.String(length=50), nullable=False),
+            sa.Column('tokens_used', sa.Integer(), nullable=False),
+            sa.Column('cost', sa.Float(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('response_time', sa.Float(), nullable=True),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('usage_records')
+    op.drop_table('completions')
+    op.drop_table('messages')
+    op.drop_table('conversations')
+    op.drop_table('system_configs')
+    op.drop_table('users')
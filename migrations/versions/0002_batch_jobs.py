@@ -0,0 +1,71 @@
+"""batch jobs
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 10:10:00
+
+服务端批量处理任务表。
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def has_table(name):
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not has_table('batch_jobs'):
+        op.create_table(
+            'batch_jobs',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('started_at', sa.DateTime(), nullable=True),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+            sa.Column('model', sa.String(length=50), nullable=False),
+            sa.Column('max_tokens', sa.Integer(), nullable=True),
+            sa.Column('temperature', sa.Float(), nullable=True),
+            sa.Column('max_concurrency', sa.Integer(), nullable=True),
+            sa.Column('total_items', sa.Integer(), nullable=True),
+            sa.Column('completed_items', sa.Integer(), nullable=True),
+            sa.Column('failed_items', sa.Integer(), nullable=True),
+            sa.Column('tokens_used', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id')
+        )
+
+    if not has_table('batch_items'):
+        op.create_table(
+            'batch_items',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('job_id', sa.Integer(), nullable=False),
+            sa.Column('index', sa.Integer(), nullable=False),
+            sa.Column('prompt', sa.Text(), nullable=False),
+            sa.Column('status', sa.String(length=20), nullable=True),
+            sa.Column('response', sa.Text(), nullable=True),
+            sa.Column('error', sa.Text(), nullable=True),
+            sa.Column('attempts', sa.Integer(), nullable=True),
+            sa.Column('tokens_used', sa.Integer(), nullable=True),
+            sa.Column('duration', sa.Float(), nullable=True),
+            sa.Column('finished_at', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['job_id'], ['batch_jobs.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('job_id', 'index', name='uq_batch_items_job_index')
+        )
+        op.create_index('ix_batch_items_job_status', 'batch_items', ['job_id', 'status'])
+
+
+def downgrade():
+    op.drop_index('ix_batch_items_job_status', table_name='batch_items')
+    op.drop_table('batch_items')
+    op.drop_table('batch_jobs')
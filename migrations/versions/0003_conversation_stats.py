@@ -0,0 +1,55 @@
+"""conversation message stats
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:20:00
+
+对话表增加消息统计列，并根据已有消息回填。
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def has_column(table, column):
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    with op.batch_alter_table('conversations') as batch_op:
+        if not has_column('conversations', 'message_count'):
+            batch_op.add_column(sa.Column('message_count', sa.Integer(), nullable=False, server_default='0'))
+        if not has_column('conversations', 'last_message_at'):
+            batch_op.add_column(sa.Column('last_message_at', sa.DateTime(), nullable=True))
+        if not has_column('conversations', 'last_message_preview'):
+            batch_op.add_column(sa.Column('last_message_preview', sa.String(length=100), nullable=True))
+
+    # 回填：updated_at保持不变，避免改变对话排序
+    op.execute("""
+        UPDATE conversations SET
+            message_count = (
+                SELECT COUNT(*) FROM messages WHERE messages.conversation_id = conversations.id
+            ),
+            last_message_at = (
+                SELECT MAX(created_at) FROM messages WHERE messages.conversation_id = conversations.id
+            ),
+            last_message_preview = (
+                SELECT SUBSTR(content, 1, 100) FROM messages
+                WHERE messages.conversation_id = conversations.id
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            ),
+            updated_at = updated_at
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('conversations') as batch_op:
+        batch_op.drop_column('last_message_preview')
+        batch_op.drop_column('last_message_at')
+        batch_op.drop_column('message_count')
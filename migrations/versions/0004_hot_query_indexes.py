@@ -0,0 +1,44 @@
+"""indexes for hot queries
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 10:30:00
+
+与热点查询匹配的复合索引：
+- get_conversation_messages: messages(conversation_id, created_at)
+- get_user_conversations / get_active_conversation: conversations(user_id, is_active, updated_at)
+- 使用统计: usage_records(user_id, created_at)
+- 补全记录、批量任务按用户按时间查询
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_conversation_created', 'messages', ['conversation_id', 'created_at']),
+    ('ix_conversations_user_active_updated', 'conversations', ['user_id', 'is_active', 'updated_at']),
+    ('ix_usage_records_user_created', 'usage_records', ['user_id', 'created_at']),
+    ('ix_completions_user_created', 'completions', ['user_id', 'created_at']),
+    ('ix_batch_jobs_user_created', 'batch_jobs', ['user_id', 'created_at']),
+]
+
+
+def existing_indexes(table):
+    return {index['name'] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        if name not in existing_indexes(table):
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,40 @@
+"""response cache columns
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 11:00:00
+
+用户表增加补全响应缓存开关，使用记录增加缓存命中标记。
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def has_column(table, column):
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        if not has_column('users', 'response_cache_enabled'):
+            batch_op.add_column(sa.Column('response_cache_enabled', sa.Boolean(), nullable=False,
+                                          server_default=sa.true()))
+
+    with op.batch_alter_table('usage_records') as batch_op:
+        if not has_column('usage_records', 'cache_hit'):
+            batch_op.add_column(sa.Column('cache_hit', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('usage_records') as batch_op:
+        batch_op.drop_column('cache_hit')
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('response_cache_enabled')
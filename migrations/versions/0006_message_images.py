@@ -0,0 +1,32 @@
+"""message image references
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 11:30:00
+
+消息表增加引用的图片ID列表（图片本身保存在按内容寻址的图片存储中）。
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def has_column(table, column):
+    return column in [c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)]
+
+
+def upgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        if not has_column('messages', 'image_ids'):
+            batch_op.add_column(sa.Column('image_ids', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('image_ids')
@@ -0,0 +1,163 @@
+"""usage rollups
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 12:00:00
+
+使用统计汇总表（按用户、模型和小时/天累加），并根据已有使用记录回填。
+回填使用本文件中固定的价格表和汇总逻辑（与编写时的 usage_stats.py 一致），不依赖应用代码。
+"""
+from bisect import bisect_left
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+LATENCY_BOUNDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+LATENCY_BUCKETS = len(LATENCY_BOUNDS) + 1
+BACKFILL_BATCH_SIZE = 5000
+
+# 回填时未记录成本的使用记录按此价格表估算（美元/百万token：输入, 输出），输入按3/4折算
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'gpt-3.5-turbo-instruct': (1.5, 2.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-4-32k': (60.0, 120.0),
+    'gpt-4-0125-preview': (10.0, 30.0),
+    'gpt-4-1106-preview': (10.0, 30.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4-vision-preview': (10.0, 30.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4.1': (2.0, 8.0),
+    'gpt-4.1-mini': (0.4, 1.6),
+    'gpt-4.1-nano': (0.1, 0.4),
+}
+INPUT_SHARE = 0.75
+ERROR_STATUSES = ('error', 'rate_limited')
+KEY_COLUMNS = ('user_id', 'period', 'bucket_start', 'model')
+LATENCY_COLUMNS = tuple(f'latency_{index}' for index in range(LATENCY_BUCKETS))
+COUNTER_COLUMNS = ('request_count', 'error_count', 'cache_hits', 'tokens_used', 'cost', 'latency_sum') + LATENCY_COLUMNS
+
+usage_records = sa.table(
+    'usage_records',
+    sa.column('id', sa.Integer()),
+    sa.column('user_id', sa.Integer()),
+    sa.column('model', sa.String()),
+    sa.column('tokens_used', sa.Integer()),
+    sa.column('cost', sa.Float()),
+    sa.column('response_time', sa.Float()),
+    sa.column('status', sa.String()),
+    sa.column('cache_hit', sa.Boolean()),
+    sa.column('created_at', sa.DateTime())
+)
+
+usage_rollups = sa.table(
+    'usage_rollups',
+    sa.column('user_id', sa.Integer()),
+    sa.column('period', sa.String()),
+    sa.column('bucket_start', sa.DateTime()),
+    sa.column('model', sa.String()),
+    *[sa.column(column, sa.Float() if column in ('cost', 'latency_sum') else sa.Integer())
+      for column in COUNTER_COLUMNS]
+)
+
+
+def has_table(name):
+    return sa.inspect(op.get_bind()).has_table(name)
+
+
+def upgrade():
+    if not has_table('usage_rollups'):
+        op.create_table(
+            'usage_rollups',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('period', sa.String(length=10), nullable=False),
+            sa.Column('bucket_start', sa.DateTime(), nullable=False),
+            sa.Column('model', sa.String(length=50), nullable=False),
+            sa.Column('request_count', sa.Integer(), nullable=False),
+            sa.Column('error_count', sa.Integer(), nullable=False),
+            sa.Column('cache_hits', sa.Integer(), nullable=False),
+            sa.Column('tokens_used', sa.Integer(), nullable=False),
+            sa.Column('cost', sa.Float(), nullable=False),
+            sa.Column('latency_sum', sa.Float(), nullable=False),
+            *[sa.Column(f'latency_{index}', sa.Integer(), nullable=False) for index in range(LATENCY_BUCKETS)],
+            sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('user_id', 'period', 'bucket_start', 'model', name='uq_usage_rollups_bucket')
+        )
+        backfill()
+
+
+def estimate_cost(model, tokens):
+    matches = [prefix for prefix in MODEL_PRICES if model == prefix or model.startswith(prefix + '-')]
+    if not matches:
+        return 0.0
+    input_price, output_price = MODEL_PRICES[max(matches, key=len)]
+    return round((tokens or 0) * (input_price * INPUT_SHARE + output_price * (1 - INPUT_SHARE)) / 1e6, 6)
+
+
+def aggregate(records):
+    """把一批使用记录合并为各时段（小时/天）的增量行"""
+    rows = {}
+    for record in records:
+        created_at = record['created_at'] or datetime.utcnow()
+        tokens = record['tokens_used'] or 0
+        cost = record['cost']
+        if cost is None:
+            cost = estimate_cost(record['model'], tokens)
+        response_time = record['response_time']
+        buckets = {
+            'hour': created_at.replace(minute=0, second=0, microsecond=0),
+            'day': created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+        }
+        for period, start in buckets.items():
+            key = (record['user_id'], period, start, record['model'])
+            row = rows.get(key)
+            if row is None:
+                row = rows[key] = dict(zip(KEY_COLUMNS, key), **{column: 0 for column in COUNTER_COLUMNS})
+            row['request_count'] += 1
+            row['error_count'] += int(record['status'] in ERROR_STATUSES)
+            row['cache_hits'] += int(bool(record['cache_hit']))
+            row['tokens_used'] += tokens
+            row['cost'] += cost
+            if response_time is not None:
+                row['latency_sum'] += response_time
+                row[LATENCY_COLUMNS[bisect_left(LATENCY_BOUNDS, response_time)]] += 1
+    return list(rows.values())
+
+
+def backfill():
+    """按ID分批读取已有使用记录并累加到汇总表"""
+    bind = op.get_bind()
+    insert = postgresql.insert if bind.dialect.name == 'postgresql' else sqlite.insert
+    statement = insert(usage_rollups)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(KEY_COLUMNS),
+        set_={column: usage_rollups.c[column] + statement.excluded[column] for column in COUNTER_COLUMNS}
+    )
+    last_id = 0
+    while True:
+        records = bind.execute(
+            sa.select(usage_records)
+            .where(usage_records.c.id > last_id)
+            .order_by(usage_records.c.id)
+            .limit(BACKFILL_BATCH_SIZE)
+        ).mappings().all()
+        if not records:
+            break
+        bind.execute(statement, aggregate(records))
+        last_id = records[-1]['id']
+
+
+def downgrade():
+    op.drop_table('usage_rollups')
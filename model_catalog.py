@@ -0,0 +1,159 @@
+"""
+模型目录缓存
+
+按API密钥哈希缓存 models.list() 的结果：登录验证和 /api/models 都从缓存读取，
+接近过期时在后台刷新，无效密钥做短时负缓存，避免登录高峰时每次都请求上游。
+模型能力（是否支持图片、上下文长度）由本地能力表提供。
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from openai_clients import client_pool, hash_api_key, sdk
+from rate_limiter import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+# 模型能力表，按最长前缀匹配模型ID
+MODEL_CAPABILITIES = {
+    'gpt-3.5-turbo': {'vision': False, 'max_context': 16385},
+    'gpt-3.5-turbo-instruct': {'vision': False, 'max_context': 4096},
+    'gpt-4': {'vision': False, 'max_context': 8192},
+    'gpt-4-32k': {'vision': False, 'max_context': 32768},
+    'gpt-4-0125-preview': {'vision': False, 'max_context': 128000},
+    'gpt-4-1106-preview': {'vision': False, 'max_context': 128000},
+    'gpt-4-turbo': {'vision': True, 'max_context': 128000},
+    'gpt-4-turbo-preview': {'vision': False, 'max_context': 128000},
+    'gpt-4-vision-preview': {'vision': True, 'max_context': 128000},
+    'gpt-4o': {'vision': True, 'max_context': 128000},
+    'gpt-4o-mini': {'vision': True, 'max_context': 128000},
+    'gpt-4.1': {'vision': True, 'max_context': 1047576},
+}
+
+DEFAULT_CAPABILITIES = {'vision': False, 'max_context': None}
+
+
+def model_capabilities(model):
+    """查询模型能力，未知模型返回默认值"""
+    matches = [prefix for prefix in MODEL_CAPABILITIES if model == prefix or model.startswith(prefix + '-')]
+    if not matches:
+        return dict(DEFAULT_CAPABILITIES)
+    return dict(MODEL_CAPABILITIES[max(matches, key=len)])
+
+
+def supports_vision(model):
+    return model_capabilities(model)['vision']
+
+
+def max_context(model):
+    return model_capabilities(model)['max_context']
+
+
+class _CatalogEntry:
+    def __init__(self, models, valid):
+        self.models = models
+        self.valid = valid
+        self.fetched_at = time.monotonic()
+
+
+class ModelCatalog:
+    """按密钥缓存的模型目录，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self._entries = OrderedDict()  # api_key_hash -> _CatalogEntry，按最近使用排序
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['MODEL_CATALOG_TTL']
+        self.negative_ttl = app.config['MODEL_CATALOG_NEGATIVE_TTL']
+        self.max_entries = app.config['MODEL_CATALOG_MAX_ENTRIES']
+        # 超过该比例的TTL后返回缓存并在后台刷新
+        self.refresh_after = self.ttl * app.config['MODEL_CATALOG_REFRESH_RATIO']
+        app.extensions['model_catalog'] = self
+
+    def get_models(self, api_key):
+        """返回密钥可用的模型ID列表；密钥无效时返回None，上游临时故障时抛出异常"""
+        key = hash_api_key(api_key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if not entry.valid:
+                if age < self.negative_ttl:
+                    return None
+            elif age < self.refresh_after:
+                return entry.models
+            elif age < self.ttl:
+                self._refresh_in_background(key, api_key)
+                return entry.models
+
+        entry = self._fetch(key, api_key)
+        return entry.models if entry.valid else None
+
+    def verify(self, api_key):
+        """验证密钥是否有效（有可用模型）"""
+        return self.get_models(api_key) is not None
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._entries.pop(hash_api_key(api_key), None)
+
+    def _fetch(self, key, api_key):
+        try:
+            models = rate_limiter.call(client_pool.get(api_key).models.list)
+        except (sdk().AuthenticationError, sdk().PermissionDeniedError) as e:
+            logger.warning(f"模型目录获取失败，密钥无效: {e}")
+            entry = _CatalogEntry([], valid=False)
+        else:
+            model_ids = sorted(model.id for model in models.data)
+            entry = _CatalogEntry(model_ids, valid=bool(model_ids))
+
+        if not entry.valid:
+            client_pool.discard(api_key)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._prune()
+        return entry
+
+    def _prune(self):
+        """先删除过期的条目，仍超过上限时删除最久未使用的条目"""
+        now = time.monotonic()
+        expired = [
+            key for key, entry in self._entries.items()
+            if now - entry.fetched_at >= (self.ttl if entry.valid else self.negative_ttl)
+        ]
+        for key in expired:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _refresh_in_background(self, key, api_key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                self._fetch(key, api_key)
+            except Exception as e:
+                # 刷新失败时保留旧缓存，过期后由下一次请求同步获取
+                logger.warning(f"后台刷新模型目录失败: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, name='model-catalog-refresh', daemon=True).start()
+
+
+model_catalog = ModelCatalog()
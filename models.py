@@ -14,11 +14,14 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
+    response_cache_enabled = db.Column(db.Boolean, nullable=False, default=True, server_default=db.true())  # 是否使用补全响应缓存
     
     # 关联关系
     conversations = db.relationship('Conversation', backref='user', lazy=True, cascade='all, delete-orphan')
     completions = db.relationship('Completion', backref='user', lazy=True, cascade='all, delete-orphan')
     usage_records = db.relationship('UsageRecord', backref='user', lazy=True, cascade='all, delete-orphan')
+    usage_rollups = db.relationship('UsageRollup', backref='user', lazy=True, cascade='all, delete-orphan')
+    batch_jobs = db.relationship('BatchJob', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def __repr__(self):
         return f'<User {self.id}: {self.api_key_masked}>'
@@ -26,6 +29,10 @@ class User(db.Model):
 class Conversation(db.Model):
     """对话模型"""
     __tablename__ = 'conversations'
+    __table_args__ = (
+        # get_active_conversation / 对话列表分页: 按用户和活跃状态过滤，按 (updated_at, id) 排序
+        db.Index('ix_conversations_user_active_updated', 'user_id', 'is_active', 'updated_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -35,6 +42,11 @@ class Conversation(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
     
+    # 消息统计（保存消息时同步维护，列表接口无需加载消息）
+    message_count = db.Column(db.Integer, default=0, nullable=False)
+    last_message_at = db.Column(db.DateTime)
+    last_message_preview = db.Column(db.String(100))
+    
     # 关联关系
     messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
 
@@ -44,6 +56,10 @@ class Conversation(db.Model):
 class Message(db.Model):
     """消息模型"""
     __tablename__ = 'messages'
+    __table_args__ = (
+        # get_conversation_messages / 消息分页: 按对话过滤，按 (created_at, id) 排序（SQLite索引隐含rowid）
+        db.Index('ix_messages_conversation_created', 'conversation_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
@@ -55,12 +71,18 @@ class Message(db.Model):
     model = db.Column(db.String(50))
     tokens_used = db.Column(db.Integer)
     
+    # 用户消息引用的图片ID列表（图片存储中的内容哈希）
+    image_ids = db.Column(db.JSON)
+    
     def __repr__(self):
         return f'<Message {self.id}: {self.role}>'
 
 class Completion(db.Model):
     """文本补全模型"""
     __tablename__ = 'completions'
+    __table_args__ = (
+        db.Index('ix_completions_user_created', 'user_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -80,10 +102,14 @@ class Completion(db.Model):
 class UsageRecord(db.Model):
     """使用记录模型"""
     __tablename__ = 'usage_records'
+    __table_args__ = (
+        # 按用户统计使用情况
+        db.Index('ix_usage_records_user_created', 'user_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    api_type = db.Column(db.String(20), nullable=False)  # 'chat', 'completion'
+    api_type = db.Column(db.String(20), nullable=False)  # 'chat', 'completion', 'batch'
     model = db.Column(db.String(50), nullable=False)
     tokens_used = db.Column(db.Integer, nullable=False)
     cost = db.Column(db.Float)  # 估算成本
@@ -91,11 +117,116 @@ class UsageRecord(db.Model):
     
     # API响应信息
     response_time = db.Column(db.Float)  # 响应时间（秒）
-    status = db.Column(db.String(20), default='success')  # 'success', 'error'
+    status = db.Column(db.String(20), default='success')  # 'success', 'error', 'aborted', 'rate_limited'
+    cache_hit = db.Column(db.Boolean)  # 是否命中响应缓存，未参与缓存的请求为空
 
     def __repr__(self):
         return f'<UsageRecord {self.id}: {self.api_type} - {self.tokens_used} tokens>'
 
+class UsageRollup(db.Model):
+    """使用统计汇总模型：按用户、模型和小时/天累加，写入使用记录时同步更新"""
+    __tablename__ = 'usage_rollups'
+    __table_args__ = (
+        # 唯一约束同时作为按用户和时间范围读取统计的索引
+        db.UniqueConstraint('user_id', 'period', 'bucket_start', 'model', name='uq_usage_rollups_bucket'),
+    )
+    
+    # 响应时间直方图各区间的上限（秒），latency_0 .. latency_11 依次对应，最后一个区间为超出上限
+    LATENCY_BOUNDS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # 'hour', 'day'
+    bucket_start = db.Column(db.DateTime, nullable=False)  # 时段起点（UTC）
+    model = db.Column(db.String(50), nullable=False)
+    
+    # 累计值
+    request_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)  # 上游错误和限流
+    cache_hits = db.Column(db.Integer, nullable=False, default=0)
+    tokens_used = db.Column(db.Integer, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0)  # 按本地价格表估算的成本（美元）
+    latency_sum = db.Column(db.Float, nullable=False, default=0)  # 有响应时间的请求的耗时总和（秒）
+    latency_0 = db.Column(db.Integer, nullable=False, default=0)
+    latency_1 = db.Column(db.Integer, nullable=False, default=0)
+    latency_2 = db.Column(db.Integer, nullable=False, default=0)
+    latency_3 = db.Column(db.Integer, nullable=False, default=0)
+    latency_4 = db.Column(db.Integer, nullable=False, default=0)
+    latency_5 = db.Column(db.Integer, nullable=False, default=0)
+    latency_6 = db.Column(db.Integer, nullable=False, default=0)
+    latency_7 = db.Column(db.Integer, nullable=False, default=0)
+    latency_8 = db.Column(db.Integer, nullable=False, default=0)
+    latency_9 = db.Column(db.Integer, nullable=False, default=0)
+    latency_10 = db.Column(db.Integer, nullable=False, default=0)
+    latency_11 = db.Column(db.Integer, nullable=False, default=0)
+    
+    @property
+    def latency_counts(self):
+        return [getattr(self, f'latency_{index}') for index in range(len(self.LATENCY_BOUNDS) + 1)]
+    
+    def __repr__(self):
+        return f'<UsageRollup {self.user_id} {self.model} {self.period} {self.bucket_start}>'
+
+class BatchJob(db.Model):
+    """批量处理任务模型"""
+    __tablename__ = 'batch_jobs'
+    __table_args__ = (
+        db.Index('ix_batch_jobs_user_created', 'user_id', 'created_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String(20), default='pending')  # 'pending', 'running', 'completed', 'cancelled', 'interrupted'
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # 执行进程最近一次心跳，用于识别中断的任务
+    
+    # API调用参数
+    model = db.Column(db.String(50), nullable=False)
+    max_tokens = db.Column(db.Integer)
+    temperature = db.Column(db.Float)
+    max_concurrency = db.Column(db.Integer, default=3)  # 并发上限
+    
+    # 进度统计
+    total_items = db.Column(db.Integer, default=0)
+    completed_items = db.Column(db.Integer, default=0)
+    failed_items = db.Column(db.Integer, default=0)
+    tokens_used = db.Column(db.Integer, default=0)
+    
+    # 关联关系
+    items = db.relationship('BatchItem', backref='job', lazy='dynamic', cascade='all, delete-orphan')
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'cancelled')
+
+    def __repr__(self):
+        return f'<BatchJob {self.id}: {self.status} {self.completed_items + self.failed_items}/{self.total_items}>'
+
+class BatchItem(db.Model):
+    """批量处理条目模型"""
+    __tablename__ = 'batch_items'
+    __table_args__ = (
+        db.Index('ix_batch_items_job_status', 'job_id', 'status'),
+        db.UniqueConstraint('job_id', 'index', name='uq_batch_items_job_index'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('batch_jobs.id'), nullable=False)
+    index = db.Column(db.Integer, nullable=False)  # 在提交数组中的位置
+    prompt = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='pending')  # 'pending', 'success', 'error'
+    response = db.Column(db.Text)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0)
+    tokens_used = db.Column(db.Integer)
+    duration = db.Column(db.Float)  # 耗时（秒）
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<BatchItem {self.job_id}#{self.index}: {self.status}>'
+
 class SystemConfig(db.Model):
     """系统配置模型"""
     __tablename__ = 'system_configs'
@@ -0,0 +1,193 @@
+"""
+进程级OpenAI客户端缓存
+
+按用户API密钥哈希（与 User.api_key_hash 相同）缓存OpenAI客户端，LRU淘汰并按空闲时间过期。
+所有客户端共用一个HTTP连接池，TLS连接在不同用户之间复用（API密钥只是请求头）。
+异步服务模式（asgi.py）使用的 AsyncOpenAI 客户端另有一个异步连接池，结构相同。
+重试由 rate_limiter 统一负责，客户端关闭SDK内置重试。
+OpenAI SDK导入较慢（约0.7秒），首次创建客户端时才通过 sdk() 加载，不拖慢worker启动。
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def sdk():
+    """OpenAI SDK模块，首次调用时导入；判断SDK异常类型时SDK必然已经加载，不会触发导入"""
+    import openai
+    return openai
+
+
+def hash_api_key(api_key):
+    """API密钥哈希，与用户表中的 api_key_hash 一致"""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class OpenAIClientPool:
+    """OpenAI客户端注册表，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self._clients = OrderedDict()  # api_key_hash -> (client, last_used)
+        self._async_clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._http_client = None
+        self._async_http_client = None
+        self._response_hooks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config['OPENAI_CLIENT_POOL_SIZE']
+        self.idle_ttl = app.config['OPENAI_CLIENT_IDLE_TTL']
+        self.base_url = app.config['OPENAI_BASE_URL']
+        self.timeout = app.config['OPENAI_TIMEOUT']
+        self.limits = httpx.Limits(
+            max_connections=app.config['OPENAI_MAX_CONNECTIONS'],
+            max_keepalive_connections=app.config['OPENAI_MAX_KEEPALIVE_CONNECTIONS'],
+            keepalive_expiry=app.config['OPENAI_KEEPALIVE_EXPIRY']
+        )
+        app.extensions['openai_clients'] = self
+
+    @property
+    def http_client(self):
+        """共享的HTTP连接池（按主机限制连接数并保持长连接）"""
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = sdk().DefaultHttpxClient(
+                    limits=self.limits,
+                    timeout=self.timeout,
+                    event_hooks={'response': [self._on_response]}
+                )
+            return self._http_client
+
+    @property
+    def async_http_client(self):
+        """异步客户端共享的HTTP连接池，只能在创建它的事件循环中使用"""
+        with self._lock:
+            if self._async_http_client is None:
+                self._async_http_client = sdk().DefaultAsyncHttpxClient(
+                    limits=self.limits,
+                    timeout=self.timeout,
+                    event_hooks={'response': [self._on_async_response]}
+                )
+            return self._async_http_client
+
+    def add_response_hook(self, hook):
+        """注册上游响应钩子（收到响应头时调用，例如读取限流额度）"""
+        if hook not in self._response_hooks:
+            self._response_hooks.append(hook)
+
+    def _on_response(self, response):
+        for hook in self._response_hooks:
+            try:
+                hook(response)
+            except Exception as e:
+                logger.warning(f"上游响应钩子执行失败: {e}")
+
+    async def _on_async_response(self, response):
+        self._on_response(response)
+
+    def get(self, api_key):
+        """获取（必要时创建）该密钥对应的客户端"""
+        return self._get(self._clients, api_key, lambda: sdk().OpenAI(
+            api_key=api_key,
+            base_url=self.base_url,
+            timeout=self.timeout,
+            max_retries=0,
+            http_client=self.http_client
+        ))
+
+    def get_async(self, api_key):
+        """获取（必要时创建）该密钥对应的 AsyncOpenAI 客户端"""
+        return self._get(self._async_clients, api_key, lambda: sdk().AsyncOpenAI(
+            api_key=api_key,
+            base_url=self.base_url,
+            timeout=self.timeout,
+            max_retries=0,
+            http_client=self.async_http_client
+        ))
+
+    def _get(self, clients, api_key, create):
+        key = hash_api_key(api_key)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_idle(clients, now)
+            entry = clients.get(key)
+            if entry is not None:
+                clients[key] = (entry[0], now)
+                clients.move_to_end(key)
+                return entry[0]
+
+        client = create()
+
+        with self._lock:
+            # 并发创建时保留先注册的实例
+            entry = clients.setdefault(key, (client, now))
+            clients.move_to_end(key)
+            while len(clients) > self.max_size:
+                clients.popitem(last=False)
+            return entry[0]
+
+    def discard(self, api_key):
+        """移除密钥对应的客户端（例如密钥验证失败后）"""
+        with self._lock:
+            self._clients.pop(hash_api_key(api_key), None)
+            self._async_clients.pop(hash_api_key(api_key), None)
+
+    def _evict_idle(self, clients, now):
+        # OrderedDict按最近使用排序，从最旧的一端开始清理
+        while clients:
+            key, (client, last_used) = next(iter(clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            clients.popitem(last=False)
+
+    def after_fork(self):
+        """fork后在子进程中调用：丢弃从父进程继承的连接池和锁（连接与父进程共用socket，不能关闭）"""
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+        self._async_clients = OrderedDict()
+        self._http_client = None
+        self._async_http_client = None
+
+    async def aclose(self):
+        """关闭异步客户端的连接池（异步服务退出时调用）"""
+        with self._lock:
+            http_client, self._async_http_client = self._async_http_client, None
+            self._async_clients.clear()
+        if http_client is not None:
+            await http_client.aclose()
+
+    def prewarm(self, connections):
+        """预先建立到上游的TLS连接，放入共享连接池供后续请求复用"""
+        if connections <= 0:
+            return
+        url = str(self.base_url or 'https://api.openai.com/v1').rstrip('/') + '/models'
+
+        def touch(_):
+            try:
+                # 未携带密钥，上游返回401即可，目的只是完成握手并保留长连接
+                self.http_client.get(url)
+            except httpx.HTTPError as e:
+                logger.warning(f"预热上游连接失败: {e}")
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(touch, range(connections)))
+        logger.info(f"已预热 {connections} 个上游连接，耗时 {time.time() - start:.2f}s")
+
+    def stats(self):
+        with self._lock:
+            return {'clients': len(self._clients), 'async_clients': len(self._async_clients), 'max_size': self.max_size}
+
+
+client_pool = OpenAIClientPool()
@@ -0,0 +1,304 @@
+"""
+上游调用限流与重试
+
+每个用户（API密钥）按每分钟请求数和每分钟token数各维护一个令牌桶，另按密钥+模型维护
+模型级令牌桶，其上限和剩余额度从上游返回的 x-ratelimit-* 响应头学习。
+额度不足时请求先排队等待（不超过 RATE_LIMIT_MAX_WAIT），而不是直接失败；
+上游仍返回429或5xx时按抖动指数退避重试，优先遵循 Retry-After。
+令牌桶是进程内的，多worker部署时上游响应头会让各进程的模型级额度保持同步。
+"""
+
+import asyncio
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from openai_clients import client_pool, hash_api_key, sdk
+
+logger = logging.getLogger(__name__)
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+class RateLimitExceeded(Exception):
+    """本地额度在最长等待时间内无法满足"""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"请求过于频繁，请在 {retry_after:.0f} 秒后重试")
+
+
+def is_retryable_error(error):
+    """限流、超时、连接失败和5xx错误值得重试，其余错误直接失败"""
+    openai = sdk()
+    if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def parse_duration(value):
+    """解析上游的重置时间格式，如 '1s'、'6m0s'、'20ms'"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(error):
+    """从上游错误响应中读取建议的重试等待时间（秒）"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    return parse_duration(headers.get('retry-after'))
+
+
+class TokenBucket:
+    """令牌桶：容量为一分钟的额度，按速率持续补充；允许预扣为负数，由调用方等待补足"""
+
+    def __init__(self, per_minute):
+        self.set_limit(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_limit(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """预扣额度，返回需要等待的秒数"""
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain_to(self, remaining, now):
+        """按上游报告的剩余额度校准"""
+        self._refill(now)
+        self.tokens = min(self.tokens, float(remaining))
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Ticket:
+    def __init__(self, token_buckets, tokens):
+        self.token_buckets = token_buckets
+        self.tokens = tokens
+        self.settled = False
+
+
+class RateLimiter:
+    """上游调用限流器，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._buckets = OrderedDict()  # (kind, key_hash, model) -> TokenBucket
+        self._lock = threading.Lock()
+        self.throttled = 0
+        self.retries = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['RATE_LIMIT_ENABLED']
+        self.user_rpm = app.config['RATE_LIMIT_USER_RPM']
+        self.user_tpm = app.config['RATE_LIMIT_USER_TPM']
+        self.model_rpm = app.config['RATE_LIMIT_MODEL_RPM']
+        self.model_tpm = app.config['RATE_LIMIT_MODEL_TPM']
+        self.max_wait = app.config['RATE_LIMIT_MAX_WAIT']
+        self.max_attempts = app.config['UPSTREAM_MAX_ATTEMPTS']
+        self.base_delay = app.config['UPSTREAM_RETRY_BASE_DELAY']
+        self.max_delay = app.config['UPSTREAM_RETRY_MAX_DELAY']
+        client_pool.add_response_hook(self.observe)
+        app.extensions['rate_limiter'] = self
+
+    def reserve(self, api_key, model, tokens, max_wait=-1):
+        """按预计token数预扣额度，返回 (额度凭据, 需要等待的秒数)，不在此处等待"""
+        if not self.enabled:
+            return None, 0.0
+        if max_wait == -1:
+            max_wait = self.max_wait
+
+        key = hash_api_key(api_key)
+        now = time.monotonic()
+        with self._lock:
+            reservations = []
+            for kind, per_minute, amount in (
+                ('user_requests', self.user_rpm, 1),
+                ('user_tokens', self.user_tpm, tokens),
+                ('model_requests', self.model_rpm, 1),
+                ('model_tokens', self.model_tpm, tokens),
+            ):
+                model_scope = model if kind.startswith('model') else None
+                bucket = self._bucket((kind, key, model_scope), per_minute)
+                if bucket is not None:
+                    reservations.append((kind, bucket, amount, bucket.reserve(amount, now)))
+
+            wait = max([reservation[3] for reservation in reservations] + [0.0])
+            if max_wait is not None and wait > max_wait:
+                for _, bucket, amount, _ in reservations:
+                    bucket.refund(amount, now)
+                self.throttled += 1
+                raise RateLimitExceeded(wait)
+
+        if wait > 0:
+            logger.info(f"本地限流排队 {wait:.2f}s - 模型: {model}")
+        return _Ticket([bucket for kind, bucket, _, _ in reservations if kind.endswith('tokens')], tokens), wait
+
+    def acquire(self, api_key, model, tokens, max_wait=-1):
+        """按预计token数预扣额度，必要时等待；max_wait为None时一直等待，默认使用配置值"""
+        ticket, wait = self.reserve(api_key, model, tokens, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+        return ticket
+
+    async def acquire_async(self, api_key, model, tokens, max_wait=-1):
+        """acquire 的异步版本，排队时不占用线程"""
+        ticket, wait = self.reserve(api_key, model, tokens, max_wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return ticket
+
+    def settle(self, ticket, actual_tokens):
+        """用实际消耗的token数修正预扣额度；上游调用失败时传0退回全部预扣额度。每个凭据只修正一次"""
+        if ticket is None or actual_tokens is None:
+            return
+        difference = ticket.tokens - actual_tokens
+        now = time.monotonic()
+        with self._lock:
+            if ticket.settled:
+                return
+            ticket.settled = True
+            for bucket in ticket.token_buckets:
+                if difference > 0:
+                    bucket.refund(difference, now)
+                else:
+                    bucket.reserve(-difference, now)
+
+    def call(self, fn, deadline=None):
+        """调用上游，429/5xx/超时按抖动指数退避重试；超过 deadline（time.monotonic）后不再重试"""
+        attempt = 1
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    async def call_async(self, fn, deadline=None):
+        """call 的异步版本，fn 返回协程"""
+        attempt = 1
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _retry_delay(self, error, attempt, deadline):
+        """第 attempt 次尝试失败后的等待时间，不应重试时返回None"""
+        if not is_retryable_error(error) or attempt >= self.max_attempts:
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+        delay = min(delay, self.max_delay)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        with self._lock:
+            self.retries += 1
+        logger.warning(f"上游调用失败，{delay:.2f}s 后第 {attempt + 1} 次尝试: {error}")
+        return delay
+
+    def observe(self, response):
+        """从上游响应头学习模型级额度（由共享HTTP客户端的响应钩子调用）"""
+        if not self.enabled:
+            return
+        headers = response.headers
+        if 'x-ratelimit-limit-requests' not in headers and response.status_code != 429:
+            return
+
+        authorization = response.request.headers.get('authorization', '')
+        if not authorization.startswith('Bearer '):
+            return
+        key = hash_api_key(authorization[len('Bearer '):])
+        try:
+            model = json.loads(response.request.content or b'{}').get('model')
+        except (ValueError, AttributeError):
+            model = None
+        if not model:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for kind, limit_header, remaining_header in (
+                ('model_requests', 'x-ratelimit-limit-requests', 'x-ratelimit-remaining-requests'),
+                ('model_tokens', 'x-ratelimit-limit-tokens', 'x-ratelimit-remaining-tokens'),
+            ):
+                limit = headers.get(limit_header)
+                if not limit or not limit.isdigit() or int(limit) <= 0:
+                    continue
+                bucket = self._bucket((kind, key, model), int(limit))
+                bucket.set_limit(int(limit))
+                remaining = headers.get(remaining_header)
+                if remaining and remaining.isdigit():
+                    bucket.drain_to(int(remaining), now)
+                if response.status_code == 429:
+                    bucket.drain_to(0, now)
+
+    def _bucket(self, scope, per_minute):
+        bucket = self._buckets.get(scope)
+        if bucket is None:
+            if not per_minute:
+                return None
+            bucket = self._buckets[scope] = TokenBucket(per_minute)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._prune()
+        else:
+            self._buckets.move_to_end(scope)
+        return bucket
+
+    def _prune(self):
+        # 额度已补满的桶与新建的桶等价，可以丢弃
+        now = time.monotonic()
+        for scope in [scope for scope, bucket in self._buckets.items() if bucket.idle(now)]:
+            del self._buckets[scope]
+        while len(self._buckets) > self.MAX_BUCKETS:
+            self._buckets.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'buckets': len(self._buckets), 'throttled': self.throttled, 'retries': self.retries}
+
+
+rate_limiter = RateLimiter()
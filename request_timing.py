@@ -0,0 +1,175 @@
+"""
+请求耗时分解与采样分析
+
+热点路径中的各阶段（用户查询、上下文构建、上游调用、提交事务等）用 span 记录耗时，
+通过 Server-Timing 响应头返回，浏览器开发者工具里即可看到慢请求的时间花在哪里。
+采样分析器按比例对请求启用 cProfile，并把结果保存为 .prof 文件（可用 snakeviz 或 pstats 查看）；
+采样比例由管理员通过接口设置，保存在 system_configs 表中，所有worker定期读取。
+"""
+
+import cProfile
+import inspect
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app, g, has_request_context, request
+
+from database import get_system_config, set_system_config
+
+logger = logging.getLogger(__name__)
+
+PROFILER_RATE_KEY = 'profiler_sample_rate'
+
+
+class RequestTiming:
+    """请求阶段计时，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['SERVER_TIMING_ENABLED']
+        if self.enabled:
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+        app.extensions['request_timing'] = self
+
+    @contextmanager
+    def span(self, name):
+        """记录一个阶段的耗时，同名阶段累加；不在请求中时不记录"""
+        if not self.enabled or not has_request_context() or 'timing_spans' not in g:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            spans = g.timing_spans
+            spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
+
+    def _before_request(self):
+        g.timing_start = time.perf_counter()
+        g.timing_spans = OrderedDict()
+
+    def _after_request(self, response):
+        # 流式响应的响应头先于正文发送，只包含开始转发之前的阶段
+        if 'timing_spans' in g:
+            entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in g.timing_spans.items()]
+            entries.append(f'total;dur={(time.perf_counter() - g.timing_start) * 1000:.1f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+
+class Profiler:
+    """按比例采样的请求分析器，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.sample_rate = 0.0
+        self.directory = None
+        self._loaded_at = None
+        self._active = threading.Lock()  # 同一进程同时只分析一个请求
+        self.profiled = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['PROFILER_DIR'] or os.path.join(app.instance_path, 'profiles')
+        self.default_rate = app.config['PROFILER_SAMPLE_RATE']
+        self.refresh_interval = app.config['PROFILER_REFRESH_INTERVAL']
+        self.max_files = app.config['PROFILER_MAX_FILES']
+        self.sample_rate = self.default_rate
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['profiler'] = self
+
+    def current_rate(self):
+        """当前采样比例，按刷新间隔从 system_configs 读取管理员的设置"""
+        now = time.monotonic()
+        if self._loaded_at is None or now - self._loaded_at >= self.refresh_interval:
+            self._loaded_at = now
+            value = get_system_config(PROFILER_RATE_KEY)
+            try:
+                self.sample_rate = float(value) if value is not None else self.default_rate
+            except ValueError:
+                self.sample_rate = self.default_rate
+        return self.sample_rate
+
+    def set_rate(self, rate):
+        """管理员设置采样比例（0为关闭），所有worker在刷新间隔内生效；保存失败时返回None"""
+        config = set_system_config(PROFILER_RATE_KEY, str(rate), '请求采样分析比例（0-1）')
+        if config is not None:
+            self.sample_rate = rate
+            self._loaded_at = time.monotonic()
+        return config
+
+    def _before_request(self):
+        if request.endpoint in (None, 'static'):
+            return
+        # 异步视图（asgi.py）的协程在事件循环线程上与其他请求交替执行，cProfile 的结果无法归属到单个请求
+        if inspect.iscoroutinefunction(inspect.unwrap(current_app.view_functions.get(request.endpoint))):
+            return
+        try:
+            rate = self.current_rate()
+        except Exception as e:
+            logger.warning(f"读取采样分析配置失败: {e}")
+            return
+        if rate <= 0 or random.random() >= rate or not self._active.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:  # 已有其他分析工具在运行
+            self._active.release()
+            return
+        g.profile = profile
+
+    def _teardown_request(self, error=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        try:
+            profile.disable()
+            self._dump(profile)
+        except Exception as e:
+            logger.warning(f"保存请求分析结果失败: {e}")
+        finally:
+            self._active.release()
+
+    def _dump(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = re.sub(r'[^A-Za-z0-9_]', '_', request.endpoint or 'unknown')
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}-{random.randrange(16 ** 4):04x}.prof"
+        profile.dump_stats(os.path.join(self.directory, name))
+        self.profiled += 1
+        self._prune()
+
+    def _prune(self):
+        files = self.profiles()
+        for name in files[self.max_files:]:
+            os.remove(os.path.join(self.directory, name))
+
+    def profiles(self):
+        """已保存的分析文件名，最新的在前"""
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.endswith('.prof')]
+        return sorted(names, reverse=True)
+
+    def path(self, name):
+        """分析文件路径，文件名无效或不存在时返回None"""
+        if name != os.path.basename(name) or not name.endswith('.prof'):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+
+request_timing = RequestTiming()
+profiler = Profiler()
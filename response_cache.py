@@ -0,0 +1,241 @@
+"""
+文本补全响应缓存
+
+temperature不高于阈值（默认只有0）的补全请求结果是确定的，同一用户重复提交相同的
+model / prompt / max_tokens / temperature 时直接返回缓存结果，不再请求上游。
+内存层为按条数和字节数限制的LRU；可选的磁盘层是一个独立的SQLite文件，
+多个worker进程共享，按最近访问时间淘汰。两层都有TTL。
+
+同一个缓存类也用于缓存自定义助手生成的system prompt和标题（配置前缀 ASSISTANT_CACHE），
+按规范化后的需求描述和模型共享，重复或热门的助手需求无需再请求上游。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(user_id, params):
+    """按用户和规范化后的请求参数计算缓存键"""
+    normalized = {
+        'user_id': user_id,
+        'model': params['model'],
+        'prompt': params['prompt'],
+        'max_tokens': int(params['max_tokens']),
+        'temperature': float(params['temperature'])
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def assistant_cache_key(user_request, model):
+    """按规范化后的助手需求描述和模型计算缓存键（忽略大小写、全半角和多余空白）"""
+    normalized = re.sub(r'\s+', ' ', unicodedata.normalize('NFKC', user_request)).strip().lower()
+    return hashlib.sha256(json.dumps(
+        {'request': normalized, 'model': model}, sort_keys=True, ensure_ascii=False
+    ).encode()).hexdigest()
+
+
+class _DiskTier:
+    """SQLite磁盘缓存层，每个线程使用独立连接"""
+
+    EVICT_EVERY = 100  # 每写入多少条检查一次容量
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_responses_accessed ON responses (accessed_at)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute('SELECT value, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        now = time.time()
+        if now - created_at >= self.ttl:
+            conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            return None
+        conn.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (key, value, len(value), now, now)
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """删除过期条目，总大小超出上限时按最近访问时间淘汰"""
+        conn = self._connection()
+        conn.execute('DELETE FROM responses WHERE created_at < ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        stale = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed_at ASC'):
+            stale.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM responses')
+
+
+class ResponseCache:
+    """响应缓存，用法与Flask扩展一致：先创建实例再 init_app；config_prefix 决定读取哪组配置"""
+
+    def __init__(self, app=None, config_prefix='RESPONSE_CACHE', name='response_cache'):
+        self.config_prefix = config_prefix
+        self.name = name
+        self.enabled = False
+        self._entries = OrderedDict()  # key -> (value_json, stored_at)
+        self._bytes = 0
+        self._disk = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        prefix = self.config_prefix
+        self.enabled = app.config[f'{prefix}_ENABLED']
+        self.max_temperature = app.config.get(f'{prefix}_MAX_TEMPERATURE', 0)
+        self.max_entries = app.config[f'{prefix}_MAX_ENTRIES']
+        self.max_bytes = app.config[f'{prefix}_MAX_BYTES']
+        self.ttl = app.config[f'{prefix}_TTL']
+        disk_path = app.config[f'{prefix}_DISK_PATH']
+        if self.enabled and disk_path:
+            try:
+                self._disk = _DiskTier(disk_path, app.config[f'{prefix}_DISK_MAX_BYTES'], self.ttl)
+            except Exception as e:
+                logger.warning(f"{self.name} 磁盘层初始化失败，仅使用内存缓存: {e}")
+        app.extensions[self.name] = self
+
+    def cacheable(self, user, params):
+        """只缓存确定性的请求，且用户未关闭缓存"""
+        return (
+            self.enabled
+            and user.response_cache_enabled is not False
+            and params['temperature'] is not None
+            and float(params['temperature']) <= self.max_temperature
+        )
+
+    def get(self, key):
+        """读取缓存，未命中返回None"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                if now - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(value)
+                self._remove(key)
+
+        if self._disk is not None:
+            try:
+                value = self._disk.get(key)
+            except Exception as e:
+                logger.warning(f"读取 {self.name} 磁盘层失败: {e}")
+                value = None
+            if value is not None:
+                # 磁盘层命中后提升到内存层
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                return json.loads(value)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, response):
+        if not self.enabled:
+            return
+        value = json.dumps(response, ensure_ascii=False)
+        self._store(key, value)
+        if self._disk is not None:
+            try:
+                self._disk.set(key, value)
+            except Exception as e:
+                logger.warning(f"写入 {self.name} 磁盘层失败: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk': self._disk is not None
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self._disk is not None:
+            self._disk.clear()
+
+    def _store(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, time.monotonic())
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+
+response_cache = ResponseCache()
+assistant_prompt_cache = ResponseCache(config_prefix='ASSISTANT_CACHE', name='assistant_prompt_cache')
@@ -1,70 +1,61 @@
 #!/usr/bin/env python3
 """
 OpenAI API调用平台启动脚本
-自动安装依赖并启动应用
+默认用gunicorn按 gunicorn.conf.py 启动（预加载应用，worker和线程数按CPU与预期并发计算），
+--dev 使用Flask开发服务器（调试模式、代码修改后自动重载）
 """
 
-import subprocess
-import sys
+import argparse
+import importlib.util
 import os
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def launch(port, dev=False):
+    """启动应用；生产模式下当前进程被gunicorn替换，不会返回"""
+    if dev:
+        from app import app, start_prewarm
+        start_prewarm(app)
+        app.run(debug=True, host='0.0.0.0', port=port)
+        return
+
+    if importlib.util.find_spec('gunicorn') is None:
+        print("未安装gunicorn，请先执行 pip install -r requirements.txt，或使用 --dev 启动开发服务器")
+        sys.exit(1)
+
+    os.environ['PORT'] = str(port)
+    os.chdir(BASE_DIR)
+    os.execv(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', os.path.join(BASE_DIR, 'gunicorn.conf.py')])
 
-def install_requirements():
-    """安装必需的依赖包"""
-    requirements = [
-        'flask',
-        'flask-cors', 
-        'openai',
-        'python-dotenv',
-        'gunicorn'
-    ]
-    
-    print("正在安装依赖包...")
-    for package in requirements:
-        try:
-            subprocess.check_call([sys.executable, '-m', 'pip', 'install', package])
-            print(f"✓ {package} 安装成功")
-        except subprocess.CalledProcessError:
-            print(f"✗ {package} 安装失败")
-            return False
-    
-    print("所有依赖包安装完成！")
-    return True
 
 def main():
+    parser = argparse.ArgumentParser(description='启动 endless-api')
+    parser.add_argument('--dev', action='store_true', help='使用Flask开发服务器（调试模式）')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT') or 5000))
+    args = parser.parse_args()
+
     print("=" * 50)
     print("OpenAI API调用平台")
     print("=" * 50)
-    
-    # 检查是否已安装Flask
-    try:
-        import flask
-        print("✓ Flask 已安装")
-    except ImportError:
-        print("Flask 未安装，正在安装依赖...")
-        if not install_requirements():
-            print("依赖安装失败，请手动安装")
-            return
-    
     print("\n程序功能:")
     print("🔑 用户登录：输入您的OpenAI API密钥")
     print("💬 智能对话：支持GPT模型聊天")
     print("📝 文本补全：文本生成和补全")
     print("⚙️ 参数调节：自定义模型参数")
     print("📊 使用统计：实时查看token消耗")
-    
-    print("\n启动应用...")
-    print("访问地址: http://localhost:5000")
+
+    print(f"\n启动应用（{'开发服务器' if args.dev else 'gunicorn'}）...")
+    print(f"访问地址: http://localhost:{args.port}")
     print("按 Ctrl+C 停止服务")
     print("-" * 50)
-    
-    # 启动Flask应用
+
     try:
-        from app import app
-        app.run(debug=True, host='0.0.0.0', port=5000)
+        launch(args.port, dev=args.dev)
     except KeyboardInterrupt:
         print("\n应用已停止")
-    except Exception as e:
-        print(f"启动失败: {e}")
+
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
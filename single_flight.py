@@ -0,0 +1,126 @@
+"""
+相同上游请求合并（single-flight）
+
+批量页面或客户端重试可能同时提交完全相同的请求（同一用户、模型、消息/提示文本和采样参数）。
+同一进程内，第一个请求负责调用上游，其余相同请求等待并共享它的结果（或异常），
+不再各自消耗一次上游调用和token。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(*parts):
+    """按请求内容计算合并键"""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode()
+    ).hexdigest()
+
+
+class _LeaderCancelled(Exception):
+    """异步领头请求被取消（客户端断开），等待者不应随之取消"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """进程内请求合并，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self._calls = {}  # key -> _Call
+        self._async_calls = {}  # key -> asyncio.Future，只在异步服务的事件循环中使用
+        self._lock = threading.Lock()
+        self.shared = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['SINGLE_FLIGHT_ENABLED']
+        # 等待时间略长于上游超时，正常情况下先等到领头请求结束
+        self.wait_timeout = app.config['OPENAI_TIMEOUT'] + 10
+        app.extensions['single_flight'] = self
+
+    def do(self, key, fn):
+        """执行 fn 或等待相同的进行中请求，返回 (结果, 是否为共享结果)"""
+        if not self.enabled:
+            return fn(), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            if not call.done.wait(self.wait_timeout):
+                raise TimeoutError('等待相同请求的结果超时')
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+            if call.waiters:
+                logger.info(f"合并相同请求 - 共享结果的请求数: {call.waiters}")
+
+    async def do_async(self, key, fn):
+        """do 的异步版本：fn 返回协程，等待者不占用线程"""
+        if not self.enabled:
+            return await fn(), False
+
+        while key in self._async_calls:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(self._async_calls[key]), self.wait_timeout)
+            except _LeaderCancelled:
+                # 领头请求被取消，由第一个醒来的等待者重新调用上游，其余等待者等待它的结果
+                continue
+            with self._lock:
+                self.shared += 1
+            return result, True
+
+        call = self._async_calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            call.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            call.set_exception(_LeaderCancelled())
+            call.exception()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # 没有等待者时避免 "exception was never retrieved" 警告
+            call.exception()
+            raise
+        finally:
+            self._async_calls.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': len(self._calls) + len(self._async_calls), 'shared': self.shared}
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,218 @@
+"""
+使用统计汇总
+
+写入使用记录时在同一事务中按 (用户, 模型, 小时/天) 累加请求数、错误数、token数、估算成本和响应时间直方图，
+/api/usage 只读取汇总表，读取的行数只与时间范围和模型数有关，不随使用记录增长。
+累加使用 INSERT ... ON CONFLICT DO UPDATE，多个worker同时写入同一时段也不会丢失计数。
+成本按本地价格表估算（可用 USAGE_PRICE_FILE 覆盖），百分位数由直方图插值得到，均为近似值。
+"""
+
+import json
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, UsageRollup
+
+# 模型价格表（美元/百万token：输入, 输出），按最长前缀匹配模型ID
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'gpt-3.5-turbo-instruct': (1.5, 2.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-4-32k': (60.0, 120.0),
+    'gpt-4-0125-preview': (10.0, 30.0),
+    'gpt-4-1106-preview': (10.0, 30.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4-vision-preview': (10.0, 30.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4.1': (2.0, 8.0),
+    'gpt-4.1-mini': (0.4, 1.6),
+    'gpt-4.1-nano': (0.1, 0.4),
+}
+
+# 使用记录只有总token数，按输入约占3/4的典型比例折算为单一价格
+INPUT_SHARE = 0.75
+
+PERIODS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+ERROR_STATUSES = ('error', 'rate_limited')
+KEY_COLUMNS = ('user_id', 'period', 'bucket_start', 'model')
+LATENCY_COLUMNS = tuple(f'latency_{index}' for index in range(len(UsageRollup.LATENCY_BOUNDS) + 1))
+COUNTER_COLUMNS = ('request_count', 'error_count', 'cache_hits', 'tokens_used', 'cost', 'latency_sum') + LATENCY_COLUMNS
+
+
+def bucket_start(timestamp, period):
+    """时间所在时段的起点"""
+    if period == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def latency_percentile(counts, percentile):
+    """由直方图估算百分位数（秒）：在所在区间内线性插值，落在超出上限的区间时返回上限"""
+    bounds = UsageRollup.LATENCY_BOUNDS
+    total = sum(counts)
+    if not total:
+        return None
+    rank = total * percentile / 100
+    seen = 0
+    for index, count in enumerate(counts[:len(bounds)]):
+        if count and seen + count >= rank:
+            lower = bounds[index - 1] if index else 0
+            return round(lower + (bounds[index] - lower) * (rank - seen) / count, 3)
+        seen += count
+    return float(bounds[-1])
+
+
+def upsert_rollups(session, rows):
+    """把增量累加到汇总表（不存在的时段插入新行）
+
+    按主键顺序写入，PostgreSQL上并发事务以相同顺序加锁，不会互相死锁。
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    statement = (postgresql.insert if dialect == 'postgresql' else sqlite.insert)(UsageRollup.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=list(KEY_COLUMNS),
+        set_={column: UsageRollup.__table__.c[column] + statement.excluded[column] for column in COUNTER_COLUMNS}
+    )
+    session.execute(statement, sorted(rows, key=lambda row: tuple(row[column] for column in KEY_COLUMNS)))
+
+
+class UsageStats:
+    """使用统计汇总与成本估算，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.prices = dict(MODEL_PRICES)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.prices = dict(MODEL_PRICES)
+        price_file = app.config['USAGE_PRICE_FILE']
+        if price_file:
+            with open(price_file) as file:
+                self.prices.update({model: tuple(price) for model, price in json.load(file).items()})
+        app.extensions['usage_stats'] = self
+
+    def price(self, model):
+        """模型价格（美元/百万token：输入, 输出），价格表中没有的模型返回None"""
+        if not isinstance(model, str):
+            return None
+        matches = [prefix for prefix in self.prices if model == prefix or model.startswith(prefix + '-')]
+        if not matches:
+            return None
+        return self.prices[max(matches, key=len)]
+
+    def estimate_cost(self, model, tokens):
+        """按价格表估算成本（美元），未知模型返回None"""
+        price = self.price(model)
+        if price is None:
+            return None
+        input_price, output_price = price
+        return round((tokens or 0) * (input_price * INPUT_SHARE + output_price * (1 - INPUT_SHARE)) / 1e6, 6)
+
+    def aggregate(self, records):
+        """把一组使用记录（字段与 UsageRecord 相同的字典）合并为各时段的增量行"""
+        rows = {}
+        for record in records:
+            created_at = record.get('created_at') or datetime.utcnow()
+            tokens = record.get('tokens_used') or 0
+            cost = record.get('cost')
+            if cost is None:
+                cost = self.estimate_cost(record['model'], tokens) or 0.0
+            response_time = record.get('response_time')
+            for period in PERIODS:
+                key = (record['user_id'], period, bucket_start(created_at, period), record['model'])
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = dict(zip(KEY_COLUMNS, key), **{column: 0 for column in COUNTER_COLUMNS})
+                row['request_count'] += 1
+                row['error_count'] += int(record.get('status') in ERROR_STATUSES)
+                row['cache_hits'] += int(bool(record.get('cache_hit')))
+                row['tokens_used'] += tokens
+                row['cost'] += cost
+                if response_time is not None:
+                    row['latency_sum'] += response_time
+                    row[LATENCY_COLUMNS[bisect_left(UsageRollup.LATENCY_BOUNDS, response_time)]] += 1
+        return list(rows.values())
+
+    def add(self, records):
+        """在当前事务中累加一组使用记录，由调用方与使用记录一起提交"""
+        upsert_rollups(db.session, self.aggregate(records))
+
+    def summary(self, user_id, period='day', limit=30, now=None):
+        """用户最近 limit 个时段的统计：总计、按模型汇总和逐时段序列（时间为UTC）"""
+        step = PERIODS[period]
+        start = bucket_start(now or datetime.utcnow(), period) - step * (limit - 1)
+        rows = UsageRollup.query.filter(
+            UsageRollup.user_id == user_id,
+            UsageRollup.period == period,
+            UsageRollup.bucket_start >= start
+        ).all()
+
+        totals = _Totals()
+        models = {}
+        series = {start + step * index: _Totals() for index in range(limit)}
+        for row in rows:
+            totals.add(row)
+            models.setdefault(row.model, _Totals()).add(row)
+            if row.bucket_start in series:
+                series[row.bucket_start].add(row)
+
+        return {
+            'period': period,
+            'since': start.isoformat(),
+            'totals': totals.to_dict(),
+            'models': [
+                dict(model=model, priced=self.price(model) is not None, **model_totals.to_dict())
+                for model, model_totals in sorted(models.items(), key=lambda item: -item[1].requests)
+            ],
+            'series': [dict(start=bucket.isoformat(), **bucket_totals.to_dict(latency=False))
+                       for bucket, bucket_totals in series.items()]
+        }
+
+
+class _Totals:
+    """多个汇总行的合计"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.tokens = 0
+        self.cost = 0.0
+        self.latency_sum = 0.0
+        self.latency_counts = [0] * len(LATENCY_COLUMNS)
+
+    def add(self, row):
+        self.requests += row.request_count
+        self.errors += row.error_count
+        self.cache_hits += row.cache_hits
+        self.tokens += row.tokens_used
+        self.cost += row.cost
+        self.latency_sum += row.latency_sum
+        self.latency_counts = [total + count for total, count in zip(self.latency_counts, row.latency_counts)]
+
+    def to_dict(self, latency=True):
+        result = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'cache_hits': self.cache_hits,
+            'tokens': self.tokens,
+            'cost': round(self.cost, 4)
+        }
+        if latency:
+            timed = sum(self.latency_counts)
+            result['latency'] = {
+                'avg': round(self.latency_sum / timed, 3) if timed else None,
+                'p50': latency_percentile(self.latency_counts, 50),
+                'p95': latency_percentile(self.latency_counts, 95),
+                'p99': latency_percentile(self.latency_counts, 99)
+            }
+        return result
+
+
+usage_stats = UsageStats()
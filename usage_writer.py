@@ -0,0 +1,135 @@
+"""
+使用记录异步写入器
+
+使用记录只用于统计，不应占用用户请求的响应时间，也不应与消息写入争抢SQLite写锁。
+记录先放入有界内存队列，由后台线程按数量或时间阈值批量插入；队列满时丢弃并计数，
+进程退出时把队列中剩余的记录写完。每批记录与对应的使用统计汇总（usage_stats）在同一事务中提交。
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from models import db, UsageRecord
+from usage_stats import usage_stats
+
+logger = logging.getLogger(__name__)
+
+
+class UsageWriter:
+    """后台批量写入使用记录，用法与Flask扩展一致：先创建实例再 init_app"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['USAGE_WRITER_ENABLED']
+        self.queue_size = app.config['USAGE_QUEUE_SIZE']
+        self.flush_size = app.config['USAGE_FLUSH_SIZE']
+        self.flush_interval = app.config['USAGE_FLUSH_INTERVAL']
+        app.extensions['usage_writer'] = self
+
+    @property
+    def active(self):
+        return self.app is not None and self.enabled
+
+    def record(self, **fields):
+        """记录一条使用记录，不阻塞调用方；队列已满时丢弃并返回False"""
+        fields.setdefault('created_at', datetime.utcnow())
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(fields)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped == 1 or dropped % 1000 == 0:
+                logger.warning(f"使用记录队列已满，累计丢弃 {dropped} 条")
+            return False
+
+    def stats(self):
+        """队列积压与写入情况"""
+        return {
+            'backlog': self._queue.qsize() if self._queue else 0,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed': self.failed
+        }
+
+    def _ensure_started(self):
+        # 按进程启动：gunicorn预加载后fork出的worker不会继承父进程的线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5.0):
+        """停止后台线程，并等待剩余记录写入"""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch:
+                self._write(batch)
+            elif self._stopping.is_set():
+                return
+
+    def _collect(self):
+        """收集一批记录：攒够 flush_size 条或等待 flush_interval 秒"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or (self._stopping.is_set() and self._queue.empty()):
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, 0.2)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _write(self, batch):
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(UsageRecord), batch)
+                usage_stats.add(batch)
+                db.session.commit()
+                self.written += len(batch)
+            except Exception as e:
+                db.session.rollback()
+                self.failed += len(batch)
+                logger.error(f"批量写入使用记录失败（{len(batch)}条）: {e}")
+            finally:
+                db.session.remove()
+
+
+usage_writer = UsageWriter()